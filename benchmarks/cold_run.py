@@ -0,0 +1,90 @@
+"""
+Cold run throughput for a growing number of jobs.
+
+Every run starts with an empty cache, so all files are analysed by the
+workers and all results are written back to the cache.
+
+    python benchmarks/cold_run.py --files 2000 --jobs 1 2 4 8
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modernmetric.__main__ import main  # noqa: E402
+
+TESTFILES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "testfiles"
+)
+
+
+def make_tree(root, count):
+    """
+    count distinct files, copies of the testfiles padded with a different
+    number of trailing newlines
+    """
+    _sources = [
+        os.path.join(TESTFILES, x)
+        for x in sorted(os.listdir(TESTFILES))
+        if x.startswith("test.")
+    ]
+    res = []
+    for i in range(count):
+        _source = _sources[i % len(_sources)]
+        _name, _ext = os.path.splitext(os.path.basename(_source))
+        _path = os.path.join(root, "{}_{}{}".format(_name, i, _ext))
+        with open(_source, "rb") as src, open(_path, "wb") as o:
+            o.write(src.read())
+            o.write(b"\n" * (i // len(_sources) + 1))
+        res.append(_path)
+    return res
+
+
+def run(files, jobs, home):
+    _cache = os.path.join(home, ".modernmetric_cache")
+    shutil.rmtree(_cache, ignore_errors=True)
+    _start = time.perf_counter()
+    main(
+        custom_args=files
+        + ["--jobs", str(jobs), "--output_file", os.path.join(home, "out.json")]
+    )
+    return time.perf_counter() - _start
+
+
+def bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=1000, help="Number of files")
+    parser.add_argument(
+        "--jobs", type=int, nargs="+", default=[1, 2, 4, 8], help="Job counts"
+    )
+    args = parser.parse_args()
+
+    _tmp = tempfile.mkdtemp(prefix="modernmetric_bench_")
+    _home = os.environ.get("HOME")
+    try:
+        # keep the benchmark cache away from the user's one
+        os.environ["HOME"] = _tmp
+        _tree = os.path.join(_tmp, "tree")
+        os.mkdir(_tree)
+        files = make_tree(_tree, args.files)
+        print("{:>6} {:>10} {:>12}".format("jobs", "seconds", "files/s"))
+        for jobs in args.jobs:
+            _elapsed = run(files, jobs, _tmp)
+            print(
+                "{:>6} {:>10.2f} {:>12.1f}".format(
+                    jobs, _elapsed, len(files) / _elapsed
+                )
+            )
+    finally:
+        if _home is not None:
+            os.environ["HOME"] = _home
+        shutil.rmtree(_tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    bench()
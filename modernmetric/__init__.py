@@ -1,3 +1,15 @@
-from .diff_process import process_diff_content
+__all__ = ["Analyser", "cls", "process_diff_content"]
 
-__all__ = ["cls", "process_diff_content"]
+
+def __getattr__(name):
+    # imported on first use, the thin client (modernmetric.client) doesn't
+    # need pygments and the metric modules
+    if name == "process_diff_content":
+        from .diff_process import process_diff_content
+
+        return process_diff_content
+    if name == "Analyser":
+        from .api import Analyser
+
+        return Analyser
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
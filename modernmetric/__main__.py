@@ -1,20 +1,114 @@
 import argparse
+import io
 import json
+import math
+import os
+import signal
+import socket
 import textwrap
+from collections import Counter, deque
+from contextlib import ExitStack, redirect_stderr, redirect_stdout
 from multiprocessing import Pool, TimeoutError
+from multiprocessing.util import Finalize
 from functools import partial
 import sys
 from typing import Union
-from pathlib import Path
-from cachehash.main import Cache
 
+from modernmetric.cache import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_SIZE_MB
+from modernmetric.cache import CacheWriter, export_bundle, import_bundle, open_cache
+from modernmetric.cache import analyser_fingerprint, get_cache_path, imports_hash
+from modernmetric.archive import input_members, member_batches
+from modernmetric.client import DEFAULT_SOCKET, receive_message, send_message
+from modernmetric.client import socket_path
 from modernmetric.cls.importer.pick import importer_pick
+from modernmetric.cls.modules import finish_result, fold_aggregates
 from modernmetric.cls.modules import get_additional_parser_args
-from modernmetric.cls.modules import get_modules_calculated
 from modernmetric.cls.modules import get_modules_metrics
-from modernmetric.cls.modules import get_modules_stats
-from modernmetric.fp import file_process
+from modernmetric.cls.modules import overall_section
+from modernmetric.cls.modules import new_aggregates
+from modernmetric.cls.modules import pack_store
+from modernmetric.fp import cached_result, content_digests, file_process
+from modernmetric.fp import take_content_digests, take_io_counters
+from modernmetric.fp import tier_keys
+from modernmetric.diff_process import metric_delta, process_revision_file
+from modernmetric.git import CatFile, changed_files, commits, resolve, toplevel
+from modernmetric.history import select_files, version_results
+from modernmetric.incremental import file_digests, incremental_section
+from modernmetric.incremental import read_previous, split_unchanged
 from modernmetric.license import report
+from modernmetric.shard import in_shard
+from modernmetric.shard import merge_partials
+from modernmetric.shard import parse_shard
+from modernmetric.shard import partial_result
+from modernmetric.shard import read_partials
+from modernmetric.shard import select_shard
+from modernmetric.watch import DEFAULT_DEBOUNCE, BucketAggregates, IncrementalStats
+from modernmetric.watch import OwnFiles
+from modernmetric.watch import open_watcher, scan_files, touched_files, watch_loop
+
+# upper bound for the automatic --batch-size
+MAX_AUTO_BATCH_SIZE = 64
+
+
+def add_importer_args(parser):
+    parser.add_argument(
+        "--warn_compiler",
+        default=None,
+        help="File(s) holding information about compiler warnings",
+    )
+    parser.add_argument(
+        "--warn_duplication",
+        default=None,
+        help="File(s) holding information about code duplications",
+    )
+    parser.add_argument(
+        "--warn_functional",
+        default=None,
+        help="File(s) holding information about static code analysis findings",
+    )
+    parser.add_argument(
+        "--warn_standard",
+        default=None,
+        help="File(s) holding information about language standard violations",
+    )
+    parser.add_argument(
+        "--warn_security",
+        default=None,
+        help="File(s) File(s) holding information about found security issue",
+    )
+    parser.add_argument(
+        "--coverage",
+        default=None,
+        help="File(s) with compiler warningsFile(s) holding information about testing coverage",
+    )  # noqa: E501
+
+
+def add_cache_args(parser):
+    parser.add_argument(
+        "--cache-dir",
+        default=".modernmetric_cache",
+        help="Directory to store cache files (default: .modernmetric_cache)",
+    )
+
+    parser.add_argument(
+        "--cache-db",
+        default="modernmetric.db",
+        help="SQLite database file for caching (default: modernmetric.db)",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE_MB,
+        help="Evict the least recently used entries once the cache is larger\n"
+        "than this many MB (default: {}, 0 = no limit)".format(DEFAULT_MAX_SIZE_MB),
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE_DAYS,
+        help="Evict entries not used for this many days\n"
+        "(default: {}, 0 = no limit)".format(DEFAULT_MAX_AGE_DAYS),
+    )
 
 
 def ArgParser(custom_args=None):
@@ -57,40 +151,68 @@ def ArgParser(custom_args=None):
         type=int,
         help="Timeout in seconds for file processing",
     )
+    add_importer_args(parser)
     parser.add_argument(
-        "--warn_compiler",
-        default=None,
-        help="File(s) holding information about compiler warnings",
+        "--dump", default=False, action="store_true", help="Just dump the token tree"
     )
+    parser.add_argument("--jobs", type=int, default=1, help="Run x jobs in parallel")
     parser.add_argument(
-        "--warn_duplication",
-        default=None,
-        help="File(s) holding information about code duplications",
+        "--batch-size",
+        type=int,
+        default=0,
+        help="Files analysed per task, a worker pre-aggregates the results\n"
+        "of a batch (default: 0 = automatic, up to {})".format(MAX_AUTO_BATCH_SIZE),
     )
     parser.add_argument(
-        "--warn_functional",
-        default=None,
-        help="File(s) holding information about static code analysis findings",
+        "--io-stats",
+        default=False,
+        action="store_true",
+        help="Report the number of bytes read per file on stderr",
     )
     parser.add_argument(
-        "--warn_standard",
+        "--shard",
+        type=parse_shard,
         default=None,
-        help="File(s) holding information about language standard violations",
+        metavar="K/N",
+        help="Only analyse the K-th of N deterministic shards of the file list\n"
+        "and write a partial result, see 'modernmetric merge'",
     )
     parser.add_argument(
-        "--warn_security",
-        default=None,
-        help="File(s) File(s) holding information about found security issue",
+        "--with-stores",
+        default=False,
+        action="store_true",
+        help="Add the content hash and the metric store of every file to the\n"
+        "output, for a later --incremental run",
     )
     parser.add_argument(
-        "--coverage",
+        "--incremental",
         default=None,
-        help="File(s) with compiler warningsFile(s) holding information about testing coverage",
-    )  # noqa: E501
+        metavar="PREVIOUS_OUTPUT",
+        help="Take the results of unchanged files from the output of a previous\n"
+        "run with --with-stores and only analyse new and changed files,\n"
+        "implies --with-stores",
+    )
     parser.add_argument(
-        "--dump", default=False, action="store_true", help="Just dump the token tree"
+        "--watch",
+        default=False,
+        action="store_true",
+        help="Watch the files and directories passed and update the output\n"
+        "whenever they change, until interrupted",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=DEFAULT_DEBOUNCE,
+        help="With --watch, seconds without further changes before the\n"
+        "output is updated (default: {})".format(DEFAULT_DEBOUNCE),
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=None,
+        help="With --watch, poll for changes every this many seconds instead\n"
+        "of using inotify",
     )
-    parser.add_argument("--jobs", type=int, default=1, help="Run x jobs in parallel")
     parser.add_argument(
         "--ignore_lexer_errors", default=True, help="Ignore unparseable files"
     )
@@ -98,23 +220,31 @@ def ArgParser(custom_args=None):
     parser.add_argument(
         "--file", type=str, help="Path to the JSON file list of file paths"
     )
-
     parser.add_argument(
-        "files", metavar="file", type=str, nargs="*", help="List of file paths"
+        "--archive",
+        action="append",
+        default=[],
+        help="Analyse the files of a tar (.tar, .tar.gz, .tgz, .tar.bz2,\n"
+        ".tar.xz) or zip archive without extracting it, can be repeated",
     )
-
-    # Add cachehash arguments
     parser.add_argument(
-        "--cache-dir",
-        default=".modernmetric_cache",
-        help="Directory to store cache files (default: .modernmetric_cache)",
+        "--git-tree",
+        action="append",
+        default=[],
+        metavar="REV",
+        help="Analyse the files of a revision of the git repository --repo\n"
+        "without checking it out, can be repeated",
+    )
+    parser.add_argument(
+        "--repo", default=".", help="Git repository of --git-tree (default: .)"
     )
 
     parser.add_argument(
-        "--cache-db",
-        default="modernmetric.db",
-        help="SQLite database file for caching (default: modernmetric.db)",
+        "files", metavar="file", type=str, nargs="*", help="List of file paths"
     )
+
+    # Add cache arguments
+    add_cache_args(parser)
     parser.add_argument(
         "--no-cache", action="store_true", help="Disable result caching"
     )
@@ -130,27 +260,57 @@ def ArgParser(custom_args=None):
     input_file = RUNARGS.file
 
     if (
-        not file_paths and not input_file
+        not file_paths
+        and not input_file
+        and not RUNARGS.archive
+        and not RUNARGS.git_tree
     ):  # No file passed in, read filelist from command line  # noqa: E501
         raise Exception(
             "No filelist provided. Provide path to file list with --file=<path>"
         )  # noqa: E501
+    for path in RUNARGS.archive:
+        if not os.path.isfile(path):
+            parser.error("archive {} doesn't exist".format(path))
 
     if input_file:
-        with open(input_file) as file:
-            data = json.load(file)
-            if isinstance(data, dict) and "files" in data:
-                for file in data["files"]:
-                    RUNARGS.files.append(file["path"])
-            elif isinstance(data, list):
-                if all(isinstance(item, dict) and "path" in item for item in data):
-                    for file in data:
-                        RUNARGS.files.append(file["path"])
-                else:
-                    RUNARGS.files.extend(data)
+        RUNARGS.files.extend(read_file_list(input_file))
+    if RUNARGS.incremental:
+        if RUNARGS.shard or RUNARGS.dump:
+            parser.error("--incremental can't be combined with --shard or --dump")
+        RUNARGS.with_stores = True
+    if RUNARGS.watch and (
+        RUNARGS.shard
+        or RUNARGS.dump
+        or RUNARGS.with_stores
+        or RUNARGS.archive
+        or RUNARGS.git_tree
+    ):
+        parser.error(
+            "--watch can't be combined with --shard, --dump, --with-stores,\n"
+            "--incremental, --archive or --git-tree"
+        )
     return RUNARGS
 
 
+def read_file_list(input_file):
+    """
+    File paths of a --file JSON file list
+    """
+    res = []
+    with open(input_file) as file:
+        data = json.load(file)
+        if isinstance(data, dict) and "files" in data:
+            for file in data["files"]:
+                res.append(file["path"])
+        elif isinstance(data, list):
+            if all(isinstance(item, dict) and "path" in item for item in data):
+                for file in data:
+                    res.append(file["path"])
+            else:
+                res.extend(data)
+    return res
+
+
 # process_file returns (res, _file, _lexer.name, tokens, store)
 RES_KEY_RES = 0
 RES_KEY_FILE = 1
@@ -159,12 +319,807 @@ RES_KEY_TOKENS = 3
 RES_KEY_STORE = 4
 
 
-def process_file(f, args, importer):
-    db_path = Path(Path.home(), args.cache_dir, args.cache_db)
-    if not db_path.parent.exists():
-        db_path.parent.mkdir(parents=True, exist_ok=True)
-    cache = None if args.no_cache else Cache(db_path, "modernmetric")
-    return file_process(f, args, importer, cache)
+def compact_result(result, args):
+    """
+    Shrink a file_process result before it is pickled back to the parent:
+    tokens are only kept for --dump and the store is densely encoded
+    """
+    return (
+        result[RES_KEY_RES],
+        result[RES_KEY_FILE],
+        result[RES_KEY_LEXER],
+        result[RES_KEY_TOKENS] if args.dump else [],
+        pack_store(result[RES_KEY_STORE]),
+    )
+
+
+# cache connection of the worker process, see init_worker
+_worker_cache = None
+_worker_cache_opened = False
+_worker_cache_close = None
+# worker_cache_key of the cache of a worker of the daemon's pool
+_worker_cache_key = None
+# worker pool of a 'modernmetric serve' daemon, kept over its requests
+_shared_pool = None
+
+
+def init_worker(args, importer, defer_writes=False):
+    """
+    Pool initializer, opens the cache once per worker. The connection is
+    closed when the worker exits. With defer_writes the new entries are
+    returned by process_batch instead of being written by the worker.
+    """
+    global _worker_cache, _worker_cache_opened, _worker_cache_close
+    _worker_cache = open_cache(args, importer, defer_writes=defer_writes)
+    _worker_cache_opened = True
+    _worker_cache_close = None
+    if _worker_cache is not None:
+        _worker_cache_close = Finalize(
+            _worker_cache, _worker_cache.close, exitpriority=10
+        )
+
+
+def worker_cache_key(args, importer):
+    """
+    Identifies the cache a request to the daemon needs: the database and
+    the metric options and imports the entries are keyed with
+    """
+    if getattr(args, "no_cache", False):
+        return None
+    return (str(get_cache_path(args)), analyser_fingerprint(args, importer))
+
+
+def enter_request(cwd, cache_key, args, importer):
+    """
+    Prepare a worker of the daemon's pool for a request: relative paths are
+    relative to the client's directory, and the cache is opened again only
+    if the request uses another one than the previous request
+    """
+    global _worker_cache_key
+    if os.getcwd() != cwd:
+        os.chdir(cwd)
+    if not _worker_cache_opened or cache_key != _worker_cache_key:
+        if _worker_cache_close is not None:
+            _worker_cache_close()
+        init_worker(args, importer, defer_writes=True)
+        _worker_cache_key = cache_key
+
+
+def process_file(f, args, importer, digest=None, content=None):
+    if not _worker_cache_opened:
+        # not running in a pool set up by main()
+        init_worker(args, importer)
+    return compact_result(
+        file_process(f, args, importer, _worker_cache, digest=digest, content=content),
+        args,
+    )
+
+
+def prefetch_cached(files, args, cache):
+    """
+    Look up the files in the cache from the parent process.
+    Returns the compact results of the hits and the misses as
+    (file, content hash or None) pairs.
+    """
+    if cache is None or cache.is_empty():
+        # cold run, don't read every file twice
+        return [], [(f, None) for f in files]
+    # only files known unchanged by the stat index are looked up, without
+    # reading them; the others are read and hashed once, by the workers
+    _digests = cache.indexed_digests(files)
+    _keys = [
+        (f, _digests.get(f), cache.key(f, _digests[f]) if f in _digests else None)
+        for f in files
+    ]
+    _cached = cache.get_many([k for _, _, k in _keys if k is not None])
+
+    hits = []
+    misses = []
+    for f, _digest, k in _keys:
+        _result = cached_result(_cached.get(k), f)
+        if _result is None:
+            misses.append((f, _digest))
+        else:
+            if getattr(args, "with_stores", False):
+                content_digests[f] = _digest
+            hits.append(compact_result(_result, args))
+    return hits, misses
+
+
+def get_batches(files, args):
+    _size = args.batch_size
+    if _size < 1:
+        _size = max(
+            1, min(MAX_AUTO_BATCH_SIZE, math.ceil(len(files) / (args.jobs * 4.0)))
+        )
+    return [files[i : i + _size] for i in range(0, len(files), _size)]
+
+
+def process_batch(files, args, importer, request=None):
+    """
+    Analyse several (file, content hash) pairs in one task, or (member
+    name, None, content) triples of archive members. The file stores are folded into one
+    partial aggregate per metric, which is all the parent needs to compute
+    the overall section, so the stores themselves are not sent back,
+    unless a --shard, --with-stores or --watch run needs them.
+    New cache entries are returned as well, for the parent to write them,
+    with --io-stats the I/O counters of the batch and with --with-stores
+    the content hashes of its files.
+    request is the (working directory, worker_cache_key) of a request to
+    the daemon, when running in its pool. What the batch prints is returned
+    as (stdout, stderr) then, for the client, and is empty otherwise.
+    """
+    _metrics = get_modules_metrics(args)
+    _aggregates = new_aggregates(_metrics)
+    _keep_stores = (
+        getattr(args, "shard", None) is not None
+        or getattr(args, "with_stores", False)
+        or getattr(args, "watch", False)
+    )
+    results = []
+    _output = (io.StringIO(), io.StringIO())
+    with ExitStack() as stack:
+        if request is not None:
+            stack.enter_context(redirect_stdout(_output[0]))
+            stack.enter_context(redirect_stderr(_output[1]))
+            enter_request(*request, args, importer)
+        for f, digest, *content in files:
+            file_result = process_file(f, args, importer, digest, *content)
+            fold_aggregates(_metrics, _aggregates, file_result[RES_KEY_STORE])
+            if not _keep_stores:
+                file_result = file_result[:RES_KEY_STORE] + ({},)
+            results.append(file_result)
+    _pending = _worker_cache.take_pending() if _worker_cache is not None else ([], [])
+    # drained in every batch, workers of the daemon and of --watch live on
+    _io = take_io_counters()
+    if not getattr(args, "io_stats", False):
+        _io = ({}, {})
+    return (
+        results,
+        _aggregates,
+        _pending,
+        _io,
+        take_content_digests(),
+        tuple(x.getvalue() for x in _output),
+    )
+
+
+def write_cache_entries(writer, pending=None):
+    """
+    Queue the pending entries of a worker at writer, or flush it if
+    pending is None
+    """
+    try:
+        if pending is None:
+            writer.flush()
+        else:
+            writer.add(*pending)
+    except Exception as e:
+        print(f"Cache error: {e}", file=sys.stderr)
+
+
+def report_io_stats(reads, nbytes):
+    """
+    Print the I/O counters collected with --io-stats, files that were read
+    more than once are listed
+    """
+    print(
+        "\rRead {} bytes in {} reads of {} files".format(
+            sum(nbytes.values()), sum(reads.values()), len(reads)
+        ),
+        file=sys.stderr,
+    )
+    for f, n in sorted(reads.items()):
+        if n > 1:
+            print(f"{f}: read {n} times, {nbytes[f]} bytes", file=sys.stderr)
+
+
+def evict_cache(cache, args):
+    """
+    Apply the --cache-max-size and --cache-max-age limits to cache
+    """
+    try:
+        cache.flush()
+        return cache.evict(
+            max_bytes=args.cache_max_size * 1024 * 1024,
+            max_age=args.cache_max_age * 24 * 3600,
+        )
+    except Exception as e:
+        print(f"Cache error: {e}", file=sys.stderr)
+        return 0
+
+
+def get_importer(args):
+    _importer = {}
+    _importer["import_compiler"] = importer_pick(args, args.warn_compiler)
+    _importer["import_coverage"] = importer_pick(args, args.coverage)
+    _importer["import_duplication"] = importer_pick(args, args.warn_duplication)
+    _importer["import_functional"] = importer_pick(args, args.warn_functional)
+    _importer["import_security"] = importer_pick(args, args.warn_standard)
+    _importer["import_standard"] = importer_pick(args, args.warn_security)
+    # sanity check
+    return {k: v for k, v in _importer.items() if v}
+
+
+def write_result(result, args):
+    if args.dump:
+        # Output
+        print(json.dumps(result, indent=2, sort_keys=True))
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            f.write(json.dumps(result, indent=2, sort_keys=True))
+
+
+def MergeArgParser(custom_args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="modernmetric merge",
+        description="Merge the partial results of 'modernmetric --shard K/N' runs\n"
+        "into the result of a single run",
+    )
+    parser.add_argument(
+        "--output_file", default=None, help="File to write the output to"
+    )
+    parser.add_argument(
+        "--dump", default=False, action="store_true", help="Print the output"
+    )
+    add_importer_args(parser)
+    parser.add_argument(
+        "partials", metavar="partial", nargs="+", help="Partial result files"
+    )
+    return parser.parse_args(custom_args)
+
+
+def merge_main(custom_args=None):
+    _args = MergeArgParser(custom_args)
+    try:
+        _partials = read_partials(_args.partials)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    # the metric options are the ones the partials were created with
+    for k, v in _partials[0]["partial"]["options"].items():
+        setattr(_args, k, v)
+    _importer = get_importer(_args)
+    if imports_hash(_importer) != _partials[0]["partial"]["imports"]:
+        # the overall section needs the imports the files were analysed with
+        print(
+            "The partials were created with other --warn_* or --coverage imports",
+            file=sys.stderr,
+        )
+        return 1
+
+    _overallMetrics = get_modules_metrics(_args, **_importer)
+    _files, _aggregates = merge_partials(_partials, _overallMetrics)
+    _result = finish_result(
+        {"files": _files, "overall": {}},
+        _args,
+        _importer,
+        _overallMetrics,
+        _aggregates,
+    )
+    write_result(_result, _args)
+
+
+def DiffArgParser(custom_args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="modernmetric diff",
+        description="Metrics of the files changed between two revisions of a git\n"
+        "repository, and how the change altered them",
+    )
+    parser.add_argument("base", help="Base revision, e.g. the target branch")
+    parser.add_argument(
+        "head", nargs="?", default="HEAD", help="Head revision (default: HEAD)"
+    )
+    parser.add_argument(
+        "--repo", default=".", help="Path to the git repository (default: .)"
+    )
+    parser.add_argument(
+        "--output_file",
+        default=None,
+        help="File to write the output to, it is printed otherwise",
+    )
+    parser.add_argument(
+        "--ignore_lexer_errors", default=True, help="Ignore unparseable files"
+    )
+    add_importer_args(parser)
+    add_cache_args(parser)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Disable result caching"
+    )
+    get_additional_parser_args(parser)
+    # the files are analysed, their tokens are never dumped
+    parser.set_defaults(dump=False)
+    return parser.parse_args(custom_args)
+
+
+def diff_main(custom_args=None):
+    _args = DiffArgParser(custom_args)
+    _importer = get_importer(_args)
+    try:
+        _repo = toplevel(_args.repo)
+        _revs = {x: resolve(_repo, getattr(_args, x)) for x in ("base", "head")}
+        _changed = changed_files(_repo, _revs["base"], _revs["head"])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    # versions of files don't change, results are cached by blob id
+    _cache = open_cache(_args, _importer, defer_writes=True)
+    _files = {}
+    _sides = {x: {"files": {}, "overall": {}} for x in ("base", "head")}
+    _metrics = {x: get_modules_metrics(_args, **_importer) for x in _sides}
+    _aggregates = {x: new_aggregates(_metrics[x]) for x in _sides}
+    try:
+        for idx, (status, path, *blobs) in enumerate(_changed, 1):
+            print(
+                f"\rModernMetric analyzing file {idx} of {len(_changed)}\r",
+                file=sys.stderr,
+                end="",
+            )
+            _entry = {"status": status}
+            for side, blob in zip(_sides, blobs):
+                _entry[side] = None
+                if blob is None:
+                    continue
+                res, _, _, _, store = process_revision_file(
+                    _repo, path, blob, _args, _importer, _cache
+                )
+                _entry[side] = res
+                _sides[side]["files"][path] = res
+                fold_aggregates(_metrics[side], _aggregates[side], store)
+            _entry["delta"] = metric_delta(_entry["base"], _entry["head"])
+            _files[path] = _entry
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        if _cache is not None:
+            _writer = CacheWriter(_cache)
+            write_cache_entries(_writer, _cache.take_pending())
+            write_cache_entries(_writer)
+            evict_cache(_cache, _args)
+            _cache.close()
+
+    _overall = {}
+    for side in _sides:
+        _overall[side] = finish_result(
+            _sides[side], _args, _importer, _metrics[side], _aggregates[side]
+        )["overall"]
+    _overall["delta"] = metric_delta(_overall["base"], _overall["head"])
+    _result = {"revisions": _revs, "files": _files, "overall": _overall}
+    if _args.output_file:
+        write_result(_result, _args)
+    else:
+        print(json.dumps(_result, indent=2, sort_keys=True))
+    return 0
+
+
+def HistoryArgParser(custom_args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="modernmetric history",
+        description="overall and stats sections of many commits of a git\n"
+        "repository, without checking them out",
+    )
+    parser.add_argument(
+        "rev", nargs="?", default="HEAD", help="Newest commit (default: HEAD)"
+    )
+    parser.add_argument(
+        "--repo", default=".", help="Path to the git repository (default: .)"
+    )
+    parser.add_argument(
+        "--max-count",
+        type=int,
+        default=100,
+        help="Number of commits, 0 for all (default: 100)",
+    )
+    parser.add_argument(
+        "--first-parent",
+        default=False,
+        action="store_true",
+        help="Only follow the first parent of merge commits",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Only analyse the files matching one of these patterns",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Don't analyse the files matching one of these patterns",
+    )
+    parser.add_argument(
+        "--output_file",
+        default=None,
+        help="File to write the output to, it is printed otherwise",
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="Run x jobs in parallel")
+    parser.add_argument(
+        "--ignore_lexer_errors", default=True, help="Ignore unparseable files"
+    )
+    add_cache_args(parser)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Disable result caching"
+    )
+    get_additional_parser_args(parser)
+    # the files are analysed, their tokens are never dumped
+    parser.set_defaults(dump=False)
+    return parser.parse_args(custom_args)
+
+
+def history_main(custom_args=None):
+    _args = HistoryArgParser(custom_args)
+    # findings of --warn_* files belong to the working tree, not to the
+    # history, so there are no imports
+    _cache = None
+    try:
+        _repo = toplevel(_args.repo)
+        _commits = commits(_repo, _args.rev, _args.max_count, _args.first_parent)
+        _cache = open_cache(_args, {}, defer_writes=True)
+        with CatFile(_repo) as cat:
+            _trees = [
+                (
+                    commit,
+                    time,
+                    select_files(cat.files(commit), _args.include, _args.exclude),
+                )
+                for commit, time in _commits
+            ]
+            _versions = version_results(_repo, cat, _trees, _args, _cache)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        if _cache is not None:
+            _writer = CacheWriter(_cache)
+            write_cache_entries(_writer, _cache.take_pending())
+            write_cache_entries(_writer)
+            evict_cache(_cache, _args)
+            _cache.close()
+
+    _history = []
+    for commit, time, files in _trees:
+        _metrics = get_modules_metrics(_args)
+        _aggregates = new_aggregates(_metrics)
+        _result = {"files": {}, "overall": {}}
+        for path, blob in files:
+            res, store = _versions[(os.path.basename(path), blob)]
+            _result["files"][path] = res
+            fold_aggregates(_metrics, _aggregates, store)
+        _result = finish_result(_result, _args, {}, _metrics, _aggregates)
+        _history.append(
+            {
+                "commit": commit,
+                "time": time,
+                "files": len(files),
+                "overall": _result["overall"],
+                "stats": _result["stats"],
+            }
+        )
+    _result = {"commits": _history}
+    if _args.output_file:
+        write_result(_result, _args)
+    else:
+        print(json.dumps(_result, indent=2, sort_keys=True))
+    return 0
+
+
+def CacheArgParser(custom_args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="modernmetric cache",
+        description="Maintain the result cache",
+    )
+    parser.add_argument(
+        "command",
+        choices=["stats", "prune", "vacuum", "verify", "export", "import"],
+        help="stats: print the size and content of the cache\n"
+        "prune: evict entries over the limits and forget deleted files\n"
+        "vacuum: give the space of evicted entries back to the file system\n"
+        "verify: check the database and its entries\n"
+        "export: write the cache, or the entries of the given files, to bundle\n"
+        "import: merge bundle into the cache",
+    )
+    parser.add_argument(
+        "bundle", nargs="?", default=None, help="Bundle file of export and import"
+    )
+    parser.add_argument(
+        "files",
+        metavar="file",
+        nargs="*",
+        help="Only export the entries of these files, analysed with the\n"
+        "given metric options and imports",
+    )
+    parser.add_argument(
+        "--file", type=str, help="Path to the JSON file list of file paths"
+    )
+    add_cache_args(parser)
+    add_importer_args(parser)
+    get_additional_parser_args(parser)
+    parser.add_argument(
+        "--ignore_lexer_errors", default=True, help="Ignore unparseable files"
+    )
+    parser.add_argument(
+        "--repair",
+        default=False,
+        action="store_true",
+        help="Drop the broken entries found by verify",
+    )
+    _args = parser.parse_args(custom_args)
+    if _args.command in ("export", "import") and not _args.bundle:
+        parser.error("{} needs a bundle file".format(_args.command))
+    if _args.file:
+        _args.files.extend(read_file_list(_args.file))
+    return _args
+
+
+def cache_main(custom_args=None):
+    _args = CacheArgParser(custom_args)
+    _cache = open_cache(_args, get_importer(_args))
+    try:
+        if _args.command == "stats":
+            print(json.dumps(_cache.stats(), indent=2, sort_keys=True))
+        elif _args.command == "prune":
+            print("Evicted {} entries".format(evict_cache(_cache, _args)))
+            print("Forgot {} deleted files".format(_cache.prune_stat_index()))
+        elif _args.command == "vacuum":
+            _before = _cache.stats()["file_bytes"]
+            _cache.vacuum()
+            print(
+                "Cache file shrunk from {} to {} bytes".format(
+                    _before, _cache.stats()["file_bytes"]
+                )
+            )
+        elif _args.command == "verify":
+            _problems = _cache.verify(repair=_args.repair)
+            for x in _problems:
+                print(x)
+            if _problems and not _args.repair:
+                return 1
+            print("Cache is fine" if not _problems else "Cache repaired")
+        elif _args.command == "export":
+            _keys = None
+            if _args.files:
+                _keys = []
+                for f, digest in _cache.digest_files(_args.files).items():
+                    _keys.append(_cache.key(f, digest))
+                    _tiers = tier_keys(_cache, f, digest)
+                    if _tiers is not None:
+                        _keys.append(_tiers[1])
+                        _keys.extend(_tiers[2].values())
+            _count = export_bundle(_cache, _args.bundle, _keys)
+            print("Exported {} entries to {}".format(_count, _args.bundle))
+        elif _args.command == "import":
+            try:
+                _count = import_bundle(_cache, _args.bundle)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 1
+            print("Imported {} new entries from {}".format(_count, _args.bundle))
+    finally:
+        _cache.close()
+    return 0
+
+
+def ServeArgParser(custom_args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog="modernmetric serve",
+        description="Keep modernmetric running with warm workers and answer the\n"
+        "requests of modernmetric-client on a Unix socket",
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help="Socket to listen on (default: $MODERNMETRIC_SOCKET or\n"
+        "{})".format(DEFAULT_SOCKET),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Workers of the pool, the --jobs of the requests is ignored",
+    )
+    return parser.parse_args(custom_args)
+
+
+# the first argument of main that runs another entry point
+SUBCOMMANDS = ("merge", "cache", "diff", "history", "serve")
+
+
+def serve_request(message):
+    """
+    Run modernmetric in the client's directory for a request of the
+    client, returning the exit status and what the run printed
+    """
+    _argv = message.get("argv") or []
+    _stdout = io.StringIO()
+    _stderr = io.StringIO()
+    _status = 0
+    _cwd = os.getcwd()
+    try:
+        os.chdir(message.get("cwd") or _cwd)
+        with redirect_stdout(_stdout), redirect_stderr(_stderr):
+            _unsupported = not _argv or _argv[0] == "serve"
+            if not _unsupported and _argv[0] not in SUBCOMMANDS:
+                # parsed, so abbreviations of the options are caught too.
+                # --watch never terminates and would block the daemon, the
+                # tokens of --dump are printed by the workers
+                _run = ArgParser(_argv)
+                _unsupported = _run.watch or _run.dump
+            if _unsupported:
+                raise ValueError(
+                    "Not supported by the daemon: {}".format(" ".join(_argv))
+                )
+            _status = main(_argv) or 0
+    except SystemExit as e:
+        # argument errors and --help
+        _status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception as e:
+        _stderr.write("{}\n".format(e))
+        _status = 1
+    finally:
+        os.chdir(_cwd)
+    return {
+        "status": _status,
+        "stdout": _stdout.getvalue(),
+        "stderr": _stderr.getvalue(),
+    }
+
+
+def serve_main(custom_args=None):
+    global _shared_pool
+    _args = ServeArgParser(custom_args)
+    _path = socket_path(_args.socket)
+    if os.path.exists(_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(_path)
+            except OSError:
+                # left behind by a daemon that was killed
+                os.unlink(_path)
+            else:
+                print(f"A daemon is listening on {_path} already", file=sys.stderr)
+                return 1
+    os.makedirs(os.path.dirname(_path), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(_path)
+    # requests run with the rights of the daemon, only its user may send them
+    os.chmod(_path, 0o600)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"ModernMetric listening on {_path}", file=sys.stderr)
+    try:
+        # one request at a time, they share the pool and the working directory
+        while True:
+            if _shared_pool is None:
+                _shared_pool = Pool(processes=_args.jobs)
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    message = receive_message(conn)
+                    if message.get("stop"):
+                        send_message(conn, {"status": 0, "stdout": "", "stderr": ""})
+                        break
+                    send_message(conn, serve_request(message))
+                except (OSError, ValueError) as e:
+                    print(f"Bad request: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(_path)
+        if _shared_pool is not None:
+            # let the workers exit on their own, so they close their caches
+            _shared_pool.close()
+            _shared_pool.join()
+            _shared_pool = None
+    return 0
+
+
+def write_watch_result(result, args):
+    """
+    Replace --output_file in one step, so a reader never sees a partly
+    written output, or print the result as a single line
+    """
+    if args.output_file:
+        _tmp = args.output_file + ".tmp"
+        with open(_tmp, "w") as f:
+            f.write(json.dumps(result, indent=2, sort_keys=True))
+        os.replace(_tmp, args.output_file)
+    else:
+        print(json.dumps(result, sort_keys=True), flush=True)
+
+
+def watch_main(args):
+    """
+    Analyse the files and directories of args.files, then keep the output
+    up to date as they change (--watch)
+    """
+    _importer = get_importer(args)
+    _metrics = get_modules_metrics(args, **_importer)
+    _aggregates = BucketAggregates(_metrics)
+    _stats = IncrementalStats()
+    _files = {}
+    # the output is written into the watched tree, maybe
+    _own = OwnFiles(
+        [args.output_file, args.output_file + ".tmp"] if args.output_file else [],
+        [sys.stdout, sys.stderr],
+    )
+    _cache = open_cache(args, _importer)
+    _writer = CacheWriter(_cache) if _cache is not None else None
+    pool = Pool(
+        processes=args.jobs,
+        initializer=init_worker,
+        initargs=(args, _importer, True),
+    )
+
+    def analyse(files):
+        hits, misses = prefetch_cached(files, args, _cache)
+        results = list(hits)
+        async_results = [
+            pool.apply_async(process_batch, args=(batch, args, _importer))
+            for batch in get_batches(misses, args)
+        ]
+        for async_result in async_results:
+            file_results, _, pending, _, _, _ = async_result.get()
+            if _writer is not None:
+                write_cache_entries(_writer, pending)
+            results.extend(file_results)
+        if _writer is not None:
+            write_cache_entries(_writer)
+        return results
+
+    def update(changes):
+        if changes is None:
+            present = scan_files(args.files, _own)
+            gone = sorted(set(_files) - set(present))
+        else:
+            present, gone = touched_files(changes, _files, args.files, _own)
+            if not present and not gone:
+                return
+        for f in gone:
+            _stats.remove(_files.pop(f))
+            _aggregates.remove(f)
+        for res, f, _, _, store in analyse(present):
+            if f in _files:
+                _stats.remove(_files[f])
+            _files[f] = res
+            _stats.add(res)
+            _aggregates.set(f, store)
+        _result = {
+            "files": dict(_files),
+            "overall": overall_section(args, _importer, _metrics, _aggregates.total()),
+        }
+        _result["stats"] = _stats.results(_result["overall"])
+        write_watch_result(_result, args)
+        print(
+            f"\rModernMetric analysed {len(present)} files, {len(gone)} removed",
+            file=sys.stderr,
+        )
+
+    # watching starts first, changes during the first run aren't missed
+    _watcher = open_watcher(args.files, args.poll_interval, _own)
+    try:
+        update(None)
+        watch_loop(_watcher, update, args.debounce)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _watcher.close()
+        pool.terminate()
+        pool.join()
+        if _cache is not None:
+            evict_cache(_cache, args)
+            _cache.close()
+    return 0
 
 
 # custom_args is an optional list of strings args,
@@ -173,77 +1128,222 @@ def main(custom_args=None, license_identifier: Union[int, str, None] = None):
 
     if license_identifier:
         report(identifier=license_identifier, product="modernmetric")
+    _argv = custom_args if custom_args else sys.argv[1:]
+    if _argv and _argv[0] == "merge":
+        return merge_main(_argv[1:])
+    if _argv and _argv[0] == "cache":
+        return cache_main(_argv[1:])
+    if _argv and _argv[0] == "diff":
+        return diff_main(_argv[1:])
+    if _argv and _argv[0] == "history":
+        return history_main(_argv[1:])
+    if _argv and _argv[0] == "serve":
+        return serve_main(_argv[1:])
     if custom_args:
         _args = ArgParser(custom_args)
     else:
         _args = ArgParser()
+    if _args.watch:
+        return watch_main(_args)
     _result = {"files": {}, "overall": {}}
+    _stores = []
+    if _args.shard:
+        _args.files = select_shard(_args.files, *_args.shard)
 
     # Get importer
-    _importer = {}
-    _importer["import_compiler"] = importer_pick(_args, _args.warn_compiler)
-    _importer["import_coverage"] = importer_pick(_args, _args.coverage)
-    _importer["import_duplication"] = importer_pick(_args, _args.warn_duplication)
-    _importer["import_functional"] = importer_pick(_args, _args.warn_functional)
-    _importer["import_security"] = importer_pick(_args, _args.warn_standard)
-    _importer["import_standard"] = importer_pick(_args, _args.warn_security)
-    # sanity check
-    _importer = {k: v for k, v in _importer.items() if v}
+    _importer = get_importer(_args)
 
     # instance metric modules
     _overallMetrics = get_modules_metrics(_args, **_importer)
-    _overallCalc = get_modules_calculated(_args, **_importer)
 
-    stores = []
-    # process_file_fn = partial(process_file, args=_args, importer=_importer)
+    _aggregates = new_aggregates(_overallMetrics)
 
     file_count = 1
-    total_files = len(_args.files)
+    _archives = _args.archive or _args.git_tree
+    # the number of archive members is only known once they are read
+    total_files = "?" if _archives else len(_args.files)
 
     timeout_seconds = _args.file_timeout
 
-    def get_file_result(async_result, idx, total_files, timeout_seconds):
+    def add_file_result(file_result):
+        nonlocal file_count
+        _result["files"][file_result[RES_KEY_FILE]] = file_result[RES_KEY_RES]
+        if _args.shard or _args.with_stores:
+            _stores.append([file_result[RES_KEY_FILE], file_result[RES_KEY_STORE]])
+        print(
+            f"\rModernMetric analyzing file {file_count} of {total_files}\r",
+            file=sys.stderr,
+            end="",
+        )
+        file_count += 1
+
+    _io_reads = Counter()
+    _io_bytes = Counter()
+
+    _fingerprint = analyser_fingerprint(_args, _importer)
+    if _args.incremental:
         try:
-            return async_result.get(timeout=timeout_seconds)
-        except TimeoutError:
-            print(f"\rTimeout processing file {idx} of {total_files}", file=sys.stderr)
-            return None
+            _previous = read_previous(_args.incremental, _fingerprint)
+        except (OSError, ValueError) as e:
+            print(e, file=sys.stderr)
+            return 1
 
-    with Pool(processes=_args.jobs) as pool:
-        async_results = [
-            pool.apply_async(process_file, args=(file, _args, _importer))
-            for file in _args.files
-        ]
+    # --dump prints the tokens as they are lexed, it has to analyse every file
+    _cache = None if _args.dump else open_cache(_args, _importer)
+    _writer = CacheWriter(_cache) if _cache is not None else None
 
-        for idx, async_result in enumerate(async_results, start=1):
-            file_result = get_file_result(
-                async_result, idx, total_files, timeout_seconds
-            )
-            if file_result is None:
-                continue
-            stores.append(file_result[RES_KEY_STORE])
-            _result["files"][file_result[RES_KEY_FILE]] = file_result[RES_KEY_RES]
-            print(
-                f"\rModernMetric analyzing file {file_count} of {total_files}\r",
-                file=sys.stderr,
-                end="",
+    _digests = {}
+    _files = _args.files
+    if _args.incremental:
+        # unchanged files keep the result and store of the previous run
+        _digests = file_digests(_files, _cache)
+        unchanged, changed = split_unchanged(_files, _digests, _previous)
+        for f, res, store in unchanged:
+            fold_aggregates(_overallMetrics, _aggregates, store)
+            add_file_result((res, f, None, [], store))
+        _files = [f for f, _ in changed]
+
+    # only the files missing in the cache are sent to the workers
+    hits, misses = prefetch_cached(_files, _args, _cache)
+    misses = [(f, digest or _digests.get(f)) for f, digest in misses]
+    _digests.update(take_content_digests())
+    for file_result in hits:
+        fold_aggregates(_overallMetrics, _aggregates, file_result[RES_KEY_STORE])
+        add_file_result(file_result)
+    sys.stderr.flush()
+
+    def analyse_batches(batches):
+        global _shared_pool
+        shared = _shared_pool is not None
+        if shared:
+            # the warm workers of the daemon, see serve_main
+            pool = _shared_pool
+            request = (os.getcwd(), worker_cache_key(_args, _importer))
+        else:
+            pool = None
+            request = None
+
+        def new_pool():
+            return Pool(
+                processes=_args.jobs,
+                initializer=init_worker,
+                initargs=(_args, _importer, True),
             )
-            file_count += 1
+
+        def collect(batch_result):
+            file_results, partial, pending, io, digests, output = batch_result
+            # what the workers of the daemon printed, for the client
+            sys.stdout.write(output[0])
+            sys.stderr.write(output[1])
+            fold_aggregates(_overallMetrics, _aggregates, partial)
+            _digests.update(digests)
+            _io_reads.update(io[0])
+            _io_bytes.update(io[1])
+            if _writer is not None:
+                write_cache_entries(_writer, pending)
+            for file_result in file_results:
+                add_file_result(file_result)
             sys.stderr.flush()
 
-    for y in _overallMetrics:
-        _result["overall"].update(y.get_results_global([x for x in stores]))
-    for y in _overallCalc:
-        _result["overall"].update(y.get_results(_result["overall"]))
-    for m in get_modules_stats(_args, **_importer):
-        _result = m.get_results(_result, "files", "overall")
-    if _args.dump:
-        # Output
-        print(json.dumps(_result, indent=2, sort_keys=True))
-    if _args.output_file:
-        with open(_args.output_file, "w") as f:
-            f.write(json.dumps(_result, indent=2, sort_keys=True))
+        if pool is None:
+            pool = new_pool()
+        # batches of archive members hold their contents, only a few of them
+        # per worker are submitted ahead
+        _ahead = _args.jobs * 4 if _archives else math.inf
+        # batches to submit before the next ones of batches
+        retry = deque()
+        batches = iter(batches)
+        submitted = deque()
+        try:
+            while True:
+                while len(submitted) <= _ahead:
+                    batch = retry.popleft() if retry else next(batches, None)
+                    if batch is None:
+                        break
+                    submitted.append(
+                        (
+                            batch,
+                            pool.apply_async(
+                                process_batch, args=(batch, _args, _importer, request)
+                            ),
+                        )
+                    )
+                if not submitted:
+                    break
+                batch, async_result = submitted.popleft()
+                try:
+                    batch_result = async_result.get(
+                        timeout=timeout_seconds * len(batch)
+                    )
+                except TimeoutError:
+                    # the worker hangs on one of the files, the pool is
+                    # replaced and the batches that didn't finish are sent
+                    # again, the files of this one one at a time, so only the
+                    # file that hangs is lost
+                    pool.terminate()
+                    pool.join()
+                    if shared:
+                        # the daemon starts a new pool for the next request
+                        _shared_pool = None
+                        shared = False
+                        request = None
+                    pool = new_pool()
+                    if len(batch) == 1:
+                        print(
+                            f"\rTimeout processing file {batch[0][0]}",
+                            file=sys.stderr,
+                        )
+                    else:
+                        retry.extend([x] for x in batch)
+                    retry.extend(x for x, _ in submitted)
+                    submitted.clear()
+                    continue
+                collect(batch_result)
+        except BaseException:
+            pool.terminate()
+            pool.join()
+            if shared:
+                _shared_pool = None
+            raise
+        if not shared:
+            # let the workers exit on their own, so they close their caches
+            pool.close()
+            pool.join()
+
+    _failed = False
+    if misses:
+        analyse_batches(get_batches(misses, _args))
+    if _archives:
+        try:
+            analyse_batches(
+                member_batches(
+                    input_members(_args.archive, _args.git_tree, _args.repo),
+                    _args.batch_size if _args.batch_size > 0 else MAX_AUTO_BATCH_SIZE,
+                    (lambda x: in_shard(x, *_args.shard)) if _args.shard else None,
+                )
+            )
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            _failed = True
+    if _cache is not None:
+        write_cache_entries(_writer)
+        evict_cache(_cache, _args)
+    if _cache is not None:
+        _cache.close()
+    if _args.io_stats:
+        report_io_stats(_io_reads, _io_bytes)
+    if _failed:
+        return 1
+
+    if _args.shard:
+        # overall and stats are computed by 'modernmetric merge'
+        write_result(partial_result(_args, _result["files"], _stores, _importer), _args)
+        return
+    _result = finish_result(_result, _args, _importer, _overallMetrics, _aggregates)
+    if _args.with_stores:
+        _result["incremental"] = incremental_section(_fingerprint, _digests, _stores)
+    write_result(_result, _args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
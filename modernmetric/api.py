@@ -0,0 +1,80 @@
+"""
+Metrics of contents held in memory, e.g. the unsaved buffers of an editor.
+
+Nothing is read from disk and everything runs in the calling process.
+Contents passed as str are lexed as they are, bytes are decoded as UTF-8
+and only go through the encoding detection if that fails. Lexers are
+looked up once per file name and kept for later calls.
+
+    >>> from modernmetric import Analyser
+    >>> analyser = Analyser(["--maintindex", "classic"])
+    >>> result = analyser.analyse([("buffer.py", "def f(x):\\n    return x\\n")])
+    >>> result["files"]["buffer.py"]["loc"]
+    2
+"""
+
+import argparse
+
+from pygments.util import ClassNotFound
+
+from modernmetric.cls.modules import finish_result, fold_aggregates
+from modernmetric.cls.modules import get_additional_parser_args
+from modernmetric.cls.modules import get_modules_metrics, new_aggregates
+from modernmetric.fp import decode_content, lexer_for_filename, process_tokens
+
+
+def decode_buffer(content):
+    """
+    str of a buffer, the encoding is only detected if it isn't UTF-8
+    """
+    if isinstance(content, str):
+        return content
+    try:
+        return content.decode("utf-8")
+    except UnicodeDecodeError:
+        return decode_content(content)
+
+
+class Analyser:
+    """
+    Analyse batches of (file name, content) pairs. options are the metric
+    options of the command line, e.g. ["--approx"].
+    """
+
+    def __init__(self, options=None, ignore_lexer_errors=True):
+        parser = argparse.ArgumentParser(prog="modernmetric", add_help=False)
+        get_additional_parser_args(parser)
+        self._args = parser.parse_args(options or [])
+        self._args.ignore_lexer_errors = ignore_lexer_errors
+        self._args.dump = False
+
+    def analyse_file(self, name, content):
+        """
+        (res, store) of a single buffer, the file name picks the lexer. Both
+        are empty for files without lexer, unless ignore_lexer_errors is
+        False, then ClassNotFound is raised.
+        """
+        try:
+            _lexer = lexer_for_filename(name)
+        except ClassNotFound:
+            if self._args.ignore_lexer_errors:
+                return {}, {}
+            raise
+        _content = decode_buffer(content)
+        if not _content:
+            return {}, {}
+        return process_tokens(_lexer.name, _lexer.get_tokens(_content), self._args, {})
+
+    def analyse(self, contents):
+        """
+        Result of a batch of (file name, str or bytes content) pairs, with
+        the files, overall and stats sections of the command line output
+        """
+        _metrics = get_modules_metrics(self._args)
+        _aggregates = new_aggregates(_metrics)
+        result = {"files": {}, "overall": {}}
+        for name, content in contents:
+            res, store = self.analyse_file(name, content)
+            result["files"][name] = res
+            fold_aggregates(_metrics, _aggregates, store)
+        return finish_result(result, self._args, {}, _metrics, _aggregates)
@@ -0,0 +1,86 @@
+"""
+Members of tarballs, zip archives and git trees (--archive, --git-tree),
+read one after the other without extracting them. Their contents go
+through file_process like files on disk, keyed by the member name.
+"""
+
+import sys
+import tarfile
+import zipfile
+
+import modernmetric.config as config
+from modernmetric.git import CatFile, resolve
+
+
+def skip_member(name, size):
+    """
+    Members over the file size limit are not read at all
+    """
+    if size > config.MAX_FILE_SIZE:
+        print("Skipping {}: file too large".format(name), file=sys.stderr)
+        return True
+    return False
+
+
+def archive_members(path):
+    """
+    (member name, content) of the regular files of a tar (optionally
+    gzip, bzip2 or xz compressed) or zip archive, in archive order.
+    Tarballs are read as a stream, a compressed one is decompressed once.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or skip_member(info.filename, info.file_size):
+                    continue
+                with archive.open(info) as i:
+                    yield info.filename, i.read()
+        return
+    try:
+        archive = tarfile.open(path, "r|*")
+    except tarfile.TarError as e:
+        raise ValueError("{} is no tar or zip archive: {}".format(path, e))
+    with archive:
+        for info in archive:
+            if not info.isfile() or skip_member(info.name, info.size):
+                continue
+            yield info.name, archive.extractfile(info).read()
+
+
+def tree_members(repo, rev):
+    """
+    (path, content) of the regular files of the tree of a commit, read
+    through a single 'git cat-file --batch' process
+    """
+    with CatFile(repo) as cat:
+        for path, blob in cat.files(resolve(repo, rev)):
+            _content = cat.read(blob)[1]
+            if not skip_member(path, len(_content)):
+                yield path, _content
+
+
+def input_members(archives, trees, repo):
+    """
+    (member name, content) of all --archive and --git-tree inputs
+    """
+    for path in archives or ():
+        yield from archive_members(path)
+    for rev in trees or ():
+        yield from tree_members(repo, rev)
+
+
+def member_batches(members, size, keep=None):
+    """
+    Lists of up to size (member name, None, content) tasks for
+    process_batch, of the members for which keep (if given) is true
+    """
+    batch = []
+    for name, content in members:
+        if keep is not None and not keep(name):
+            continue
+        batch.append((name, None, content))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,807 @@
+"""
+Result cache.
+
+Entries are addressed by the hash of a file's content plus a fingerprint of
+everything else that goes into its results: the modernmetric sources, the
+versions of the libraries used for decoding and lexing, the metric options
+and the contents of the --warn_* / --coverage imports.
+
+Below these per file results ("file" tier) are two tiers that outlive most
+changes of modernmetric itself: the lexed tokens of a file ("tokens" tier,
+keyed by content, lexer and library versions) and the results of each
+metric module ("metric" tier, keyed by the tokens and the sources of the
+module). A changed metric only runs that metric again over the cached
+tokens, without reading, decoding or lexing the file.
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from pathlib import Path
+
+import chardet
+import pygments
+from pygments.token import string_to_tokentype
+
+SCHEMA_VERSION = 4
+# version of the token encoding and of the decoding that precedes lexing,
+# see pack_tokens
+TOKENS_FORMAT = 2
+
+TIER_FILE = "file"
+TIER_TOKENS = "tokens"
+TIER_METRIC = "metric"
+# the members every entry of a tier has
+TIER_FIELDS = {
+    TIER_FILE: ("res", "lexer_name", "store"),
+    TIER_TOKENS: ("types", "stream"),
+    TIER_METRIC: ("res", "store"),
+}
+# sources, besides its own module, the results of a metric module depend on
+METRIC_SOURCES = [
+    "cls/base.py",
+    "cls/dispatch.py",
+    "cls/sketch.py",
+    "cls/symbols.py",
+    "cls/tokenclass.py",
+]
+
+# options that change the per file results or stores
+FINGERPRINT_OPTIONS = [
+    "halstead_bug_predict_method",
+    "maintenance_index_calc_method",
+    "approx_global_metrics",
+    "approx_precision",
+    "ignore_lexer_errors",
+]
+
+READ_SIZE = 1024 * 1024
+# keys per SELECT of get_many, below SQLite's host parameter limit
+LOOKUP_BATCH = 500
+# entries per transaction of the parent process writer
+WRITE_BATCH = 2000
+# a file modified less than this after its stat index entry was taken could
+# have changed within the same timestamp tick, its content is hashed again
+RACY_WINDOW_NS = 2 * 10**9
+
+# version of the bundle file format, see export_bundle
+BUNDLE_FORMAT = 1
+BUNDLE_MAGIC = "modernmetric-cache-bundle"
+
+# defaults of --cache-max-size (MB) and --cache-max-age (days)
+DEFAULT_MAX_SIZE_MB = 1024
+DEFAULT_MAX_AGE_DAYS = 90
+# a cache over its size limit is shrunk to this share of the limit, so the
+# following runs don't have to evict again right away
+EVICT_TARGET = 0.9
+
+_tool_version = None
+_tokens_version = None
+_metric_versions = {}
+
+
+def _hash(*parts):
+    _h = hashlib.blake2b(digest_size=16)
+    for x in parts:
+        _h.update(x.encode("utf-8", "surrogatepass"))
+        _h.update(b"\0")
+    return _h.hexdigest()
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path):
+    _h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as i:
+        for chunk in iter(lambda: i.read(READ_SIZE), b""):
+            _h.update(chunk)
+    return _h.hexdigest()
+
+
+def _distribution_version(name):
+    try:
+        from importlib.metadata import version
+
+        return version(name)
+    except Exception:
+        return "unknown"
+
+
+def _source_hashes(paths):
+    _package = Path(__file__).parent
+    return [
+        "{}:{}".format(x.relative_to(_package).as_posix(), file_hash(x)) for x in paths
+    ]
+
+
+def tool_version():
+    """
+    Hash of the modernmetric sources and of the versions of the libraries
+    the results depend on, any change invalidates all "file" tier entries
+    """
+    global _tool_version
+    if _tool_version is None:
+        _tool_version = _hash(
+            str(SCHEMA_VERSION),
+            pygments.__version__,
+            _distribution_version("pygments-tsx"),
+            chardet.__version__,
+            *_source_hashes(sorted(Path(__file__).parent.rglob("*.py"))),
+        )
+    return _tool_version
+
+
+def tokens_version():
+    """
+    Hash of the versions of the libraries used for decoding and lexing
+    """
+    global _tokens_version
+    if _tokens_version is None:
+        _tokens_version = _hash(
+            str(TOKENS_FORMAT),
+            pygments.__version__,
+            _distribution_version("pygments-tsx"),
+            chardet.__version__,
+        )
+    return _tokens_version
+
+
+def metric_version(metric_class):
+    """
+    Hash of the sources of a metric module, and of what it builds on
+    """
+    _name = metric_class.__name__
+    if _name not in _metric_versions:
+        _package = Path(__file__).parent
+        _module = Path(sys.modules[metric_class.__module__].__file__)
+        _metric_versions[_name] = _hash(
+            _name,
+            _distribution_version("pygount"),
+            *_source_hashes([_module] + [_package / x for x in METRIC_SOURCES]),
+        )
+    return _metric_versions[_name]
+
+
+def pack_tokens(tokens):
+    """
+    Compact encoding of a token stream for the "tokens" tier: the token
+    types are numbered, the values joined to one text plus their lengths.
+    Numbers, lengths and text are zlib compressed, as base64 to keep the
+    entry JSON.
+    """
+    _types = {}
+    _kinds = []
+    _lengths = []
+    for token_type, value in tokens:
+        _kinds.append(_types.setdefault(token_type, len(_types)))
+        _lengths.append(len(value))
+    _stream = json.dumps(
+        [_kinds, _lengths, "".join(x for _, x in tokens)], separators=(",", ":")
+    )
+    return {
+        "types": [str(x) for x in _types],
+        "stream": base64.b64encode(zlib.compress(_stream.encode("utf-8"))).decode(
+            "ascii"
+        ),
+    }
+
+
+def unpack_tokens(packed):
+    """
+    The token stream encoded by pack_tokens
+    """
+    _types = [string_to_tokentype(x) for x in packed["types"]]
+    _kinds, _lengths, _text = json.loads(
+        zlib.decompress(base64.b64decode(packed["stream"]))
+    )
+    res = []
+    _pos = 0
+    for kind, length in zip(_kinds, _lengths):
+        res.append((_types[kind], _text[_pos : _pos + length]))
+        _pos += length
+    return res
+
+
+def analyser_fingerprint(args, importer):
+    """
+    Hash of the tool version, the metric options and the imported findings
+    """
+    _options = {x: getattr(args, x, None) for x in FINGERPRINT_OPTIONS}
+    _imports = {k: v.getItems() for k, v in sorted(importer.items())}
+    return _hash(
+        tool_version(),
+        json.dumps(_options, sort_keys=True),
+        json.dumps(_imports, sort_keys=True, default=str),
+    )
+
+
+def imports_hash(importer):
+    """
+    Hash of the imported findings, by importer
+    """
+    _imports = {k: v.getItems() for k, v in sorted(importer.items())}
+    return _hash(json.dumps(_imports, sort_keys=True, default=str))
+
+
+class ResultCache:
+    """
+    SQLite backed mapping of cache keys to per file results
+    """
+
+    def __init__(self, path, args, importer, defer_writes=False):
+        self.path = Path(path)
+        # with defer_writes, set only queues the entries, a single writer
+        # (the parent process) stores them with set_many
+        self.defer_writes = defer_writes
+        self._pending = []
+        self._pending_stats = []
+        self._touched = []
+        self.tool = tool_version()
+        self.fingerprint = analyser_fingerprint(args, importer)
+        # metric modules get the options, but not the imports
+        self._options = json.dumps(
+            {x: getattr(args, x, None) for x in FINGERPRINT_OPTIONS}, sort_keys=True
+        )
+        # imported findings are matched by path, so with imports the
+        # results of equal files at different locations can differ
+        self._by_path = bool(importer)
+        self.db = sqlite3.connect(str(self.path), timeout=60)
+        self._setup()
+
+    def _setup(self):
+        # readers (the workers) don't block the writer and vice versa
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            # the table of the former cachehash based cache held token lists
+            self.db.execute("DROP TABLE IF EXISTS modernmetric")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS meta "
+                "(name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            _meta = dict(self.db.execute("SELECT name, value FROM meta"))
+            if _meta.get("schema") != str(SCHEMA_VERSION):
+                self.db.execute("DROP TABLE IF EXISTS results")
+            # atime is the last time (in seconds) an entry was written or hit,
+            # size the length of its value, both for evict
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, tool TEXT NOT NULL, tier TEXT NOT NULL, "
+                "value TEXT NOT NULL, reason TEXT, size INTEGER NOT NULL, "
+                "atime INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS results_atime ON results (atime)"
+            )
+            # path -> (size, mtime_ns, inode, content hash) of the last time
+            # a file was hashed, like the git index
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS stat_index "
+                "(path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, "
+                "hash TEXT NOT NULL, checked_ns INTEGER NOT NULL) "
+                "WITHOUT ROWID"
+            )
+            if _meta.get("tool") != self.tool:
+                # modernmetric or a library changed, no per file result is
+                # valid. The other tiers have their own versions in their
+                # keys, outdated entries of them are left to evict.
+                self.db.execute(
+                    "DELETE FROM results WHERE tier = ? AND tool != ?",
+                    (TIER_FILE, self.tool),
+                )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                [("schema", str(SCHEMA_VERSION)), ("tool", self.tool)],
+            )
+
+    def key(self, path, digest):
+        """
+        Cache key of a file with content hash digest. The file name is part
+        of the key as the lexer is picked by it.
+        """
+        _path = os.path.abspath(path)
+        return _hash(
+            self.fingerprint,
+            digest,
+            os.path.basename(_path),
+            _path if self._by_path else "",
+        )
+
+    def tokens_key(self, digest, lexer_name):
+        """
+        Key of the "tokens" tier entry of a file with content hash digest
+        """
+        return _hash(TIER_TOKENS, tokens_version(), digest, lexer_name)
+
+    def metric_key(self, tokens_key, metric_class):
+        """
+        Key of the "metric" tier entry of a metric module for the tokens
+        of tokens_key
+        """
+        return _hash(
+            TIER_METRIC, metric_version(metric_class), self._options, tokens_key
+        )
+
+    def get(self, key):
+        _row = self.db.execute(
+            "SELECT value FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if _row is None:
+            return None
+        self._touched.append(key)
+        return json.loads(_row[0])
+
+    def _select_many(self, query, keys):
+        for i in range(0, len(keys), LOOKUP_BATCH):
+            _keys = keys[i : i + LOOKUP_BATCH]
+            yield from self.db.execute(query.format(",".join("?" * len(_keys))), _keys)
+
+    def get_many(self, keys):
+        """
+        Mapping of the keys found in the cache to their values
+        """
+        res = {
+            key: json.loads(value)
+            for key, value in self._select_many(
+                "SELECT key, value FROM results WHERE key IN ({})", keys
+            )
+        }
+        self._touched.extend(res)
+        return res
+
+    def _stat_rows(self, paths):
+        return {
+            x[0]: x
+            for x in self._select_many(
+                "SELECT path, size, mtime_ns, inode, hash, checked_ns "
+                "FROM stat_index WHERE path IN ({})",
+                [os.path.abspath(x) for x in paths],
+            )
+        }
+
+    def indexed_digests(self, paths):
+        """
+        Content hashes of the paths that are unchanged according to the stat
+        index, found without reading the files. Paths that have to be hashed
+        are missing in the result.
+        """
+        _index = self._stat_rows(paths)
+        res = {}
+        for path in paths:
+            _row = _index.get(os.path.abspath(path))
+            if _row is None:
+                continue
+            try:
+                _stat = os.stat(path)
+            except OSError:
+                continue
+            if is_stat_clean(_row, _stat):
+                res[path] = _row[4]
+        return res
+
+    def indexed_digest(self, path, stat):
+        """
+        indexed_digests of a single file, stat is its current os.stat
+        """
+        _row = self._stat_rows([path]).get(os.path.abspath(path))
+        if _row is not None and is_stat_clean(_row, stat):
+            return _row[4]
+        return None
+
+    def record_digest(self, path, stat, digest, checked_ns):
+        """
+        Enter a file hashed to digest into the stat index, stat has to be
+        taken before the file was read, at checked_ns
+        """
+        self._pending_stats.append(
+            stat_row(os.path.abspath(path), stat, digest, checked_ns)
+        )
+        if not self.defer_writes:
+            self.set_many([], self._pending_stats)
+            self._pending_stats = []
+
+    def is_empty(self):
+        return self.db.execute("SELECT 1 FROM results LIMIT 1").fetchone() is None
+
+    def set(self, key, value, tier=TIER_FILE):
+        _entry = (
+            key,
+            json.dumps(value, separators=(",", ":")),
+            value.get("reason") if tier == TIER_FILE else None,
+            tier,
+        )
+        if self.defer_writes:
+            self._pending.append(_entry)
+        else:
+            self.set_many([_entry])
+
+    def take_pending(self):
+        """
+        Returns and forgets the (key, encoded value, reason, tier) entries
+        queued by set, the queued stat index rows and the keys of the cache hits
+        """
+        res = (self._pending, self._pending_stats, self._touched)
+        self._pending = []
+        self._pending_stats = []
+        self._touched = []
+        return res
+
+    def set_many(self, entries, stats=(), touched=()):
+        """
+        Store (key, encoded value, reason, tier) entries and stat index rows
+        and renew the access time of the touched keys in a single transaction
+        """
+        _now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO results "
+                "(key, tool, tier, value, reason, size, atime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (key, self.tool, tier, value, reason, len(value), _now)
+                    for key, value, reason, tier in entries
+                ),
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO stat_index "
+                "(path, size, mtime_ns, inode, hash, checked_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                stats,
+            )
+            for i in range(0, len(touched), LOOKUP_BATCH):
+                _keys = touched[i : i + LOOKUP_BATCH]
+                self.db.execute(
+                    "UPDATE results SET atime = ? WHERE key IN ({})".format(
+                        ",".join("?" * len(_keys))
+                    ),
+                    [_now] + list(_keys),
+                )
+
+    def flush(self):
+        """
+        Write what is still queued, the access times of the hits mostly
+        """
+        if not self.defer_writes:
+            self.set_many(*self.take_pending())
+
+    def used_bytes(self):
+        """
+        Size of the database without its free pages, cheap to get
+        """
+        _page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        _pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        _free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (_pages - _free) * _page_size
+
+    def evict(self, max_bytes=None, max_age=None):
+        """
+        Drop the entries not used for more than max_age seconds, then the
+        least recently used ones until the database is below max_bytes.
+        Returns the number of entries dropped.
+        """
+        res = 0
+        with self.db:
+            if max_age:
+                res += self.db.execute(
+                    "DELETE FROM results WHERE atime < ?",
+                    (int(time.time() - max_age),),
+                ).rowcount
+        if max_bytes:
+            _used = self.used_bytes()
+            _excess = _used - int(max_bytes * EVICT_TARGET)
+            if _used > max_bytes and _excess > 0:
+                # the space of an entry in the database (key, index, page
+                # overhead) is estimated by the average
+                _count = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+                _drop = math.ceil(_excess * _count / float(_used))
+                with self.db:
+                    res += self.db.execute(
+                        "DELETE FROM results WHERE key IN "
+                        "(SELECT key FROM results ORDER BY atime LIMIT ?)",
+                        (_drop,),
+                    ).rowcount
+        return res
+
+    def prune_stat_index(self):
+        """
+        Drop the stat index rows of files that don't exist anymore
+        """
+        _gone = [
+            (path,)
+            for (path,) in self.db.execute("SELECT path FROM stat_index")
+            if not os.path.exists(path)
+        ]
+        with self.db:
+            self.db.executemany("DELETE FROM stat_index WHERE path = ?", _gone)
+        return len(_gone)
+
+    def stats(self):
+        _entries = {}
+        for tier, reason, count, size in self.db.execute(
+            "SELECT tier, reason, COUNT(*), SUM(size) FROM results "
+            "GROUP BY tier, reason"
+        ):
+            if tier == TIER_FILE:
+                tier = reason or "results"
+            _entries[tier] = {"count": count, "bytes": size}
+        _oldest, _newest = self.db.execute(
+            "SELECT MIN(atime), MAX(atime) FROM results"
+        ).fetchone()
+        return {
+            "path": str(self.path),
+            "file_bytes": os.path.getsize(self.path),
+            "used_bytes": self.used_bytes(),
+            "entries": _entries,
+            "stat_index": self.db.execute("SELECT COUNT(*) FROM stat_index").fetchone()[
+                0
+            ],
+            "oldest_access": _oldest,
+            "newest_access": _newest,
+        }
+
+    def vacuum(self):
+        """
+        Give the space of dropped entries back to the file system
+        """
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.db.execute("VACUUM")
+
+    def verify(self, repair=False):
+        """
+        Check the database and its entries, returns a list of problems.
+        With repair, unreadable entries are dropped.
+        """
+        res = [
+            "integrity: {}".format(x)
+            for (x,) in self.db.execute("PRAGMA quick_check")
+            if x != "ok"
+        ]
+        _incomplete = " OR ".join(
+            "(tier = '{}' AND ({}))".format(
+                tier,
+                " OR ".join(
+                    "json_type(value, '$.{}') IS NULL".format(x) for x in fields
+                ),
+            )
+            for tier, fields in TIER_FIELDS.items()
+        )
+        try:
+            # checked by SQLite's JSON functions, much faster than json.loads
+            _bad = [
+                (key, "broken entry")
+                for (key,) in self.db.execute(
+                    "SELECT key FROM results WHERE NOT json_valid(value) "
+                    "OR tier NOT IN ({}) OR {}".format(
+                        ",".join("'{}'".format(x) for x in TIER_FIELDS), _incomplete
+                    )
+                )
+            ]
+        except sqlite3.OperationalError:
+            # SQLite without JSON support
+            _bad = []
+            for key, tier, value in self.db.execute(
+                "SELECT key, tier, value FROM results"
+            ):
+                try:
+                    if tier not in TIER_FIELDS:
+                        raise ValueError("unknown tier {}".format(tier))
+                    if not set(TIER_FIELDS[tier]) <= set(json.loads(value)):
+                        raise ValueError("incomplete entry")
+                except ValueError as e:
+                    _bad.append((key, str(e)))
+        res += ["entry {}: {}".format(key, e) for key, e in _bad]
+        if repair and _bad:
+            with self.db:
+                self.db.executemany(
+                    "DELETE FROM results WHERE key = ?", [(x,) for x, _ in _bad]
+                )
+        return res
+
+    def digest_files(self, paths):
+        """
+        Content hashes of paths, from the stat index or by reading the file.
+        Files that can't be read are left out.
+        """
+        res = self.indexed_digests(paths)
+        for path in paths:
+            if path not in res:
+                try:
+                    res[path] = file_hash(path)
+                except OSError:
+                    pass
+        return res
+
+    def entries(self, keys=None):
+        """
+        (key, encoded value, reason, tier) of all entries or of the given
+        keys, ordered by key
+        """
+        if keys is None:
+            return self.db.execute(
+                "SELECT key, value, reason, tier FROM results ORDER BY key"
+            ).fetchall()
+        return sorted(
+            self._select_many(
+                "SELECT key, value, reason, tier FROM results WHERE key IN ({})", keys
+            )
+        )
+
+    def add_entries(self, entries):
+        """
+        Merge (key, encoded value, reason, tier) entries, existing ones are
+        kept. Runs in the current transaction, returns the number of new
+        entries.
+        """
+        _now = int(time.time())
+        return self.db.executemany(
+            "INSERT OR IGNORE INTO results "
+            "(key, tool, tier, value, reason, size, atime) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                (key, self.tool, tier, value, reason, len(value), _now)
+                for key, value, reason, tier in entries
+            ),
+        ).rowcount
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.db.close()
+
+
+def stat_row(path, stat, digest, checked_ns):
+    """
+    stat index row of a file hashed to digest, checked_ns is the time the
+    file was stat()ed, before it was read
+    """
+    return (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest, checked_ns)
+
+
+def is_stat_clean(row, stat):
+    """
+    True if the file can be trusted to still have the content hash of its
+    stat index row. A file whose mtime isn't clearly older than the moment
+    the row was taken is racy (it may have changed again within the same
+    timestamp tick) and has to be hashed, same for nonsensical timestamps.
+    """
+    _, size, mtime_ns, inode, _, checked_ns = row
+    return (
+        (size, mtime_ns, inode) == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        and mtime_ns > 0
+        and mtime_ns + RACY_WINDOW_NS < checked_ns
+    )
+
+
+def export_bundle(cache, path, keys=None):
+    """
+    Write the entries of cache (or the ones of keys) to a gzip compressed
+    bundle file. The bundle is a header line, one JSON line per entry,
+    sorted by key, and a checksum line. Its content only depends on the
+    entries, so equal caches give byte identical bundles.
+    Returns the number of entries written.
+    """
+    _entries = cache.entries(keys)
+    _checksum = hashlib.blake2b(digest_size=16)
+    _tmp = "{}.tmp".format(path)
+    with open(_tmp, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as o:
+        _header = {
+            "format": BUNDLE_MAGIC,
+            "version": BUNDLE_FORMAT,
+            "schema": SCHEMA_VERSION,
+            "tool": cache.tool,
+            "entries": len(_entries),
+        }
+        o.write(json.dumps(_header, sort_keys=True).encode("utf-8") + b"\n")
+        for x in _entries:
+            _line = json.dumps(list(x), separators=(",", ":")).encode("utf-8")
+            _checksum.update(_line)
+            o.write(_line + b"\n")
+        o.write(json.dumps({"checksum": _checksum.hexdigest()}).encode("utf-8"))
+    os.replace(_tmp, path)
+    return len(_entries)
+
+
+def import_bundle(cache, path):
+    """
+    Merge the entries of a bundle written by export_bundle into cache.
+    Bundles of another format, cache schema or modernmetric version are
+    refused with ValueError, so are incomplete or corrupted ones.
+    Returns the number of entries that were new to cache.
+    """
+    with gzip.open(path, "rb") as i:
+        try:
+            _header = json.loads(i.readline())
+        except (ValueError, EOFError, OSError):
+            _header = None
+        if not isinstance(_header, dict) or _header.get("format") != BUNDLE_MAGIC:
+            raise ValueError("{} is not a modernmetric cache bundle".format(path))
+        if _header.get("version") != BUNDLE_FORMAT:
+            raise ValueError(
+                "Unsupported bundle format {}".format(_header.get("version"))
+            )
+        if _header.get("schema") != SCHEMA_VERSION or _header.get("tool") != cache.tool:
+            raise ValueError(
+                "{} was created by another version of modernmetric".format(path)
+            )
+
+        _checksum = hashlib.blake2b(digest_size=16)
+        _trailer = {}
+        _count = [0]
+
+        def body():
+            for line in i:
+                line = line.rstrip(b"\n")
+                if line.startswith(b"{"):
+                    # entries are JSON arrays, the checksum line an object
+                    _trailer.update(json.loads(line))
+                    return
+                _checksum.update(line)
+                _count[0] += 1
+                yield tuple(json.loads(line))
+
+        # a single transaction, nothing is merged from a broken bundle
+        try:
+            with cache.db:
+                res = cache.add_entries(body())
+                if (
+                    _count[0] != _header.get("entries")
+                    or _trailer.get("checksum") != _checksum.hexdigest()
+                ):
+                    raise ValueError("{} is incomplete or corrupted".format(path))
+        except (EOFError, OSError) as e:
+            raise ValueError("{} is incomplete or corrupted".format(path)) from e
+    return res
+
+
+def get_cache_path(args):
+    return Path(Path.home(), args.cache_dir, args.cache_db)
+
+
+def open_cache(args, importer, defer_writes=False):
+    """
+    ResultCache for the --cache-dir/--cache-db options, None with --no-cache
+    """
+    if getattr(args, "no_cache", False):
+        return None
+    _path = get_cache_path(args)
+    _path.parent.mkdir(parents=True, exist_ok=True)
+    return ResultCache(_path, args, importer, defer_writes=defer_writes)
+
+
+class CacheWriter:
+    """
+    Collects the entries the workers send back and stores them in large
+    transactions, so only one process ever writes to the cache
+    """
+
+    def __init__(self, cache, batch=WRITE_BATCH):
+        self._cache = cache
+        self._batch = batch
+        self._entries = []
+        self._stats = []
+        self._touched = []
+
+    def add(self, entries, stats=(), touched=()):
+        self._entries.extend(entries)
+        self._stats.extend(stats)
+        self._touched.extend(touched)
+        if len(self._entries) + len(self._stats) + len(self._touched) >= self._batch:
+            self.flush()
+
+    def flush(self):
+        if self._entries or self._stats or self._touched:
+            self._cache.set_many(self._entries, self._stats, self._touched)
+            self._entries = []
+            self._stats = []
+            self._touched = []
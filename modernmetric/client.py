@@ -0,0 +1,92 @@
+"""
+Thin client of the 'modernmetric serve' daemon.
+
+It takes the arguments of modernmetric, sends them with the working
+directory to the daemon over its Unix socket and prints what the daemon's
+run printed, so the interpreter startup, the imports and the worker pool
+are only paid for once. Only the standard library is imported here. If no
+daemon is listening, or with --dump, modernmetric runs in this process.
+
+Protocol: one JSON request per connection, {"argv": [...], "cwd": ...}
+or {"stop": true}, answered with {"status": ..., "stdout": ...,
+"stderr": ...}. Each side shuts down its writing end after its message.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = os.path.join("~", ".modernmetric_cache", "serve.sock")
+
+
+def socket_path(path=None):
+    """
+    The socket of --socket, $MODERNMETRIC_SOCKET or the default one
+    """
+    return os.path.expanduser(
+        path or os.environ.get("MODERNMETRIC_SOCKET") or DEFAULT_SOCKET
+    )
+
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode("utf-8"))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def receive_message(sock):
+    _chunks = []
+    while True:
+        _chunk = sock.recv(65536)
+        if not _chunk:
+            break
+        _chunks.append(_chunk)
+    return json.loads(b"".join(_chunks).decode("utf-8"))
+
+
+def request(message, path=None):
+    """
+    Send a request to the daemon, OSError if there is none
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path(path))
+        send_message(sock, message)
+        return receive_message(sock)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="modernmetric-client",
+        description="Run modernmetric through a 'modernmetric serve' daemon,\n"
+        "all other arguments are the ones of modernmetric",
+        allow_abbrev=False,
+        add_help=False,
+    )
+    parser.add_argument("--socket", default=None, help="Socket of the daemon")
+    parser.add_argument(
+        "--stop", default=False, action="store_true", help="Stop the daemon"
+    )
+    _args, _argv = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    if not _argv and not _args.stop:
+        parser.error("no arguments for modernmetric")
+    try:
+        if _args.stop:
+            return request({"stop": True}, _args.socket)["status"]
+        if "--dump" not in _argv:
+            _response = request({"argv": _argv, "cwd": os.getcwd()}, _args.socket)
+            sys.stdout.write(_response["stdout"])
+            sys.stderr.write(_response["stderr"])
+            return _response["status"]
+    except OSError as e:
+        if _args.stop:
+            print("No modernmetric daemon: {}".format(e), file=sys.stderr)
+            return 1
+    # no daemon, or --dump, whose tokens the workers print: run it here
+    from modernmetric.__main__ import main as modernmetric_main
+
+    return modernmetric_main(_argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
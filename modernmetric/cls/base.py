@@ -1,18 +1,40 @@
+from modernmetric.cls.dispatch import TokenDispatcher
+
+
 class MetricBase:
     def __init__(self, args, **kwargs):
         self._metrics = {"lang": []}
         self._internalstore = {}
 
-    def parse_tokens(self, language, tokens):
+    def subscribe(self, language, dispatcher):
+        """
+        Register the token handlers of this metric at the dispatcher
+        """
         if language not in self._metrics["lang"]:
             self._metrics["lang"].append(language)
 
+    def finish(self):
+        """
+        Called once the token stream is exhausted
+        """
+        pass
+
+    def parse_tokens(self, language, tokens):
+        TokenDispatcher([self]).walk(language, tokens)
+
     def get_results(self):
         return self._metrics
 
     def get_internal_store(self):
         return {self.__class__.__name__: self._internalstore}
 
+    @classmethod
+    def pack_internal_store(cls, internalstore):
+        """
+        Dense encoding of an internal store, see modules.pack_store
+        """
+        return internalstore
+
     def _get_all_matching_store_objects(self, store):
         res = []
         for item in store:
@@ -20,5 +42,26 @@ class MetricBase:
                 res.append(item[self.__class__.__name__])
         return res
 
-    def get_results_global(self, value_stores):
+    def new_aggregate(self):
+        """
+        Neutral element for fold_store
+        """
+        return {}
+
+    def fold_store(self, aggregate, internalstore):
+        """
+        Merge an internal store, or another aggregate, into aggregate.
+        The merge is associative and commutative, so stores can be folded
+        in any grouping and order (e.g. per worker first, then in the parent).
+        aggregate is updated in place and returned.
+        """
+        return aggregate
+
+    def get_results_aggregate(self, aggregate):
         return {}
+
+    def get_results_global(self, value_stores):
+        _aggregate = self.new_aggregate()
+        for x in self._get_all_matching_store_objects(value_stores):
+            self.fold_store(_aggregate, x)
+        return self.get_results_aggregate(_aggregate)
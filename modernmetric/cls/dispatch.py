@@ -0,0 +1,65 @@
+from modernmetric.cls.tokenclass import get_table, type_name
+
+
+class TokenDispatcher:
+    """
+    Feeds a single walk over a token stream to several metrics at once.
+
+    Each metric registers its handlers in ``subscribe`` (by token category,
+    by token type name, by token value or for every token); the dispatcher
+    then routes every token only to the handlers that asked for it.
+    Handlers are called with ``(token_type, token_value)``.
+    """
+
+    def __init__(self, metrics):
+        self._metrics = metrics
+        self._any = []
+        self._categories = []
+        self._types = []
+        self._values = {}
+
+    def on_token(self, handler):
+        self._any.append(handler)
+
+    def on_category(self, flags, handler):
+        self._categories.append((flags, handler))
+
+    def on_types(self, types, handler):
+        self._types.append((frozenset(types), handler))
+
+    def on_values(self, values, handler):
+        for value in values:
+            self._values.setdefault(value, []).append(handler)
+
+    def _route(self, table, token_type):
+        _flags = table[token_type]
+        _name = type_name(token_type)
+        return tuple(h for flags, h in self._categories if flags & _flags) + tuple(
+            h for names, h in self._types if _name in names
+        )
+
+    def walk(self, language, tokens):
+        self._any = []
+        self._categories = []
+        self._types = []
+        self._values = {}
+        for x in self._metrics:
+            x.subscribe(language, self)
+
+        _table = get_table(language)
+        _any = tuple(self._any)
+        _values = {k: tuple(v) for k, v in self._values.items()}
+        _routes = {}
+        for token_type, value in tokens:
+            for h in _any:
+                h(token_type, value)
+            _handlers = _routes.get(token_type)
+            if _handlers is None:
+                _handlers = _routes[token_type] = self._route(_table, token_type)
+            for h in _handlers:
+                h(token_type, value)
+            for h in _values.get(value, ()):
+                h(token_type, value)
+
+        for x in self._metrics:
+            x.finish()
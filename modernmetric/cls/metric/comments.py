@@ -1,18 +1,8 @@
+from modernmetric.cls import tokenclass
 from modernmetric.cls.base import MetricBase
 
 
 class MetricBaseComments(MetricBase):
-    _needles = [
-        "Token.Comment",
-        "Token.Comment.Hashbang",
-        "Token.Comment.Multiline",
-        "Token.Comment.Single",
-        "Token.Comment.Special",
-        "Token.Literal.String.Doc",
-    ]
-
-    _specific = {"Python": ["Token.Comment.Preproc"]}
-
     METRIC_COMMENT_RATIO = "comment_ratio"
 
     def __init__(self, args, **kwargs):
@@ -20,15 +10,16 @@ class MetricBaseComments(MetricBase):
         self.__overall = 0
         self.__comments = 0
 
-    def parse_tokens(self, language, tokens):
-        super().parse_tokens(language, [])
-        _n = MetricBaseComments._needles
-        if language in MetricBaseComments._specific:
-            _n += MetricBaseComments._specific[language]
-        for x in tokens:
-            self.__overall += len(str(x[1]))
-            if str(x[0]) in _n:
-                self.__comments += len(str(x[1]))
+    def subscribe(self, language, dispatcher):
+        super().subscribe(language, dispatcher)
+        dispatcher.on_token(self._count_overall)
+        dispatcher.on_category(tokenclass.COMMENT, self._count_comment)
+
+    def _count_overall(self, token_type, value):
+        self.__overall += len(value)
+
+    def _count_comment(self, token_type, value):
+        self.__comments += len(value)
 
     def get_results(self):
         if self.__overall == 0:
@@ -41,14 +32,17 @@ class MetricBaseComments(MetricBase):
         self._internalstore["overall"] = self.__overall
         return self._metrics
 
-    def get_results_global(self, value_stores):
-        __comments = 0
-        __overall = 0
-        for x in self._get_all_matching_store_objects(value_stores):
-            __comments += x["comments"]
-            __overall += x["overall"]
+    def new_aggregate(self):
+        return {"comments": 0, "overall": 0}
+
+    def fold_store(self, aggregate, internalstore):
+        aggregate["comments"] += internalstore["comments"]
+        aggregate["overall"] += internalstore["overall"]
+        return aggregate
+
+    def get_results_aggregate(self, aggregate):
         return {
-            MetricBaseComments.METRIC_COMMENT_RATIO: __comments
+            MetricBaseComments.METRIC_COMMENT_RATIO: aggregate["comments"]
             * 100.0
-            / float(__overall or 1.0)
+            / float(aggregate["overall"] or 1.0)
         }
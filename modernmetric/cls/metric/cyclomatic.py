@@ -26,13 +26,20 @@ class MetricBaseCyclomaticComplexity(MetricBase):
         self._internalstore["exitpoints"] = 0
         self._internalstore["conditions"] = 0
 
-    def parse_tokens(self, language, tokens):
-        super().parse_tokens(language, [])
-        for x in tokens:
-            if str(x[1]) in MetricBaseCyclomaticComplexity.__exitPoints:
-                self._internalstore["exitpoints"] += 1
-            if str(x[1]) in MetricBaseCyclomaticComplexity.__conditions:
-                self._internalstore["conditions"] += 1
+    def subscribe(self, language, dispatcher):
+        super().subscribe(language, dispatcher)
+        dispatcher.on_values(
+            MetricBaseCyclomaticComplexity.__exitPoints, self._count_exitpoint
+        )
+        dispatcher.on_values(
+            MetricBaseCyclomaticComplexity.__conditions, self._count_condition
+        )
+
+    def _count_exitpoint(self, token_type, value):
+        self._internalstore["exitpoints"] += 1
+
+    def _count_condition(self, token_type, value):
+        self._internalstore["conditions"] += 1
 
     def get_results(self):
         self._metrics[MetricBaseCyclomaticComplexity.METRIC_CYCLOMATIC_COMPLEXITY] = (
@@ -45,14 +52,17 @@ class MetricBaseCyclomaticComplexity(MetricBase):
         )
         return self._metrics
 
-    def get_results_global(self, value_stores):
-        __exitPoints = 0
-        __conditions = 0
-        for x in self._get_all_matching_store_objects(value_stores):
-            __conditions += x["conditions"]
-            __exitPoints += x["exitpoints"]
+    def new_aggregate(self):
+        return {"exitpoints": 0, "conditions": 0}
+
+    def fold_store(self, aggregate, internalstore):
+        aggregate["exitpoints"] += internalstore["exitpoints"]
+        aggregate["conditions"] += internalstore["conditions"]
+        return aggregate
+
+    def get_results_aggregate(self, aggregate):
         return {
             MetricBaseCyclomaticComplexity.METRIC_CYCLOMATIC_COMPLEXITY: max(
-                __conditions - __exitPoints + 2, 0
+                aggregate["conditions"] - aggregate["exitpoints"] + 2, 0
             )
         }
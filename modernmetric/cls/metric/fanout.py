@@ -1,12 +1,11 @@
+from pygments.token import Token
+
+from modernmetric.cls import tokenclass
 from modernmetric.cls.base import MetricBase
+from modernmetric.cls.sketch import get_sketch_precision
 
 
 class MetricBaseFanout(MetricBase):
-    _needles = {
-        "Python": ["Token.Name.Namespace"],
-        "C": ["Token.Comment.PreprocFile"],
-        "C++": ["Token.Comment.PreprocFile"],
-    }
     _functions = {"PHP": "_parsePHP", "Go": "_parseGo", "Ruby": "_parseRuby"}
     _internal = {
         "Python": {"start": ".", "end": ""},
@@ -21,6 +20,13 @@ class MetricBaseFanout(MetricBase):
         super().__init__(args, **kwargs)
         self._int = set()
         self._ext = set()
+        self._i = {"start": "", "end": ""}
+        self._imports = []
+        self._seeking = False
+        self._multiple = False
+        self._start_type = None
+        self._stop_type = None
+        self._approx = get_sketch_precision(args) is not None
 
     def __isInternal(self, value, internal_mapping):
         return all(
@@ -30,84 +36,100 @@ class MetricBaseFanout(MetricBase):
             ]
         )
 
-    def _parsePHP(self, iterator):
-        res = []
-        _start_token = ["include", "require", "include_once", "require_once"]
-        _cont_token = ["Token.Literal.String.Single", "Token.Literal.String.Double"]
-        for i, val in iterator:
-            if str(val[0]) in ["Token.Keyword"] and val[1] in _start_token:
-                while iterator and str(val[0]) not in _cont_token:
-                    i, val = next(iterator)
-                if iterator:
-                    res.append(val[1].strip("'").strip('"'))
-        return res
-
-    def _parseRuby(self, iterator):
-        res = []
-        for i, val in iterator:
-            if str(val[0]) in ["Token.Name.Builtin"] and val[1] in ["require"]:
-                while iterator:
-                    i, val = next(iterator)
-                    if str(val[0]) in ["Token.Literal.String.Single"]:
-                        print()
-                        res.append(val[1].strip("'").strip('"'))
-                        break
-                    elif str(val[0]) in ["Token.Text"] and val[1] in ["\n", "\r\n"]:
-                        break
-        return res
-
-    def _parseGo(self, iterator):
-        res = []
-        for i, val in iterator:
-            if str(val[0]) in ["Token.Keyword.Namespace"] and val[1] in ["import"]:
-                while iterator:
-                    i, val = next(iterator)
-                    if str(val[0]) in ["Token.Literal.String"]:
-                        res.append(val[1].strip("'").strip('"'))
-                    if str(val[0]) in ["Token.Punctuation"] and val[1] in [")"]:
-                        break
-        return res
-
-    def parse_tokens(self, language, tokens):
-        super().parse_tokens(language, [])
+    def _startImport(self, token_type, value):
+        if token_type is self._start_type:
+            self._seeking = True
+
+    def _stopImport(self, token_type, value):
+        if token_type is self._stop_type:
+            self._seeking = False
+
+    def _takeImport(self, token_type, value):
+        if self._seeking:
+            self._imports.append(value.strip("'").strip('"'))
+            self._seeking = self._multiple
+
+    def _parsePHP(self, dispatcher):
+        self._start_type = Token.Keyword
+        dispatcher.on_values(
+            ["include", "require", "include_once", "require_once"], self._startImport
+        )
+        dispatcher.on_types(
+            ["Token.Literal.String.Single", "Token.Literal.String.Double"],
+            self._takeImport,
+        )
+
+    def _parseRuby(self, dispatcher):
+        self._start_type = Token.Name.Builtin
+        self._stop_type = Token.Text
+        dispatcher.on_values(["require"], self._startImport)
+        dispatcher.on_types(["Token.Literal.String.Single"], self._takeImport)
+        dispatcher.on_values(["\n", "\r\n"], self._stopImport)
+
+    def _parseGo(self, dispatcher):
+        self._start_type = Token.Keyword.Namespace
+        self._stop_type = Token.Punctuation
+        self._multiple = True
+        dispatcher.on_values(["import"], self._startImport)
+        dispatcher.on_types(["Token.Literal.String"], self._takeImport)
+        dispatcher.on_values([")"], self._stopImport)
+
+    def _collect(self, token_type, value):
+        self._imports.append(value)
+
+    def subscribe(self, language, dispatcher):
+        super().subscribe(language, dispatcher)
         if language in MetricBaseFanout._internal:
-            _i = MetricBaseFanout._internal[language]
+            self._i = MetricBaseFanout._internal[language]
         else:
-            _i = {"start": "", "end": ""}
-        _imports = []
-        if language in MetricBaseFanout._needles.keys():
-            _n = MetricBaseFanout._needles[language]
-            for x in [x for x in tokens if str(x[0]) in _n]:
-                _imports.append(x[1])
+            self._i = {"start": "", "end": ""}
+        self._imports = []
+        self._seeking = False
+        self._multiple = False
+        if language in tokenclass.IMPORT_TYPES:
+            dispatcher.on_category(tokenclass.IMPORT, self._collect)
         elif language in MetricBaseFanout._functions:
-            _imports = getattr(self, MetricBaseFanout._functions[language])(
-                enumerate(tokens)
-            )
+            getattr(self, MetricBaseFanout._functions[language])(dispatcher)
         # else:
         #     # Language isn't supported at the moment
-        #     for x in tokens:
-        #         print(str(x))
-        for x in _imports:
-            if self.__isInternal(x, _i):
+
+    def finish(self):
+        for x in self._imports:
+            if self.__isInternal(x, self._i):
                 self._int.add(str(x))
             else:
                 self._ext.add(str(x))
+        self._imports = []
         self._metrics.update(
             {
                 MetricBaseFanout.METRIC_FANOUT_INTERNAL: len(list(self._int)),
                 MetricBaseFanout.METRIC_FANOUT_EXTERNAL: len(list(self._ext)),
             }
         )
-        self._internalstore["int"] = list(self._int)
-        self._internalstore["ext"] = list(self._ext)
-
-    def get_results_global(self, value_stores):
-        _int = []
-        _ext = []
-        for x in self._get_all_matching_store_objects(value_stores):
-            _int += x["int"]
-            _ext += x["ext"]
+        if self._approx:
+            # the global fanout adds up the per file counts, so these are
+            # all that is needed, exact and of constant size
+            self._internalstore["int"] = len(self._int)
+            self._internalstore["ext"] = len(self._ext)
+        else:
+            self._internalstore["int"] = list(self._int)
+            self._internalstore["ext"] = list(self._ext)
+
+    @staticmethod
+    def __count(value):
+        return value if isinstance(value, int) else len(value)
+
+    def new_aggregate(self):
+        return {"int": 0, "ext": 0}
+
+    def fold_store(self, aggregate, internalstore):
+        # the global fanout adds up the per file counts
+        aggregate["int"] += MetricBaseFanout.__count(internalstore["int"])
+        aggregate["ext"] += MetricBaseFanout.__count(internalstore["ext"])
+        return aggregate
+
+    def get_results_aggregate(self, aggregate):
         return {
-            MetricBaseFanout.METRIC_FANOUT_INTERNAL: len(_int),
-            MetricBaseFanout.METRIC_FANOUT_EXTERNAL: len(_ext),
+            MetricBaseFanout.METRIC_FANOUT_INTERNAL: aggregate["int"],
+            MetricBaseFanout.METRIC_FANOUT_EXTERNAL: aggregate["ext"],
         }
@@ -1,44 +1,8 @@
+from modernmetric.cls import tokenclass
 from modernmetric.cls.base import MetricBase
-import pygments
-import pygments.lexer
-import pygments.lexers
-import pygments.token
-import pygments.util
-
-from pygount.analysis import (
-    white_characters,
-    white_code_words,
-    _delined_tokens,
-    _pythonized_comments,
-)
-
-
-def _line_parts(tokens, language_id: str):
-    line_marks = set()
-    white_text = " \f\n\r\t" + white_characters(language_id)
-    white_words = white_code_words(language_id)
-    for token_type, token_text in tokens:
-        # NOTE: Pygments treats preprocessor statements as special comments.
-        is_actual_comment = token_type in pygments.token.Comment and token_type not in (
-            pygments.token.Comment.Preproc,
-            pygments.token.Comment.PreprocFile,
-        )
-        if is_actual_comment:
-            line_marks.add("d")  # 'documentation'
-        elif token_type in pygments.token.String:
-            line_marks.add("s")  # 'string'
-        else:
-            is_white_text = (token_text.strip() in white_words) or (
-                token_text.rstrip(white_text) == ""
-            )
-            if not is_white_text:
-                line_marks.add("c")  # 'code'
 
-        if token_text.endswith("\n"):
-            yield line_marks
-            line_marks = set()
-    if len(line_marks) >= 1:
-        yield line_marks
+from pygount.analysis import white_characters, white_code_words
+from pygount.common import WHITE_SPACE_CHARACTERS
 
 
 class MetricBaseLOC(MetricBase):
@@ -50,22 +14,77 @@ class MetricBaseLOC(MetricBase):
 
     metrics = {"c": METRIC_CLOC, "d": METRIC_DLOC, "e": METRIC_ELOC, "s": METRIC_SLOC}
 
+    __keys = (METRIC_LOC, METRIC_CLOC, METRIC_DLOC, METRIC_ELOC, METRIC_SLOC)
+
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
 
-    def parse_tokens(self, language, tokens):
-        super().parse_tokens(language, [])
-        tokens = _delined_tokens(tokens)
-        if language.lower() == "python":
-            tokens = _pythonized_comments(tokens)
+    def subscribe(self, language, dispatcher):
+        super().subscribe(language, dispatcher)
         language_id = language.lower()
-        mark_to_count_map = {"c": 0, "d": 0, "e": 0, "s": 0}
-        for line_parts in _line_parts(tokens, language_id):
-            mark_to_increment = "e"
-            for mark_to_check in ("d", "s", "c"):
-                if mark_to_check in line_parts:
-                    mark_to_increment = mark_to_check
-            mark_to_count_map[mark_to_increment] += 1
+        self._table = tokenclass.get_table(language)
+        self._pythonized = language_id == "python"
+        self._is_after_colon = True
+        self._white_text = " \f\n\r\t" + white_characters(language_id)
+        self._white_words = white_code_words(language_id)
+        self._line_marks = set()
+        self._mark_to_count_map = {"c": 0, "d": 0, "e": 0, "s": 0}
+        dispatcher.on_token(self._delined_token)
+
+    def _delined_token(self, token_type, token_text):
+        # Same as pygount's _delined_tokens, but pushed one token at a time
+        flags = self._table[token_type]
+        remaining_token_text = token_text
+        newline_index = remaining_token_text.find("\n")
+        while newline_index != -1:
+            self._line_part(flags, remaining_token_text[: newline_index + 1])
+            remaining_token_text = remaining_token_text[newline_index + 1 :]
+            newline_index = remaining_token_text.find("\n")
+        if remaining_token_text != "":
+            self._line_part(flags, remaining_token_text)
+
+    def _pythonized_comment(self, flags, token_text):
+        # Same as pygount's _pythonized_comments for a single token
+        if self._is_after_colon and (flags & tokenclass.STRING):
+            return tokenclass.DOCUMENTATION
+        if token_text == ":":
+            self._is_after_colon = True
+        elif not flags & (tokenclass.DOCUMENTATION | tokenclass.PREPROC):
+            is_whitespace = len(token_text.rstrip(WHITE_SPACE_CHARACTERS)) == 0
+            if not is_whitespace:
+                self._is_after_colon = False
+        return flags
+
+    def _line_part(self, flags, token_text):
+        if self._pythonized:
+            flags = self._pythonized_comment(flags, token_text)
+        # NOTE: Pygments treats preprocessor statements as special comments.
+        if flags & tokenclass.DOCUMENTATION:
+            self._line_marks.add("d")  # 'documentation'
+        elif flags & tokenclass.STRING:
+            self._line_marks.add("s")  # 'string'
+        else:
+            is_white_text = (token_text.strip() in self._white_words) or (
+                token_text.rstrip(self._white_text) == ""
+            )
+            if not is_white_text:
+                self._line_marks.add("c")  # 'code'
+
+        if token_text.endswith("\n"):
+            self._count_line()
+
+    def _count_line(self):
+        mark_to_increment = "e"
+        for mark_to_check in ("d", "s", "c"):
+            if mark_to_check in self._line_marks:
+                mark_to_increment = mark_to_check
+        self._mark_to_count_map[mark_to_increment] += 1
+        self._line_marks = set()
+
+    def finish(self):
+        if len(self._line_marks) >= 1:
+            self._count_line()
+        mark_to_count_map = self._mark_to_count_map
 
         self._metrics[MetricBaseLOC.METRIC_LOC] = 0
         for mark_type in mark_to_count_map:
@@ -111,41 +130,13 @@ class MetricBaseLOC(MetricBase):
             MetricBaseLOC.METRIC_SLOC
         ]
 
-    def get_results_global(self, value_stores):
-        _sum_LOC = sum(
-            [
-                x[MetricBaseLOC.METRIC_LOC]
-                for x in self._get_all_matching_store_objects(value_stores)
-            ]
-        )
-        _sum_CLOC = sum(
-            [
-                x[MetricBaseLOC.METRIC_CLOC]
-                for x in self._get_all_matching_store_objects(value_stores)
-            ]
-        )
-        _sum_DLOC = sum(
-            [
-                x[MetricBaseLOC.METRIC_DLOC]
-                for x in self._get_all_matching_store_objects(value_stores)
-            ]
-        )
-        _sum_ELOC = sum(
-            [
-                x[MetricBaseLOC.METRIC_ELOC]
-                for x in self._get_all_matching_store_objects(value_stores)
-            ]
-        )
-        _sum_SLOC = sum(
-            [
-                x[MetricBaseLOC.METRIC_SLOC]
-                for x in self._get_all_matching_store_objects(value_stores)
-            ]
-        )
-        return {
-            MetricBaseLOC.METRIC_LOC: _sum_LOC,
-            MetricBaseLOC.METRIC_CLOC: _sum_CLOC,
-            MetricBaseLOC.METRIC_DLOC: _sum_DLOC,
-            MetricBaseLOC.METRIC_ELOC: _sum_ELOC,
-            MetricBaseLOC.METRIC_SLOC: _sum_SLOC,
-        }
+    def new_aggregate(self):
+        return {x: 0 for x in MetricBaseLOC.__keys}
+
+    def fold_store(self, aggregate, internalstore):
+        for x in MetricBaseLOC.__keys:
+            aggregate[x] += internalstore[x]
+        return aggregate
+
+    def get_results_aggregate(self, aggregate):
+        return {x: aggregate[x] for x in MetricBaseLOC.__keys}
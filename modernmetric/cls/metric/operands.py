@@ -1,74 +1,63 @@
+from collections import Counter
+
+from modernmetric.cls import tokenclass
 from modernmetric.cls.base import MetricBase
+from modernmetric.cls.sketch import (
+    count_results,
+    fold_counts,
+    get_sketch_precision,
+    new_counts_aggregate,
+    sketch_counts,
+)
 
 
 class MetricBaseOperands(MetricBase):
-    _needles = [
-        "Token.Literal.Date",
-        "Token.Literal.String.Double",
-        "Token.Literal.String",
-        "Token.Literal.Number.Bin",
-        "Token.Literal.Number.Float",
-        "Token.Literal.Number.Hex",
-        "Token.Literal.Number.Integer.Long",
-        "Token.Literal.Number.Integer",
-        "Token.Literal.Number.Oct",
-        "Token.Literal.Number",
-        "Token.Name",
-        "Token.Name.Attribute",
-        "Token.Name.Builtin.Pseudo",
-        "Token.Name.Builtin",
-        "Token.Name.Constant",
-        "Token.Name.Variable.Class",
-        "Token.Name.Variable.Global",
-        "Token.Name.Variable.Instance",
-        "Token.Name.Variable.Magic",
-        "Token.Name.Variable",
-        "Token.Name.Other",
-        "Token.Number.Bin",
-        "Token.Number.Float",
-        "Token.Number.Hex",
-        "Token.Number.Integer.Long",
-        "Token.Number.Integer",
-        "Token.Number.Oct",
-        "Token.Number",
-        "Token.String.Char",
-        "Token.String.Double",
-        "Token.String.Escape",
-        "Token.String.Heredoc",
-        "Token.String.Interpol",
-        "Token.String.Other",
-        "Token.String.Regex",
-        "Token.String.Single",
-        "Token.String.Symbol",
-    ]
-
     METRIC_OPERANDS_SUM = "operands_sum"
     METRIC_OPERANDS_UNIQUE = "operands_uniq"
+    METRIC_OPERANDS_UNIQUE_ERROR = "operands_uniq_error"
 
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
-        self.__operands = []
+        self.__operands = Counter()
+        self.__precision = get_sketch_precision(args)
 
-    def parse_tokens(self, language, tokens):
-        super().parse_tokens(language, [])
-        for x in tokens:
-            if str(x[0]) in MetricBaseOperands._needles:
-                self.__operands.append(str(x[1]))
+    def subscribe(self, language, dispatcher):
+        super().subscribe(language, dispatcher)
+        dispatcher.on_category(tokenclass.OPERAND, self._collect)
+
+    def _collect(self, token_type, value):
+        self.__operands[value] += 1
 
     def get_results(self):
-        self._metrics[MetricBaseOperands.METRIC_OPERANDS_SUM] = len(self.__operands)
-        self._metrics[MetricBaseOperands.METRIC_OPERANDS_UNIQUE] = len(
-            list(set(self.__operands))
+        self._metrics[MetricBaseOperands.METRIC_OPERANDS_SUM] = sum(
+            self.__operands.values()
         )
-
-        self._internalstore["operands"] = self.__operands
+        self._metrics[MetricBaseOperands.METRIC_OPERANDS_UNIQUE] = len(self.__operands)
+        if self.__precision:
+            self._internalstore = sketch_counts(self.__operands, self.__precision)
+        else:
+            self._internalstore["operands"] = dict(self.__operands)
         return self._metrics
 
-    def get_results_global(self, value_stores):
-        _operands = []
-        for x in self._get_all_matching_store_objects(value_stores):
-            _operands += x["operands"]
-        return {
-            MetricBaseOperands.METRIC_OPERANDS_SUM: len(_operands),
-            MetricBaseOperands.METRIC_OPERANDS_UNIQUE: len(list(set(_operands))),
+    @classmethod
+    def pack_internal_store(cls, internalstore):
+        # stores written before the counters were introduced
+        if isinstance(internalstore.get("operands"), list):
+            return {"operands": dict(Counter(internalstore["operands"]))}
+        return internalstore
+
+    def new_aggregate(self):
+        return new_counts_aggregate("operands")
+
+    def fold_store(self, aggregate, internalstore):
+        return fold_counts(aggregate, internalstore, "operands")
+
+    def get_results_aggregate(self, aggregate):
+        _sum, _uniq, _error = count_results(aggregate, "operands")
+        res = {
+            MetricBaseOperands.METRIC_OPERANDS_SUM: _sum,
+            MetricBaseOperands.METRIC_OPERANDS_UNIQUE: _uniq,
         }
+        if _error is not None:
+            res[MetricBaseOperands.METRIC_OPERANDS_UNIQUE_ERROR] = _error
+        return res
@@ -1,49 +1,63 @@
+from collections import Counter
+
+from modernmetric.cls import tokenclass
 from modernmetric.cls.base import MetricBase
+from modernmetric.cls.sketch import (
+    count_results,
+    fold_counts,
+    get_sketch_precision,
+    new_counts_aggregate,
+    sketch_counts,
+)
 
 
 class MetricBaseOperator(MetricBase):
-    _needles = [
-        "Token.Name.Class",
-        "Token.Name.Decorator",
-        "Token.Name.Entity",
-        "Token.Name.Exception",
-        "Token.Name.Function.Magic",
-        "Token.Name.Function",
-        "Token.Name.Label",
-        "Token.Name.Tag",
-        "Token.Operator.Word",
-        "Token.Operator",
-        "Token.Punctuation",
-        "Token.String.Affix",
-        "Token.String.Delimiter",
-    ]
-
     METRIC_OPERATORS_SUM = "operators_sum"
     METRIC_OPERATORS_UNIQUE = "operators_uniq"
+    METRIC_OPERATORS_UNIQUE_ERROR = "operators_uniq_error"
 
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
-        self.__operator = []
+        self.__operator = Counter()
+        self.__precision = get_sketch_precision(args)
+
+    def subscribe(self, language, dispatcher):
+        super().subscribe(language, dispatcher)
+        dispatcher.on_category(tokenclass.OPERATOR, self._collect)
 
-    def parse_tokens(self, language, tokens):
-        super().parse_tokens(language, [])
-        for x in tokens:
-            if str(x[0]) in MetricBaseOperator._needles:
-                self.__operator.append(str(x[1]))
+    def _collect(self, token_type, value):
+        self.__operator[value] += 1
 
     def get_results(self):
-        self._metrics[MetricBaseOperator.METRIC_OPERATORS_SUM] = len(self.__operator)
-        self._metrics[MetricBaseOperator.METRIC_OPERATORS_UNIQUE] = len(
-            list(set(self.__operator))
+        self._metrics[MetricBaseOperator.METRIC_OPERATORS_SUM] = sum(
+            self.__operator.values()
         )
-        self._internalstore["operator"] = self.__operator
+        self._metrics[MetricBaseOperator.METRIC_OPERATORS_UNIQUE] = len(self.__operator)
+        if self.__precision:
+            self._internalstore = sketch_counts(self.__operator, self.__precision)
+        else:
+            self._internalstore["operator"] = dict(self.__operator)
         return self._metrics
 
-    def get_results_global(self, value_stores):
-        _operator = []
-        for x in self._get_all_matching_store_objects(value_stores):
-            _operator += x["operator"]
-        return {
-            MetricBaseOperator.METRIC_OPERATORS_SUM: len(_operator),
-            MetricBaseOperator.METRIC_OPERATORS_UNIQUE: len(list(set(_operator))),
+    @classmethod
+    def pack_internal_store(cls, internalstore):
+        # stores written before the counters were introduced
+        if isinstance(internalstore.get("operator"), list):
+            return {"operator": dict(Counter(internalstore["operator"]))}
+        return internalstore
+
+    def new_aggregate(self):
+        return new_counts_aggregate("operator")
+
+    def fold_store(self, aggregate, internalstore):
+        return fold_counts(aggregate, internalstore, "operator")
+
+    def get_results_aggregate(self, aggregate):
+        _sum, _uniq, _error = count_results(aggregate, "operator")
+        res = {
+            MetricBaseOperator.METRIC_OPERATORS_SUM: _sum,
+            MetricBaseOperator.METRIC_OPERATORS_UNIQUE: _uniq,
         }
+        if _error is not None:
+            res[MetricBaseOperator.METRIC_OPERATORS_UNIQUE_ERROR] = _error
+        return res
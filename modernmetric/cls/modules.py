@@ -8,20 +8,50 @@ from modernmetric.cls.metric.fanout import MetricBaseFanout
 from modernmetric.cls.metric.loc import MetricBaseLOC
 from modernmetric.cls.metric.operands import MetricBaseOperands
 from modernmetric.cls.metric.operators import MetricBaseOperator
+from modernmetric.cls.sketch import DEFAULT_PRECISION, MAX_PRECISION, MIN_PRECISION
 from modernmetric.cls.stats.stats import MetricBaseStatsAverage
 
 
-def get_modules_metrics(args, **kwargs):
+def get_modules_metrics_classes():
     return [
-        MetricBaseComments(args, **kwargs),
-        MetricBaseCyclomaticComplexity(args, **kwargs),
-        MetricBaseFanout(args, **kwargs),
-        MetricBaseLOC(args, **kwargs),
-        MetricBaseOperands(args, **kwargs),
-        MetricBaseOperator(args, **kwargs),
+        MetricBaseComments,
+        MetricBaseCyclomaticComplexity,
+        MetricBaseFanout,
+        MetricBaseLOC,
+        MetricBaseOperands,
+        MetricBaseOperator,
     ]
 
 
+def get_modules_metrics(args, **kwargs):
+    return [x(args, **kwargs) for x in get_modules_metrics_classes()]
+
+
+def pack_store(store):
+    """
+    Dense encoding of a file store, as sent from the workers to the parent
+    """
+    res = dict(store)
+    for x in get_modules_metrics_classes():
+        if x.__name__ in res:
+            res[x.__name__] = x.pack_internal_store(res[x.__name__])
+    return res
+
+
+def new_aggregates(metrics):
+    return {x.__class__.__name__: x.new_aggregate() for x in metrics}
+
+
+def fold_aggregates(metrics, aggregates, store):
+    """
+    Fold a file store (or other aggregates) into the aggregates of metrics
+    """
+    for x in metrics:
+        if x.__class__.__name__ in store:
+            x.fold_store(aggregates[x.__class__.__name__], store[x.__class__.__name__])
+    return aggregates
+
+
 def get_modules_calculated(args, **kwargs):
     return [
         MetricBaseCalcHalstead(args, **kwargs),
@@ -50,3 +80,45 @@ def get_additional_parser_args(parser):
         help="Method how to calculate the maintainability index",
         dest="maintenance_index_calc_method",
     )
+    parser.add_argument(
+        "--approx",
+        default=False,
+        action="store_true",
+        help="Approximate the global operands_uniq/operators_uniq with\n"
+        "fixed size HyperLogLog sketches instead of keeping every symbol",
+        dest="approx_global_metrics",
+    )
+    parser.add_argument(
+        "--approx-precision",
+        default=DEFAULT_PRECISION,
+        type=int,
+        choices=range(MIN_PRECISION, MAX_PRECISION + 1),
+        metavar="{{{}..{}}}".format(MIN_PRECISION, MAX_PRECISION),
+        help="Sketch size as power of two for --approx (default: {})".format(
+            DEFAULT_PRECISION
+        ),
+        dest="approx_precision",
+    )
+
+
+def overall_section(args, importer, metrics, aggregates):
+    """
+    The overall section of the folded aggregates of metrics
+    """
+    res = {}
+    for y in metrics:
+        res.update(y.get_results_aggregate(aggregates[y.__class__.__name__]))
+    for y in get_modules_calculated(args, **importer):
+        res.update(y.get_results(res))
+    return res
+
+
+def finish_result(result, args, importer, metrics, aggregates):
+    """
+    Fill the overall and stats sections of result from the per file results
+    and the folded aggregates of metrics
+    """
+    result["overall"].update(overall_section(args, importer, metrics, aggregates))
+    for m in get_modules_stats(args, **importer):
+        result = m.get_results(result, "files", "overall")
+    return result
@@ -0,0 +1,150 @@
+"""
+HyperLogLog cardinality sketch.
+
+A sketch has a fixed size of 2^precision one byte registers, whatever the
+number of values added to it. Two sketches with the same precision can be
+merged, the result is the same as if all values were added to one sketch.
+Values are hashed with a process independent hash, so sketches built in
+different workers (or runs) can be merged as well.
+"""
+
+import base64
+import math
+import zlib
+from collections import Counter
+
+from modernmetric.cls.symbols import stable_hash
+
+DEFAULT_PRECISION = 10
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+class HyperLogLog:
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError("Unsupported sketch precision: {}".format(precision))
+        self.precision = precision
+        self._m = 1 << precision
+        self._registers = (
+            bytearray(registers) if registers is not None else bytearray(self._m)
+        )
+
+    def add(self, value):
+        _hash = stable_hash(value)
+        _index = _hash >> (64 - self.precision)
+        _rest = _hash & ((1 << (64 - self.precision)) - 1)
+        _rank = (64 - self.precision) - _rest.bit_length() + 1
+        if _rank > self._registers[_index]:
+            self._registers[_index] = _rank
+
+    def update(self, values):
+        for x in values:
+            self.add(x)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precision")
+        self._registers = bytearray(map(max, self._registers, other._registers))
+        return self
+
+    def estimate(self):
+        _alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(
+            self._m, 0.7213 / (1.0 + 1.079 / self._m)
+        )
+        _raw = _alpha * self._m * self._m / sum(2.0**-x for x in self._registers)
+        _zeros = self._registers.count(0)
+        if _raw <= 2.5 * self._m and _zeros:
+            # small range correction (linear counting)
+            return self._m * math.log(self._m / float(_zeros))
+        return _raw
+
+    def cardinality(self):
+        return int(round(self.estimate()))
+
+    def relative_error(self):
+        """
+        Standard error of the estimate, relative to the true cardinality
+        """
+        return 1.04 / math.sqrt(self._m)
+
+    def encode(self):
+        """
+        JSON friendly representation, see decode
+        """
+        return {
+            "p": self.precision,
+            "hll": base64.b64encode(zlib.compress(bytes(self._registers))).decode(
+                "ascii"
+            ),
+        }
+
+    @staticmethod
+    def decode(value):
+        return HyperLogLog(
+            precision=value["p"],
+            registers=zlib.decompress(base64.b64decode(value["hll"])),
+        )
+
+
+def get_sketch_precision(args):
+    """
+    Sketch precision requested by the command line, None for exact stores
+    """
+    try:
+        if args.approx_global_metrics:
+            return args.approx_precision
+    except AttributeError:
+        pass
+    return None
+
+
+def sketch_counts(counts, precision):
+    """
+    Store for a symbol -> count mapping of one file in approximate mode
+    """
+    _sketch = HyperLogLog(precision)
+    _sketch.update(counts)
+    return {"sum": sum(counts.values()), "sketch": _sketch.encode()}
+
+
+def new_counts_aggregate(key):
+    """
+    Aggregate of symbol -> count stores, exact and sketched ones.
+    Exactly counted symbols stay in key, sum counts the sketched occurrences
+    """
+    return {key: Counter(), "sum": 0, "sketch": None}
+
+
+def fold_counts(aggregate, store, key):
+    """
+    Fold a store created by get_results (exact or sketch_counts) or another
+    aggregate into aggregate
+    """
+    if key in store:
+        aggregate[key].update(store[key])
+    if store.get("sketch"):
+        aggregate["sum"] += store["sum"]
+        _sketch = store["sketch"]
+        if isinstance(_sketch, dict):
+            _sketch = HyperLogLog.decode(_sketch)
+        if aggregate["sketch"] is None:
+            aggregate["sketch"] = HyperLogLog(_sketch.precision)
+        aggregate["sketch"].merge(_sketch)
+    return aggregate
+
+
+def count_results(aggregate, key):
+    """
+    Returns the total number of occurrences, the number of distinct symbols
+    and the relative error of the latter (None if it is exact)
+    """
+    _counts = aggregate[key]
+    _sum = aggregate["sum"] + sum(_counts.values())
+    if aggregate["sketch"] is None:
+        return _sum, len(_counts), None
+    _sketch = HyperLogLog(
+        aggregate["sketch"].precision, registers=aggregate["sketch"]._registers
+    )
+    _sketch.update(_counts)
+    return _sum, _sketch.cardinality(), _sketch.relative_error()
@@ -0,0 +1,15 @@
+"""
+Process independent hashes of operand and operator symbols.
+"""
+
+import hashlib
+
+
+def stable_hash(value):
+    """
+    64 bit hash of a string, identical in every process
+    """
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8", "surrogatepass"), digest_size=8).digest(),
+        "big",
+    )
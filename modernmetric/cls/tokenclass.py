@@ -0,0 +1,169 @@
+"""
+Token classification tables shared by the metric modules.
+
+Every (language, token type) pair is classified once per process into a
+bitmask of categories, so the metrics never compare token type strings
+while walking a token stream.
+
+Categories named by token types (comments, operands, operators, imports)
+match exactly the listed types; pygments aliases like ``Token.Number``
+print as their canonical ``Token.Literal.Number`` name, which is the one
+that gets matched. The structural categories (keyword, string,
+documentation, preprocessor) follow the pygments token type hierarchy.
+"""
+
+from pygments import token
+
+COMMENT = 1 << 0
+OPERAND = 1 << 1
+OPERATOR = 1 << 2
+IMPORT = 1 << 3
+KEYWORD = 1 << 4
+STRING = 1 << 5
+DOCUMENTATION = 1 << 6
+PREPROC = 1 << 7
+
+COMMENT_TYPES = frozenset(
+    [
+        "Token.Comment",
+        "Token.Comment.Hashbang",
+        "Token.Comment.Multiline",
+        "Token.Comment.Single",
+        "Token.Comment.Special",
+        "Token.Literal.String.Doc",
+    ]
+)
+
+COMMENT_TYPES_SPECIFIC = {"Python": frozenset(["Token.Comment.Preproc"])}
+
+OPERAND_TYPES = frozenset(
+    [
+        "Token.Literal.Date",
+        "Token.Literal.String.Double",
+        "Token.Literal.String",
+        "Token.Literal.Number.Bin",
+        "Token.Literal.Number.Float",
+        "Token.Literal.Number.Hex",
+        "Token.Literal.Number.Integer.Long",
+        "Token.Literal.Number.Integer",
+        "Token.Literal.Number.Oct",
+        "Token.Literal.Number",
+        "Token.Name",
+        "Token.Name.Attribute",
+        "Token.Name.Builtin.Pseudo",
+        "Token.Name.Builtin",
+        "Token.Name.Constant",
+        "Token.Name.Variable.Class",
+        "Token.Name.Variable.Global",
+        "Token.Name.Variable.Instance",
+        "Token.Name.Variable.Magic",
+        "Token.Name.Variable",
+        "Token.Name.Other",
+        "Token.Number.Bin",
+        "Token.Number.Float",
+        "Token.Number.Hex",
+        "Token.Number.Integer.Long",
+        "Token.Number.Integer",
+        "Token.Number.Oct",
+        "Token.Number",
+        "Token.String.Char",
+        "Token.String.Double",
+        "Token.String.Escape",
+        "Token.String.Heredoc",
+        "Token.String.Interpol",
+        "Token.String.Other",
+        "Token.String.Regex",
+        "Token.String.Single",
+        "Token.String.Symbol",
+    ]
+)
+
+OPERATOR_TYPES = frozenset(
+    [
+        "Token.Name.Class",
+        "Token.Name.Decorator",
+        "Token.Name.Entity",
+        "Token.Name.Exception",
+        "Token.Name.Function.Magic",
+        "Token.Name.Function",
+        "Token.Name.Label",
+        "Token.Name.Tag",
+        "Token.Operator.Word",
+        "Token.Operator",
+        "Token.Punctuation",
+        "Token.String.Affix",
+        "Token.String.Delimiter",
+    ]
+)
+
+IMPORT_TYPES = {
+    "Python": frozenset(["Token.Name.Namespace"]),
+    "C": frozenset(["Token.Comment.PreprocFile"]),
+    "C++": frozenset(["Token.Comment.PreprocFile"]),
+}
+
+_PREPROC = (token.Comment.Preproc, token.Comment.PreprocFile)
+
+_names = {}
+_tables = {}
+
+
+def type_name(token_type):
+    """
+    Cached ``str(token_type)``
+    """
+    try:
+        return _names[token_type]
+    except KeyError:
+        _names[token_type] = str(token_type)
+        return _names[token_type]
+
+
+def classify(language, token_type):
+    """
+    Compute the category bitmask of a token type (uncached)
+    """
+    _name = type_name(token_type)
+    flags = 0
+    if _name in COMMENT_TYPES or _name in COMMENT_TYPES_SPECIFIC.get(language, ()):
+        flags |= COMMENT
+    if _name in OPERAND_TYPES:
+        flags |= OPERAND
+    if _name in OPERATOR_TYPES:
+        flags |= OPERATOR
+    if _name in IMPORT_TYPES.get(language, ()):
+        flags |= IMPORT
+    if token_type in token.Keyword:
+        flags |= KEYWORD
+    if token_type in token.String:
+        flags |= STRING
+    if token_type in _PREPROC:
+        flags |= PREPROC
+    elif token_type in token.Comment:
+        flags |= DOCUMENTATION
+    return flags
+
+
+class TokenClassTable(dict):
+    """
+    Maps the token types of one language to their category bitmask
+    """
+
+    def __init__(self, language):
+        super().__init__()
+        self.language = language
+
+    def __missing__(self, token_type):
+        self[token_type] = classify(self.language, token_type)
+        return self[token_type]
+
+
+def get_table(language):
+    """
+    Get the classification table of a language, built once per process
+    """
+    try:
+        return _tables[language]
+    except KeyError:
+        _tables[language] = TokenClassTable(language)
+        return _tables[language]
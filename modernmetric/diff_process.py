@@ -1,7 +1,13 @@
+import os
 import sys
-from pygments import lexers
-from modernmetric.cls.modules import get_modules_calculated, get_modules_metrics
+from numbers import Number
+
 from modernmetric.cls.importer.filtered import FilteredImporter
+from modernmetric.cls.modules import pack_store
+from modernmetric.fp import buffered_tokens, cached_result, decode_content
+from modernmetric.fp import lexer_for_filename, process_tokens
+from modernmetric.git import show
+import modernmetric.config as config
 
 
 def process_diff_content(_content, _file, _args, _importer):
@@ -9,7 +15,7 @@ def process_diff_content(_content, _file, _args, _importer):
     store = {}
 
     try:
-        _lexer = lexers.get_lexer_for_filename(_file)
+        _lexer = lexer_for_filename(_file)
     except Exception as e:
         if _args.ignore_lexer_errors:
             print("Processing unknown file type: " + _file, file=sys.stderr)
@@ -19,22 +25,84 @@ def process_diff_content(_content, _file, _args, _importer):
 
     try:
         _localImporter = {k: FilteredImporter(v, _file) for k, v in _importer.items()}
-        tokens = list(_lexer.get_tokens(_content))
+        tokens = []
+        _stream = _lexer.get_tokens(_content)
 
         if _args.dump:
-            for x in tokens:
+            for x in buffered_tokens(_stream, tokens):
                 print("{}: {} -> {}".format(_file, x[0], str(x[1])))
         else:
-            _localMetrics = get_modules_metrics(_args, **_localImporter)
-            _localCalc = get_modules_calculated(_args, **_localImporter)
-            for x in _localMetrics:
-                x.parse_tokens(_lexer.name, tokens)
-                res.update(x.get_results())
-                store.update(x.get_internal_store())
-            for x in _localCalc:
-                res.update(x.get_results(res))
-                store.update(x.get_internal_store())
+            res, store = process_tokens(_lexer.name, _stream, _args, _localImporter)
     except Exception:
         tokens = []
 
     return (res, _file, _lexer.name, tokens, store)
+
+
+def process_blob(data, path, _file, _args, _importer):
+    """
+    Analyse the content (bytes) of a version of a file, _file is the path
+    used for the lexer and the imports. Returns
+    (res, path, lexer name, [], packed store).
+    """
+    res = ({}, path, "unknown", [], {})
+    if data and len(data) <= config.MAX_FILE_SIZE:
+        try:
+            _content = decode_content(data)
+        except Exception:
+            _content = None
+        if _content:
+            res = process_diff_content(_content, _file, _args, _importer)
+            res = (res[0], path, res[2], [], pack_store(res[4]))
+    return res
+
+
+def blob_key(cache, _file, blob):
+    """
+    Cache key of the version blob (a git blob id) of a file, blob ids never
+    collide with the content hashes of files
+    """
+    return cache.key(_file, "git:" + blob)
+
+
+def blob_entry(result):
+    """
+    Cache entry of a process_blob result
+    """
+    res = {"res": result[0], "lexer_name": result[2], "store": result[4]}
+    if not (result[0] and result[4]):
+        res["reason"] = "no_results"
+    return res
+
+
+def process_revision_file(repo, path, blob, _args, _importer, cache=None):
+    """
+    process_blob of path in the git repository repo, blob is the id of the
+    version to analyse. Results are cached by blob id, so each version of
+    a file is analysed only once.
+    """
+    _file = os.path.join(repo, path)
+    if cache is not None:
+        result = cached_result(cache.get(blob_key(cache, _file, blob)), path)
+        if result is not None:
+            return result[:4] + (pack_store(result[4]),)
+
+    res = process_blob(show(repo, blob), path, _file, _args, _importer)
+    if cache is not None:
+        cache.set(blob_key(cache, _file, blob), blob_entry(res))
+    return res
+
+
+def metric_delta(base, head):
+    """
+    head - base for the numeric metrics of two results, a missing side
+    (an added or deleted file) counts as 0
+    """
+    base = base or {}
+    head = head or {}
+    res = {}
+    for k in sorted(set(base) | set(head)):
+        _values = [x.get(k, 0) for x in (base, head)]
+        if all(isinstance(x, Number) and not isinstance(x, bool) for x in _values):
+            res[k] = _values[1] - _values[0]
+    return res
@@ -2,14 +2,19 @@ import chardet
 import os
 import sys
 import time
+from collections import Counter
 from typing import Optional
 
 from pygments import lexers
+from pygments.util import ClassNotFound
 from pygments_tsx.tsx import patch_pygments
-from cachehash.main import Cache
 
+from modernmetric.cache import ResultCache, content_hash
+from modernmetric.cache import TIER_METRIC, TIER_TOKENS, pack_tokens, unpack_tokens
+from modernmetric.cls.dispatch import TokenDispatcher
 from modernmetric.cls.modules import get_modules_calculated
 from modernmetric.cls.modules import get_modules_metrics
+from modernmetric.cls.modules import get_modules_metrics_classes
 from modernmetric.cls.importer.filtered import FilteredImporter
 import modernmetric.config as config
 
@@ -17,6 +22,15 @@ patch_pygments()
 
 start_time = time.time()
 
+# base name -> pygments lexer, None if there is none
+_lexers = {}
+
+# reads and bytes read per file by this process
+io_reads = Counter()
+io_bytes = Counter()
+# content hash per file analysed by this process, for --with-stores
+content_digests = {}
+
 
 def print_time(msg, start_time=start_time):
     if not config.DEBUG:
@@ -25,13 +39,110 @@ def print_time(msg, start_time=start_time):
     print(f"{msg} took {elapsed_time:.2f} seconds")
 
 
+def lexer_for_filename(path):
+    """
+    The lexer of lexers.get_lexer_for_filename, looked up once per base name
+    (the lookup matches the patterns of every lexer). Lexers keep no state
+    between get_tokens calls, so the instance is shared.
+    """
+    _name = os.path.basename(path)
+    if _name not in _lexers:
+        try:
+            _lexers[_name] = lexers.get_lexer_for_filename(_name)
+        except ClassNotFound:
+            _lexers[_name] = None
+    if _lexers[_name] is None:
+        raise ClassNotFound("no lexer for filename {!r} found".format(_name))
+    return _lexers[_name]
+
+
+def has_lexer(path):
+    """
+    True if lexer_for_filename finds a lexer for path
+    """
+    try:
+        lexer_for_filename(path)
+    except ClassNotFound:
+        return False
+    return True
+
+
+def buffered_tokens(tokens, buffer):
+    """
+    Pass a token stream through, keeping a copy of every token in buffer
+    """
+    for x in tokens:
+        buffer.append(x)
+        yield x
+
+
+def run_metrics(language, tokens, metrics):
+    """
+    Run metric modules over a token stream in a single pass, returns the
+    {"res", "store"} of each module by class name
+    """
+    TokenDispatcher(metrics).walk(language, tokens)
+    return {
+        x.__class__.__name__: {"res": x.get_results(), "store": x.get_internal_store()}
+        for x in metrics
+    }
+
+
+def combine_results(metric_results, _args, _localImporter):
+    """
+    res and store of a file from the run_metrics results of all metric
+    modules, plus the ones of the calculated modules
+    """
+    res = {}
+    store = {}
+    for x in get_modules_metrics_classes():
+        res.update(metric_results[x.__name__]["res"])
+        store.update(metric_results[x.__name__]["store"])
+
+    for x in get_modules_calculated(_args, **_localImporter):
+        res.update(x.get_results(res))
+        store.update(x.get_internal_store())
+    return res, store
+
+
+def process_tokens(language, tokens, _args, _localImporter):
+    """
+    Run all metric modules over a token stream in a single pass.
+    The tokens are consumed as they come and are not kept.
+    """
+    _localMetrics = get_modules_metrics(_args, **_localImporter)
+    return combine_results(
+        run_metrics(language, tokens, _localMetrics), _args, _localImporter
+    )
+
+
+def tier_keys(cache, path, digest):
+    """
+    Lexer, "tokens" tier key and "metric" tier keys (by class name) of a
+    file, None if there is no lexer for it
+    """
+    try:
+        _lexer = lexer_for_filename(path)
+    except Exception:
+        return None
+    _tokens_key = cache.tokens_key(digest, _lexer.name)
+    return (
+        _lexer,
+        _tokens_key,
+        {
+            x.__name__: cache.metric_key(_tokens_key, x)
+            for x in get_modules_metrics_classes()
+        },
+    )
+
+
 def handle_rejected_file(_file, _args, old_file, err=None):
     _lexer = None
     res = {}
     store = {}
     lexer_name = "unknown"
     try:
-        _lexer = lexers.get_lexer_for_filename(_file)
+        _lexer = lexer_for_filename(_file)
         lexer_name = _lexer.name
         if err:
             raise err
@@ -42,67 +153,211 @@ def handle_rejected_file(_file, _args, old_file, err=None):
     return (res, old_file, lexer_name, [], store)
 
 
-def file_process(_file, _args, _importer, cache: Optional[Cache] = None):
+def cached_result(cached, old_file):
+    """
+    file_process result of a cache entry, None if the entry is not usable.
+    Entries of files without results (negative entries) record the reason:
+    "unknown_lexer", "encoding", "empty" or "no_results".
+    """
+    if cached is None:
+        return None
+    if cached.get("reason") or (
+        cached.get("res") and cached.get("lexer_name") and cached.get("store")
+    ):
+        return (cached["res"], old_file, cached["lexer_name"], [], cached["store"])
+    return None
+
+
+def read_file(path):
+    """
+    Read a whole file, counting the bytes read per file (see --io-stats)
+    """
+    with open(path, "rb") as i:
+        res = i.read()
+    io_reads[path] += 1
+    io_bytes[path] += len(res)
+    return res
+
+
+def decode_content(data):
+    """
+    Decode the content of a file, the encoding is detected from its start
+    """
+    sample = data[0 : min(config.ENCODING_SAMPLE_SIZE, len(data))]
+    _enc = chardet.detect(sample)["encoding"] or "utf-8"
+    print_time(f"\rEncoding detected: {_enc}")
+    return data.decode(_enc)
+
+
+def take_io_counters():
+    """
+    Returns and resets the (reads, bytes) per file counters of this process
+    """
+    res = (dict(io_reads), dict(io_bytes))
+    io_reads.clear()
+    io_bytes.clear()
+    return res
+
+
+def take_content_digests():
+    """
+    Returns and resets the content hashes of the files analysed by this
+    process, by file name
+    """
+    res = dict(content_digests)
+    content_digests.clear()
+    return res
+
+
+def file_process(
+    _file,
+    _args,
+    _importer,
+    cache: Optional[ResultCache] = None,
+    digest=None,
+    content=None,
+):
     print_time("Starting file process")
     old_file = _file
     _file = os.path.abspath(_file)
     _lexer = None
-    """Process a file, using cachehash if available"""
-    # Try to get cached result first
-    if cache is not None and not getattr(_args, "no_cache", False):
-        print_time("Checking cache")
+    """
+    Process a file, using the result cache if available.
+    digest is the content hash of the file, if the caller already has it.
+    content is the content (bytes) of a file that isn't on disk, e.g. a
+    member of an archive, _file is only its name then.
+    The file is read at most once, the content hash, the encoding
+    detection and the decoding all work on the same buffer.
+    """
+    # --dump prints the tokens as they are lexed, it always analyses the file
+    _caching = (
+        cache is not None and not getattr(_args, "no_cache", False) and not _args.dump
+    )
+    _key = None
+    # --with-stores writes the content hash of the buffer that was analysed
+    _keep_digest = getattr(_args, "with_stores", False) and content is None
+
+    def cache_call(fn, *args):
+        # a broken cache must not stop the analysis
         try:
-            cached_result = cache.get(_file)
-            if (
-                cached_result is not None
-                and isinstance(cached_result, dict)
-                and cached_result.get("res")
-                and cached_result.get("file")
-                and cached_result.get("lexer_name")
-                and cached_result.get("tokens")
-                and cached_result.get("store")
-            ):
-                return (
-                    cached_result["res"],
-                    cached_result["file"],
-                    cached_result["lexer_name"],
-                    cached_result["tokens"],
-                    cached_result["store"],
-                )
+            return fn(*args)
         except Exception as e:
             print(f"Cache error: {e}", file=sys.stderr)
+            return None
+
+    def remember(result, reason=None):
+        # files without results are cached as well, so the next run
+        # doesn't decode and look for a lexer again
+        if _key is not None:
+            _entry = {"res": result[0], "lexer_name": result[2], "store": result[4]}
+            if reason is not None:
+                _entry["reason"] = reason
+            cache_call(cache.set, _key, _entry)
+        return result
+
+    def analyse(language, tokens):
+        # runs the metric modules without a "metric" tier entry over tokens
+        _metrics = [
+            x
+            for x in get_modules_metrics(_args, **_localImporter)
+            if x.__class__.__name__ not in _known
+        ]
+        _results = dict(_known)
+        if _metrics:
+            _ran = run_metrics(language, tokens, _metrics)
+            for name, value in _ran.items():
+                cache_call(cache.set, _metric_keys[name], value, TIER_METRIC)
+            _results.update(_ran)
+        res, store = combine_results(_results, _args, _localImporter)
+        return remember(
+            (res, old_file, language, [], store),
+            None if res and store else "no_results",
+        )
 
     res = {}
     store = {}
+    # lexer, "tokens" and "metric" tier keys, see tier_keys
+    _tiers = None
+    # cached "metric" tier results by class name
+    _known = {}
 
     try:
-        if os.path.getsize(_file) > config.MAX_FILE_SIZE:
+        if content is None:
+            # stat before reading, for the stat index
+            _checked = time.time_ns()
+            _stat = os.stat(_file)
+            _size = _stat.st_size
+        else:
+            _size = len(content)
+        if _caching:
+            print_time("Checking cache")
+            if digest is None and content is None:
+                digest = cache_call(cache.indexed_digest, _file, _stat)
+            # Try to get cached result first
+            if digest is not None:
+                _key = cache.key(_file, digest)
+                result = cached_result(cache_call(cache.get, _key), old_file)
+                if result is not None:
+                    return result
+
+        if _size > config.MAX_FILE_SIZE:
             return handle_rejected_file(
                 _file, _args, old_file, err=ValueError("File too large")
             )
-        with open(_file, "rb") as i:
+        _cnt = content
+        if _cnt is None and (not _caching or digest is None):
             print_time("Reading file")
-            _cnt = i.read()
+            _cnt = read_file(_file)
             print_time("File read")
-            sample = _cnt[0 : min(config.ENCODING_SAMPLE_SIZE, len(_cnt))]
-            try:
-                _enc = chardet.detect(sample)["encoding"] or "utf-8"
-                print_time(f"\rEncoding detected for {_file}: {_enc}")
-                _cnt = _cnt.decode(_enc)
-            except Exception as e:
-                return handle_rejected_file(
+        if _caching and digest is None:
+            digest = content_hash(_cnt)
+            if content is None:
+                cache_call(cache.record_digest, _file, _stat, digest, _checked)
+            _key = cache.key(_file, digest)
+            result = cached_result(cache_call(cache.get, _key), old_file)
+            if result is not None:
+                return result
+        elif _keep_digest and digest is None:
+            digest = content_hash(_cnt)
+
+        _localImporter = {k: FilteredImporter(v, _file) for k, v in _importer.items()}
+        if _caching:
+            # no per file result, but maybe the tokens or the results of
+            # the single metric modules are cached
+            _tiers = cache_call(tier_keys, cache, _file, digest)
+        if _tiers is not None:
+            _lexer, _tokens_key, _metric_keys = _tiers
+            _found = cache_call(cache.get_many, list(_metric_keys.values())) or {}
+            _known = {k: _found[v] for k, v in _metric_keys.items() if v in _found}
+            if len(_known) == len(_metric_keys):
+                return analyse(_lexer.name, None)
+            _packed = cache_call(cache.get, _tokens_key)
+            if _packed is not None:
+                return analyse(_lexer.name, unpack_tokens(_packed))
+
+        if _cnt is None:
+            print_time("Reading file")
+            _cnt = read_file(_file)
+            print_time("File read")
+        try:
+            _cnt = decode_content(_cnt)
+        except Exception as e:
+            return remember(
+                handle_rejected_file(
                     _file, _args, old_file, err=ValueError("Encoding detection failed")
-                )
+                ),
+                "encoding",
+            )
         print_time("file re-encoded")
-        _lexer = None
 
         try:
             print_time("Trying guess_lexer_for_filename")
-            _lexer = lexers.get_lexer_for_filename(_file)
+            if _lexer is None:
+                _lexer = lexer_for_filename(_file)
         except Exception as e:
             print_time("Failing")
             if _args.ignore_lexer_errors:
-                return (res, old_file, "unknown", [], store)
+                return remember((res, old_file, "unknown", [], store), "unknown_lexer")
             else:
                 print("Processing unknown file type: " + _file, file=sys.stderr)
                 print(e)
@@ -110,46 +365,36 @@ def file_process(_file, _args, _importer, cache: Optional[Cache] = None):
         # If exception did not occur, still make sure we have a lexer
         if _lexer is None:
             if _args.ignore_lexer_errors:
-                return (res, old_file, "unknown", [], store)
+                return remember((res, old_file, "unknown", [], store), "unknown_lexer")
             else:
                 raise ValueError("No lexer found for file: " + _file)
 
-        if os.path.getsize(_file) == 0:
-            return (res, old_file, _lexer.name, [], store)
+        if not _cnt:
+            return remember((res, old_file, _lexer.name, [], store), "empty")
 
-        _localImporter = {k: FilteredImporter(v, _file) for k, v in _importer.items()}
-        tokens = list(_lexer.get_tokens(_cnt))
+        tokens = []
+        _stream = _lexer.get_tokens(_cnt)
+        if _args.dump:
+            # Only keep the tokens around if somebody is going to read them
+            _stream = buffered_tokens(_stream, tokens)
 
         if _args.dump:
-            for x in tokens:
+            for x in _stream:
                 print("{}: {} -> {}".format(_file, x[0], str(x[1])))
+        elif _tiers is not None:
+            # keep the tokens for the "tokens" tier
+            _lexed = []
+            result = analyse(_lexer.name, buffered_tokens(_stream, _lexed))
+            cache_call(cache.set, _tokens_key, pack_tokens(_lexed), TIER_TOKENS)
+            return result
         else:
-            _localMetrics = get_modules_metrics(_args, **_localImporter)
-            _localCalc = get_modules_calculated(_args, **_localImporter)
-
-            for x in _localMetrics:
-                x.parse_tokens(_lexer.name, tokens)
-                res.update(x.get_results())
-                store.update(x.get_internal_store())
-
-            for x in _localCalc:
-                res.update(x.get_results(res))
-                store.update(x.get_internal_store())
-
-        result = (res, old_file, _lexer.name, tokens, store)
-        resDict = {
-            "res": res,
-            "file": old_file,
-            "lexer_name": _lexer.name,
-            "tokens": tokens,
-            "store": store,
-        }
+            res, store = process_tokens(_lexer.name, _stream, _args, _localImporter)
 
         # Store in cache if available
-        if cache is not None and not getattr(_args, "no_cache", False):
-            cache.set(_file, resDict)
-
-        return result
+        return remember(
+            (res, old_file, _lexer.name, tokens, store),
+            None if res and store else "no_results",
+        )
 
     except Exception as e:
         print(f"Error processing file {_file}: {e}", file=sys.stderr)
@@ -158,3 +403,6 @@ def file_process(_file, _args, _importer, cache: Optional[Cache] = None):
         if _lexer:
             name = _lexer.name
         return (res, old_file, name, tokens, store)
+    finally:
+        if _keep_digest and digest is not None:
+            content_digests[old_file] = digest
@@ -0,0 +1,170 @@
+"""
+Read revisions of a local git repository, for 'modernmetric diff' and
+'modernmetric history'
+"""
+
+import os
+import subprocess
+
+# file modes of entries that aren't regular files: symlinks and submodules
+SKIPPED_MODES = ("120000", "160000")
+TREE_MODE = "40000"
+
+
+def git(repo, *args):
+    """
+    Output (bytes) of a git command run in repo, ValueError if it fails
+    """
+    try:
+        _run = subprocess.run(
+            ["git", "-C", repo] + list(args),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as e:
+        raise ValueError("Can't run git: {}".format(e))
+    if _run.returncode != 0:
+        raise ValueError(
+            "git {} failed: {}".format(
+                " ".join(args), _run.stderr.decode("utf-8", "replace").strip()
+            )
+        )
+    return _run.stdout
+
+
+def toplevel(repo):
+    return os.fsdecode(git(repo, "rev-parse", "--show-toplevel").strip())
+
+
+def resolve(repo, rev):
+    """
+    Commit id of a revision
+    """
+    return git(repo, "rev-parse", "--verify", rev + "^{commit}").decode().strip()
+
+
+def changed_files(repo, base, head):
+    """
+    (status, path, base blob id or None, head blob id or None) of the files
+    that differ between the commits base and head. Renames are reported as
+    a deletion plus an addition.
+    """
+    _raw = git(
+        repo, "diff", "--raw", "-z", "--no-renames", "--no-abbrev", base, head
+    ).split(b"\0")
+    res = []
+    # -z output alternates ":<modes> <blobs> <status>" and "<path>"
+    for meta, path in zip(_raw[0::2], _raw[1::2]):
+        _base_mode, _head_mode, _base, _head, _status = meta[1:].decode().split()
+        if _base_mode in SKIPPED_MODES or _head_mode in SKIPPED_MODES:
+            continue
+        res.append(
+            (
+                _status,
+                os.fsdecode(path),
+                None if _status == "A" else _base,
+                None if _status == "D" else _head,
+            )
+        )
+    return res
+
+
+def show(repo, obj):
+    """
+    Content (bytes) of an object, e.g. a blob id or <revision>:<path>
+    """
+    return git(repo, "show", obj)
+
+
+def commits(repo, rev, max_count=None, first_parent=False):
+    """
+    (commit id, commit time) of rev and its ancestors, oldest first
+    """
+    _args = ["rev-list", "--timestamp"]
+    if max_count:
+        _args.append("--max-count={}".format(max_count))
+    if first_parent:
+        _args.append("--first-parent")
+    res = []
+    for line in git(repo, *(_args + [rev, "--"])).decode().splitlines():
+        _time, _commit = line.split()
+        res.append((_commit, int(_time)))
+    return res[::-1]
+
+
+class CatFile:
+    """
+    A long running 'git cat-file --batch' process, reading any number of
+    objects without starting a git process per object
+    """
+
+    def __init__(self, repo):
+        self._process = subprocess.Popen(
+            ["git", "-C", repo, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        # entries (path, mode, object id) of the trees read so far,
+        # most subtrees don't change from one commit to the next
+        self._trees = {}
+
+    def read(self, obj):
+        """
+        (type, content) of an object
+        """
+        self._process.stdin.write(obj.encode() + b"\n")
+        self._process.stdin.flush()
+        _header = self._process.stdout.readline().split()
+        if len(_header) != 3:
+            raise ValueError("git object {} is missing".format(obj))
+        _content = self._process.stdout.read(int(_header[2]))
+        # the content is followed by a newline
+        self._process.stdout.read(1)
+        return _header[1].decode(), _content
+
+    def _tree(self, tree):
+        if tree not in self._trees:
+            _type, _content = self.read(tree)
+            if _type != "tree":
+                raise ValueError("git object {} is not a tree".format(tree))
+            # object ids are binary in trees, of the size of the hex id
+            _size = len(tree) // 2
+            res = []
+            _pos = 0
+            while _pos < len(_content):
+                _end = _content.index(b"\0", _pos)
+                _mode, _name = _content[_pos:_end].split(b" ", 1)
+                _id = _content[_end + 1 : _end + 1 + _size].hex()
+                _pos = _end + 1 + _size
+                res.append((os.fsdecode(_name), _mode.decode(), _id))
+            self._trees[tree] = res
+        return self._trees[tree]
+
+    def files(self, commit):
+        """
+        (path, blob id) of all regular files of a commit
+        """
+        _type, _content = self.read(commit)
+        if _type != "commit":
+            raise ValueError("git object {} is not a commit".format(commit))
+        res = []
+        _todo = [("", _content.split(b"\n", 1)[0].split()[1].decode())]
+        while _todo:
+            _prefix, _tree = _todo.pop()
+            for name, mode, obj in self._tree(_tree):
+                if mode == TREE_MODE:
+                    _todo.append((_prefix + name + "/", obj))
+                elif mode not in SKIPPED_MODES:
+                    res.append((_prefix + name, obj))
+        return sorted(res)
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
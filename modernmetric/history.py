@@ -0,0 +1,98 @@
+"""
+Metrics of many commits of a git repository without checking them out
+('modernmetric history').
+
+The trees and blobs are read through a single 'git cat-file --batch'
+process. Every distinct version of a file (file name and blob id) is
+analysed once, or taken from the cache, and the overall and stats
+sections of each commit are rebuilt from these per version results. The
+cost grows with the number of changed files, not with commits x files.
+"""
+
+import fnmatch
+import os
+import sys
+from multiprocessing import Pool
+
+from modernmetric.cls.modules import pack_store
+from modernmetric.diff_process import blob_entry, blob_key, process_blob
+from modernmetric.fp import cached_result, has_lexer
+
+# versions read and analysed at a time, bounds the contents held in memory
+HISTORY_CHUNK = 200
+
+
+def select_files(files, include=None, exclude=None):
+    """
+    The (path, blob id) pairs of files to analyse: the ones with a lexer,
+    matching one of the include and none of the exclude patterns. Files
+    without a lexer have no results, leaving them out doesn't change the
+    overall or stats sections.
+    """
+    return [
+        (path, blob)
+        for path, blob in files
+        if (not include or any(fnmatch.fnmatch(path, x) for x in include))
+        and not any(fnmatch.fnmatch(path, x) for x in exclude or ())
+        and has_lexer(path)
+    ]
+
+
+def version_results(repo, cat, trees, args, cache=None):
+    """
+    (res, packed store) of every distinct version of the files of trees,
+    a list of (commit, time, [(path, blob id)]), by (file name, blob id).
+    Versions missing in cache are read through cat (a git.CatFile) and
+    analysed, with args.jobs processes.
+    """
+    _versions = {}
+    for _, _, files in trees:
+        for path, blob in files:
+            _versions.setdefault((os.path.basename(path), blob), path)
+
+    res = {}
+    if cache is not None:
+        _keys = {
+            blob_key(cache, os.path.join(repo, path), version[1]): version
+            for version, path in _versions.items()
+        }
+        for key, value in cache.get_many(list(_keys)).items():
+            _result = cached_result(value, None)
+            if _result is not None:
+                res[_keys[key]] = (_result[0], pack_store(_result[4]))
+
+    _missing = [(v, path) for v, path in _versions.items() if v not in res]
+    _pool = Pool(processes=args.jobs) if args.jobs > 1 and _missing else None
+    try:
+        for i in range(0, len(_missing), HISTORY_CHUNK):
+            _chunk = _missing[i : i + HISTORY_CHUNK]
+            _tasks = [
+                (cat.read(blob)[1], path, os.path.join(repo, path), args, {})
+                for (_, blob), path in _chunk
+            ]
+            if _pool is not None:
+                _results = _pool.starmap(process_blob, _tasks)
+            else:
+                _results = [process_blob(*x) for x in _tasks]
+            for ((name, blob), path), result in zip(_chunk, _results):
+                res[(name, blob)] = (result[0], result[4])
+                if cache is not None:
+                    cache.set(
+                        blob_key(cache, os.path.join(repo, path), blob),
+                        blob_entry(result),
+                    )
+            if cache is not None:
+                # one transaction per chunk
+                cache.set_many(*cache.take_pending())
+            print(
+                "\rModernMetric analyzed {} of {} file versions\r".format(
+                    i + len(_chunk), len(_missing)
+                ),
+                file=sys.stderr,
+                end="",
+            )
+    finally:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+    return res
@@ -0,0 +1,98 @@
+"""
+Rescan a tree against the output of a previous run (--incremental).
+
+An output written with --with-stores holds, besides the usual sections, the
+content hash and the metric store of every file. The per file results of
+files whose content is unchanged are taken over from it, only new and
+changed files are analysed, and the overall and stats sections are computed
+again from all files.
+"""
+
+import json
+import sys
+
+from modernmetric.cache import file_hash
+
+INCREMENTAL_FORMAT = 1
+
+
+def file_digests(files, cache=None):
+    """
+    Content hashes of files, from the stat index of cache if there is one.
+    Files that can't be read are left out.
+    """
+    if cache is not None:
+        return cache.digest_files(files)
+    res = {}
+    for f in files:
+        try:
+            res[f] = file_hash(f)
+        except OSError:
+            pass
+    return res
+
+
+def incremental_section(fingerprint, digests, stores):
+    """
+    The section --with-stores adds to the output. stores is a list of
+    [file, store] pairs, files without content hash are left out.
+    """
+    return {
+        "format": INCREMENTAL_FORMAT,
+        "fingerprint": fingerprint,
+        "files": {
+            f: {"hash": digests[f], "store": store}
+            for f, store in stores
+            if f in digests
+        },
+    }
+
+
+def read_previous(path, fingerprint):
+    """
+    Mapping of the files of a previous output to (content hash, result,
+    store). Empty if the output was created by another modernmetric
+    version or with other metric options or imports, all files are
+    analysed again then. Raises ValueError if path isn't an output written
+    with --with-stores.
+    """
+    with open(path) as i:
+        try:
+            _previous = json.load(i)
+        except ValueError:
+            _previous = None
+    if not isinstance(_previous, dict):
+        raise ValueError("{} is not a modernmetric output".format(path))
+    _section = _previous.get("incremental")
+    if not isinstance(_section, dict) or _section.get("format") != INCREMENTAL_FORMAT:
+        raise ValueError("{} was not written with --with-stores".format(path))
+    if _section.get("fingerprint") != fingerprint:
+        sys.stderr.write(
+            "{} was created with another version or other options, "
+            "analysing all files\n".format(path)
+        )
+        return {}
+    try:
+        return {
+            f: (x["hash"], _previous["files"][f], x["store"])
+            for f, x in _section["files"].items()
+            if f in _previous.get("files", {})
+        }
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError("{} is incomplete or corrupted".format(path)) from e
+
+
+def split_unchanged(files, digests, previous):
+    """
+    Split files into the (file, result, store) of the unchanged ones and
+    the (file, content hash or None) pairs to analyse
+    """
+    unchanged = []
+    changed = []
+    for f in files:
+        _previous = previous.get(f)
+        if _previous is not None and digests.get(f) == _previous[0]:
+            unchanged.append((f, _previous[1], _previous[2]))
+        else:
+            changed.append((f, digests.get(f)))
+    return unchanged, changed
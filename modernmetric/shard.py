@@ -0,0 +1,120 @@
+"""
+Split one scan over several machines (--shard K/N) and merge the partial
+results back into the document a single run would have produced.
+"""
+
+import argparse
+import json
+import sys
+import zlib
+
+from modernmetric.cache import imports_hash
+from modernmetric.cls.modules import fold_aggregates, new_aggregates
+
+PARTIAL_FORMAT = 2
+
+# options that change the per file results or stores, all partials of one
+# scan have to agree on them
+PARTIAL_OPTIONS = [
+    "halstead_bug_predict_method",
+    "maintenance_index_calc_method",
+    "approx_global_metrics",
+    "approx_precision",
+]
+
+
+def parse_shard(value):
+    """
+    argparse type for K/N, returns (K, N)
+    """
+    try:
+        _shard, _shards = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shard must be given as K/N, e.g. 3/8")
+    if _shards < 1 or not 1 <= _shard <= _shards:
+        raise argparse.ArgumentTypeError("Shard {} out of range".format(value))
+    return (_shard, _shards)
+
+
+def in_shard(path, shard, shards):
+    """
+    Deterministic assignment of a path to one of the shards,
+    independent of the order or content of the file list
+    """
+    return zlib.crc32(path.encode("utf-8", "surrogatepass")) % shards == shard - 1
+
+
+def select_shard(files, shard, shards):
+    return [x for x in files if in_shard(x, shard, shards)]
+
+
+def partial_result(args, files, stores, importer):
+    """
+    stores is a list of [file, store] pairs, a file passed twice on the
+    command line is counted twice in the overall section, as in a single run.
+    The findings of the --warn_* and --coverage imports are recorded by
+    their hash, the files may be at other paths on other machines.
+    """
+    return {
+        "partial": {
+            "format": PARTIAL_FORMAT,
+            "shard": list(args.shard),
+            "options": {x: getattr(args, x, None) for x in PARTIAL_OPTIONS},
+            "imports": imports_hash(importer),
+        },
+        "files": files,
+        "stores": stores,
+    }
+
+
+def read_partials(paths):
+    """
+    The partial results of paths, they have to agree on the metric options
+    and imports. Raises ValueError otherwise.
+    """
+    res = []
+    for path in paths:
+        with open(path) as i:
+            _partial = json.load(i)
+        if _partial.get("partial", {}).get("format") != PARTIAL_FORMAT:
+            raise ValueError("{} is not a modernmetric partial result".format(path))
+        res.append(_partial)
+    if not res:
+        raise ValueError("No partial results to merge")
+
+    _options = res[0]["partial"]["options"]
+    for path, x in zip(paths, res):
+        if x["partial"]["options"] != _options:
+            raise ValueError(
+                "{} was created with different options: {} != {}".format(
+                    path, x["partial"]["options"], _options
+                )
+            )
+        if x["partial"]["imports"] != res[0]["partial"]["imports"]:
+            raise ValueError(
+                "{} was created with other --warn_* or --coverage imports".format(path)
+            )
+
+    _shards = {x["partial"]["shard"][1] for x in res}
+    _seen = [x["partial"]["shard"][0] for x in res]
+    if len(_shards) != 1:
+        sys.stderr.write("Merging partials of different shard counts\n")
+    elif len(set(_seen)) != len(_seen):
+        sys.stderr.write("Shards are merged more than once, result is inflated\n")
+    elif set(_seen) != set(range(1, _shards.pop() + 1)):
+        sys.stderr.write("Not all shards are merged, result is incomplete\n")
+    return res
+
+
+def merge_partials(partials, metrics):
+    """
+    Combine the per file results of partials and fold their stores into
+    the aggregates of metrics
+    """
+    files = {}
+    aggregates = new_aggregates(metrics)
+    for x in partials:
+        files.update(x["files"])
+        for _, store in x["stores"]:
+            fold_aggregates(metrics, aggregates, store)
+    return files, aggregates
@@ -0,0 +1,429 @@
+"""
+Keep the results of a tree up to date while it changes (--watch).
+
+The per file results and stores stay in memory. File system events come
+from inotify (through ctypes) or, where it isn't available, from polling
+the modification times. After a change only the touched files are
+analysed again, the overall section is folded from per bucket partial
+aggregates of which only the changed buckets are folded again, and the
+stats section is updated from running sums and sorted values.
+"""
+
+import ctypes
+import ctypes.util
+import math
+import os
+import select
+import stat
+import statistics
+import struct
+import sys
+import time
+import zlib
+from bisect import bisect_left
+from fractions import Fraction
+
+from modernmetric.cls.modules import fold_aggregates, new_aggregates
+from modernmetric.fp import has_lexer
+
+# buckets of files with a partial aggregate each
+WATCH_BUCKETS = 64
+DEFAULT_DEBOUNCE = 0.5
+DEFAULT_POLL_INTERVAL = 1.0
+# the smallest float is 2 ** -1074
+SCALE_BITS = 1074
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MODIFY
+)
+# struct inotify_event without the name that follows it
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class OwnFiles:
+    """
+    The files a watch run writes itself: the output file, its temporary
+    file and stdout and stderr if they are redirected to files. They are
+    neither analysed nor a change, every update would cause another one.
+    """
+
+    def __init__(self, paths=(), streams=()):
+        self._paths = {os.path.abspath(x) for x in paths}
+        self._ids = set()
+        for x in streams:
+            try:
+                _stat = os.fstat(x.fileno())
+            except (OSError, ValueError, AttributeError):
+                # closed, or not backed by a file descriptor
+                continue
+            if stat.S_ISREG(_stat.st_mode):
+                self._ids.add((_stat.st_dev, _stat.st_ino))
+
+    def __contains__(self, path):
+        if os.path.abspath(path) in self._paths:
+            return True
+        if not self._ids:
+            return False
+        try:
+            _stat = os.stat(path)
+        except OSError:
+            return False
+        return (_stat.st_dev, _stat.st_ino) in self._ids
+
+
+def walk_files(top, ignore=()):
+    """
+    The files of a directory tree with a lexer, hidden directories like
+    .git and the files in ignore are skipped
+    """
+    for root, dirs, files in os.walk(top):
+        dirs[:] = sorted(x for x in dirs if not x.startswith("."))
+        for name in sorted(files):
+            _path = os.path.join(root, name)
+            if has_lexer(name) and _path not in ignore:
+                yield _path
+
+
+def scan_files(paths, ignore=()):
+    """
+    The files to analyse of the watched paths, files passed directly are
+    always analysed, unless they are in ignore
+    """
+    res = []
+    for path in paths:
+        if os.path.isdir(path):
+            res.extend(walk_files(path, ignore))
+        elif path not in ignore:
+            res.append(path)
+    return res
+
+
+def touched_files(changes, known, paths, ignore=()):
+    """
+    Split the paths of change events into the files to analyse again and
+    the known files that are gone. A directory stands for all files below.
+    Changes of the files in ignore are dropped. Files passed directly are
+    reported by the paths they were passed as.
+    """
+    present = set()
+    gone = set()
+    # events of files next to a watched file are ignored
+    _dirs = tuple(x.rstrip(os.sep) + os.sep for x in paths if os.path.isdir(x))
+    # a file is watched through its directory, the events of a.py come as
+    # ./a.py, of ./x/../a.py as ./a.py
+    _named = {os.path.normpath(x): x for x in paths if not os.path.isdir(x)}
+    for path in changes:
+        path = _named.get(os.path.normpath(path), path)
+        if os.path.isdir(path):
+            present.update(walk_files(path, ignore))
+        elif os.path.isfile(path):
+            if path in ignore:
+                continue
+            if path in paths or (path.startswith(_dirs) and has_lexer(path)):
+                present.add(path)
+        else:
+            gone.add(path)
+    _prefixes = tuple(x.rstrip(os.sep) + os.sep for x in changes)
+    for f in known:
+        if f in gone or (f.startswith(_prefixes) and not os.path.isfile(f)):
+            gone.add(f)
+    return sorted(present), sorted(gone & set(known))
+
+
+class InotifyWatcher:
+    """
+    Change events of directory trees from inotify, new directories are
+    watched as they appear
+    """
+
+    def __init__(self, paths):
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = _libc.inotify_add_watch
+        self._fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self._dirs = {}
+        for path in paths:
+            if os.path.isdir(path):
+                self._add_tree(path)
+            else:
+                # files are watched through their directory
+                self._add(os.path.dirname(path) or ".")
+
+    def _add(self, path):
+        _wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        # a directory that is already gone again is reported by its parent
+        if _wd >= 0:
+            self._dirs[_wd] = path
+
+    def _add_tree(self, top):
+        for root, dirs, _ in os.walk(top):
+            dirs[:] = [x for x in dirs if not x.startswith(".")]
+            self._add(root)
+
+    def changes(self, timeout=None):
+        """
+        Paths changed within timeout seconds (None: wait for a change), or
+        None if events were lost and everything has to be checked
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        try:
+            _data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return set()
+        res = set()
+        _pos = 0
+        while _pos < len(_data):
+            _wd, _mask, _, _len = EVENT_HEADER.unpack_from(_data, _pos)
+            _pos += EVENT_HEADER.size
+            _name = os.fsdecode(_data[_pos : _pos + _len].rstrip(b"\0"))
+            _pos += _len
+            if _mask & IN_Q_OVERFLOW:
+                return None
+            if _mask & IN_IGNORED:
+                self._dirs.pop(_wd, None)
+                continue
+            if _wd not in self._dirs:
+                continue
+            _path = os.path.join(self._dirs[_wd], _name)
+            if _mask & IN_ISDIR and _mask & (IN_CREATE | IN_MOVED_TO):
+                if not _name.startswith("."):
+                    self._add_tree(_path)
+                    res.add(_path)
+            elif not _mask & IN_ISDIR or _mask & (IN_DELETE | IN_MOVED_FROM):
+                res.add(_path)
+        return res
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """
+    Changes found by comparing the size, modification time and inode of
+    the files every interval seconds
+    """
+
+    def __init__(self, paths, interval=DEFAULT_POLL_INTERVAL, ignore=()):
+        self._paths = paths
+        self._interval = interval
+        self._ignore = ignore
+        self._state = self._snapshot()
+        self._next = time.monotonic() + interval
+
+    def _snapshot(self):
+        res = {}
+        for f in scan_files(self._paths, self._ignore):
+            try:
+                _stat = os.stat(f)
+            except OSError:
+                continue
+            res[f] = (_stat.st_size, _stat.st_mtime_ns, _stat.st_ino)
+        return res
+
+    def changes(self, timeout=None):
+        _wait = self._next - time.monotonic()
+        if timeout is not None and timeout < _wait:
+            time.sleep(max(timeout, 0))
+            return set()
+        time.sleep(max(_wait, 0))
+        self._next = time.monotonic() + self._interval
+        _state = self._snapshot()
+        res = {f for f, x in _state.items() if self._state.get(f) != x}
+        res.update(f for f in self._state if f not in _state)
+        self._state = _state
+        return res
+
+    def close(self):
+        pass
+
+
+def open_watcher(paths, poll_interval=None, ignore=()):
+    """
+    inotify watcher of paths, or a polling one with poll_interval or if
+    inotify isn't available. The polling watcher doesn't look at the files
+    in ignore.
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError, TypeError):
+            # no inotify (not Linux) or no libc
+            poll_interval = DEFAULT_POLL_INTERVAL
+    return PollingWatcher(paths, poll_interval, ignore)
+
+
+def watch_loop(watcher, update, debounce=DEFAULT_DEBOUNCE):
+    """
+    Call update with the paths changed (None: all of them) once no further
+    change arrived for debounce seconds, until interrupted
+    """
+    pending = set()
+    everything = False
+    deadline = None
+    while True:
+        _timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        _changes = watcher.changes(_timeout)
+        if _changes is None or _changes:
+            if _changes is None:
+                everything = True
+            else:
+                pending.update(_changes)
+            deadline = time.monotonic() + debounce
+        elif deadline is not None and time.monotonic() >= deadline:
+            update(None if everything else pending)
+            pending = set()
+            everything = False
+            deadline = None
+
+
+class BucketAggregates:
+    """
+    Aggregates of metrics over files, kept as partial aggregates of buckets
+    of files. A changed file only causes its bucket to be folded again.
+    """
+
+    def __init__(self, metrics, buckets=WATCH_BUCKETS):
+        self._metrics = metrics
+        # per bucket: file -> store
+        self._stores = [{} for _ in range(buckets)]
+        self._partials = [new_aggregates(metrics) for _ in range(buckets)]
+        self._dirty = set()
+
+    def _bucket(self, path):
+        return zlib.crc32(path.encode("utf-8", "surrogatepass")) % len(self._stores)
+
+    def set(self, path, store):
+        _bucket = self._bucket(path)
+        self._stores[_bucket][path] = store
+        self._dirty.add(_bucket)
+
+    def remove(self, path):
+        _bucket = self._bucket(path)
+        if self._stores[_bucket].pop(path, None) is not None:
+            self._dirty.add(_bucket)
+
+    def total(self):
+        for bucket in self._dirty:
+            self._partials[bucket] = new_aggregates(self._metrics)
+            for store in self._stores[bucket].values():
+                fold_aggregates(self._metrics, self._partials[bucket], store)
+        self._dirty.clear()
+        res = new_aggregates(self._metrics)
+        for partial in self._partials:
+            fold_aggregates(self._metrics, res, partial)
+        return res
+
+
+def sqrt_of_fraction(x):
+    """
+    Square root of a Fraction as correctly rounded float, which is what
+    statistics.stdev returns for the exact variance since Python 3.11
+    """
+    _n, _m = x.numerator, x.denominator
+    # twice the bits of a float and a sticky bit, rounded once to a float
+    _shift = (_n.bit_length() - _m.bit_length() - 109) // 2
+    if _shift >= 0:
+        _m <<= 2 * _shift
+    else:
+        _n <<= -2 * _shift
+    _root = math.isqrt(_n // _m)
+    _root |= _root * _root * _m != _n
+    if _shift >= 0:
+        return float(_root << _shift)
+    return _root / (1 << -_shift)
+
+
+class IncrementalStats:
+    """
+    The stats section of MetricBaseStatsAverage (mean, median, max, min and
+    sd of each item over the files), from exact running sums and sorted
+    values that are updated as file results are added and removed
+    """
+
+    def __init__(self):
+        # item -> values, sorted unless the item is in _unsorted
+        self._values = {}
+        self._unsorted = set()
+        # item -> [scaled sum, scaled sum of squares, number of float values]
+        self._sums = {}
+
+    @staticmethod
+    def _items(res):
+        return [(k, v) for k, v in res.items() if not isinstance(v, list)]
+
+    @staticmethod
+    def _scaled(value):
+        # value * 2 ** SCALE_BITS is an integer for every float
+        _n, _d = value.as_integer_ratio()
+        return _n << (SCALE_BITS - _d.bit_length() + 1)
+
+    def _sorted(self, item):
+        if item in self._unsorted:
+            # new values were appended, sorting merges them in one pass
+            self._values[item].sort()
+            self._unsorted.discard(item)
+        return self._values[item]
+
+    def add(self, res):
+        for k, v in self._items(res):
+            self._values.setdefault(k, []).append(v)
+            self._unsorted.add(k)
+            _sums = self._sums.setdefault(k, [0, 0, 0])
+            _x = self._scaled(v)
+            _sums[0] += _x
+            _sums[1] += _x * _x
+            _sums[2] += isinstance(v, float)
+
+    def remove(self, res):
+        for k, v in self._items(res):
+            _values = self._sorted(k)
+            del _values[bisect_left(_values, v)]
+            _sums = self._sums[k]
+            _x = self._scaled(v)
+            _sums[0] -= _x
+            _sums[1] -= _x * _x
+            _sums[2] -= isinstance(v, float)
+
+    def results(self, items):
+        res = {x: {} for x in ("mean", "max", "min", "sd", "median")}
+        for k in items:
+            if not self._values.get(k):
+                continue
+            _values = self._sorted(k)
+            _n = len(_values)
+            _sum, _squares, _floats = self._sums[k]
+            _mean = Fraction(_sum, _n << SCALE_BITS)
+            # statistics.mean keeps ints for ints
+            if _floats or _mean.denominator != 1:
+                res["mean"][k] = float(_mean)
+            else:
+                res["mean"][k] = int(_mean)
+            if _n % 2:
+                res["median"][k] = _values[_n // 2]
+            else:
+                res["median"][k] = (_values[_n // 2 - 1] + _values[_n // 2]) / 2
+            res["max"][k] = _values[-1]
+            res["min"][k] = _values[0]
+            if _n < 2:
+                res["sd"][k] = 0.0
+            elif sys.version_info < (3, 11):
+                # stdev of Python < 3.11 takes the root of the variance
+                # rounded to a float (3.9 also of the deviations from the
+                # rounded mean), which doesn't depend on the order either
+                res["sd"][k] = statistics.stdev(_values)
+            else:
+                _ss = Fraction(_squares * _n - _sum * _sum, _n << (2 * SCALE_BITS))
+                res["sd"][k] = sqrt_of_fraction(_ss / (_n - 1))
+        return res
@@ -0,0 +1,58 @@
+import json
+import os
+import tracemalloc
+
+from modernmetric import Analyser
+from modernmetric.__main__ import main as modernmetric_main
+
+TESTFILES = os.path.join(os.path.dirname(__file__), "..", "testfiles")
+
+
+def test_analyser_matches_main(tmp_path, monkeypatch):
+    monkeypatch.chdir(TESTFILES)
+    files = ["test.c", "test.py", "test.js", "test.tsx"]
+    output = tmp_path / "output.json"
+    modernmetric_main(
+        custom_args=files
+        + ["--maintindex", "classic", "--no-cache"]
+        + ["--output_file", str(output)]
+    )
+    with open(output) as f:
+        expected = json.load(f)
+
+    contents = []
+    for i, name in enumerate(files):
+        with open(name, "rb") as f:
+            data = f.read()
+        # bytes and str contents
+        contents.append((name, data if i % 2 else data.decode("utf-8")))
+    analyser = Analyser(["--maintindex", "classic"])
+    for _ in range(2):
+        result = json.loads(json.dumps(analyser.analyse(contents)))
+        assert result == expected
+
+
+def test_analyser_files_without_results():
+    result = Analyser().analyse([("notes.unknownext", b"text\n"), ("empty.py", "")])
+    assert result["files"] == {"notes.unknownext": {}, "empty.py": {}}
+
+
+def test_analyser_does_not_retain_symbols():
+    analyser = Analyser()
+
+    def run(first):
+        source = "".join(
+            "v{0} = w{0} + {0}\n".format(i) for i in range(first, first + 2000)
+        )
+        analyser.analyse([("symbols.py", source)])
+
+    run(0)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for first in range(2000, 22000, 2000):
+            run(first)
+        # 60000 distinct symbols went through, none of them is kept
+        assert tracemalloc.get_traced_memory()[0] - before < 1 << 20
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,50 @@
+import os
+
+from modernmetric.cls.modules import get_modules_metrics
+from modernmetric.cls.sketch import HyperLogLog
+from modernmetric.fp import file_process
+
+
+class MockArgs:
+    """Mock args class for testing"""
+
+    def __init__(self, approx=False):
+        self.ignore_lexer_errors = True
+        self.dump = False
+        self.no_cache = True
+        self.approx_global_metrics = approx
+        self.approx_precision = 12
+
+
+def test_sketch_merge():
+    a = HyperLogLog(12)
+    b = HyperLogLog(12)
+    a.update(str(x) for x in range(0, 6000))
+    b.update(str(x) for x in range(3000, 9000))
+    merged = HyperLogLog.decode(a.encode()).merge(b)
+    assert abs(merged.cardinality() - 9000) < 9000 * 4 * merged.relative_error()
+    # merging is idempotent
+    assert merged.cardinality() == merged.merge(b).cardinality()
+
+
+def test_approx_global_metrics():
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = []
+    for root, _, names in os.walk(os.path.join(root_dir, "modernmetric")):
+        files += [os.path.join(root, x) for x in names if x.endswith(".py")]
+
+    exact = {}
+    approx = {}
+    for args, overall in ((MockArgs(), exact), (MockArgs(approx=True), approx)):
+        stores = [file_process(x, args, {})[4] for x in files]
+        for metric in get_modules_metrics(args):
+            overall.update(metric.get_results_global(stores))
+
+    for key in ("operands", "operators"):
+        error = approx["{}_uniq_error".format(key)]
+        uniq = exact["{}_uniq".format(key)]
+        assert approx["{}_sum".format(key)] == exact["{}_sum".format(key)]
+        assert abs(approx["{}_uniq".format(key)] - uniq) <= uniq * 4 * error
+        assert "{}_uniq_error".format(key) not in exact
+    assert approx["fanout_internal"] == exact["fanout_internal"]
+    assert approx["fanout_external"] == exact["fanout_external"]
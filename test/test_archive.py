@@ -0,0 +1,45 @@
+import json
+import tarfile
+import zipfile
+
+from modernmetric.__main__ import main as modernmetric_main
+
+FILES = {
+    "pkg/a.py": "def f(x):\n    if x:\n        return x\n    return 0\n",
+    "b.c": "int main() { return 0; }\n",
+    "notes.unknownext": "text\n",
+}
+
+
+def run(tmp_path, name, args):
+    output = tmp_path / name
+    modernmetric_main(custom_args=args + ["--output_file", str(output)])
+    with open(output) as f:
+        return json.load(f)
+
+
+def test_archives_match_extracted_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    tree = tmp_path / "tree"
+    for name, content in FILES.items():
+        (tree / name).parent.mkdir(parents=True, exist_ok=True)
+        (tree / name).write_text(content)
+    tarball = tmp_path / "files.tar.gz"
+    with tarfile.open(tarball, "w:gz") as archive:
+        for name in FILES:
+            archive.add(tree / name, arcname=name)
+    zipped = tmp_path / "files.zip"
+    with zipfile.ZipFile(zipped, "w") as archive:
+        archive.writestr("pkg/", "")
+        for name in FILES:
+            archive.write(tree / name, arcname=name)
+
+    monkeypatch.chdir(tree)
+    expected = run(tmp_path, "files.json", list(FILES) + ["--no-cache"])
+    # from the cache on the second run
+    for _ in range(2):
+        assert run(tmp_path, "tar.json", ["--archive", str(tarball)]) == expected
+        assert (
+            run(tmp_path, "zip.json", ["--archive", str(zipped), "--jobs", "2"])
+            == expected
+        )
@@ -0,0 +1,283 @@
+import gzip
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+
+import modernmetric.cache
+from modernmetric.__main__ import ArgParser, prefetch_cached, process_batch
+from modernmetric.cache import ResultCache
+from modernmetric.cache import export_bundle
+from modernmetric.cache import file_hash
+from modernmetric.cache import import_bundle
+from modernmetric.cache import is_stat_clean
+from modernmetric.cache import open_cache
+from modernmetric.cache import pack_tokens
+from modernmetric.cache import stat_row
+from modernmetric.cache import unpack_tokens
+from modernmetric.fp import file_process, lexer_for_filename, take_io_counters
+
+
+class MockArgs:
+    """Mock args class for testing"""
+
+    def __init__(self, **kwargs):
+        self.ignore_lexer_errors = True
+        self.dump = False
+        self.halstead_bug_predict_method = "new"
+        self.maintenance_index_calc_method = "classic"
+        self.__dict__.update(kwargs)
+
+
+def get_test_file():
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(project_root, "testfiles", "test.py")
+
+
+def test_cached_result_matches_analysis(tmp_path):
+    path = get_test_file()
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    first = file_process(path, MockArgs(), {}, cache)
+    key = cache.key(path, file_hash(path))
+    assert set(cache.get(key)) == {"res", "lexer_name", "store"}
+
+    second = file_process(path, MockArgs(), {}, cache)
+    assert second[0] == first[0]
+    assert second[2] == first[2]
+    cache.close()
+
+
+def test_key_depends_on_options_and_name(tmp_path):
+    path = get_test_file()
+    digest = file_hash(path)
+    default = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    other = ResultCache(
+        tmp_path / "cache.db", MockArgs(maintenance_index_calc_method="sei"), {}
+    )
+    assert default.key(path, digest) != other.key(path, digest)
+    assert default.key(path, digest) != default.key(path + ".txt", digest)
+    assert default.key(path, digest) == default.key(path, digest)
+    default.close()
+    other.close()
+
+
+def test_legacy_table_is_dropped(tmp_path):
+    db = sqlite3.connect(str(tmp_path / "cache.db"))
+    db.execute("CREATE TABLE modernmetric (key TEXT, hash TEXT, val TEXT)")
+    db.commit()
+    db.close()
+
+    ResultCache(tmp_path / "cache.db", MockArgs(), {}).close()
+    db = sqlite3.connect(str(tmp_path / "cache.db"))
+    tables = {x for (x,) in db.execute("SELECT name FROM sqlite_master")}
+    assert "modernmetric" not in tables
+    db.close()
+
+
+def test_prefetch_sends_only_misses(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    path = get_test_file()
+    other = os.path.join(os.path.dirname(path), "test.c")
+    args = ArgParser([path, other])
+    cache = open_cache(args, {})
+    assert prefetch_cached(args.files, args, cache) == (
+        [],
+        [(path, None), (other, None)],
+    )
+
+    analysed = file_process(path, args, {}, cache)
+    hits, misses = prefetch_cached(args.files, args, cache)
+    cache.close()
+    assert [x[:4] for x in hits] == [analysed[:4]]
+    assert misses == [(other, None)]
+
+
+def test_stat_index_skips_unchanged_files(tmp_path):
+    path = str(tmp_path / "a.py")
+    with open(path, "w") as f:
+        f.write("a = 1\n")
+    # well in the past, so the entry is not racy
+    os.utime(path, ns=(10**18, 10**18))
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    assert cache.indexed_digests([path]) == {}
+
+    cache.record_digest(path, os.stat(path), file_hash(path), time.time_ns())
+    assert cache.indexed_digests([path]) == {path: file_hash(path)}
+
+    # a changed file has to be hashed again
+    with open(path, "w") as f:
+        f.write("a = 22\n")
+    os.utime(path, ns=(10**18 + 1, 10**18 + 1))
+    assert cache.indexed_digests([path]) == {}
+    cache.close()
+
+
+def test_file_is_read_once(tmp_path):
+    path = get_test_file()
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    take_io_counters()
+    file_process(path, MockArgs(), {}, cache)
+    reads, nbytes = take_io_counters()
+    assert reads == {path: 1}
+    assert nbytes == {path: os.path.getsize(path)}
+    cache.close()
+
+
+def test_batches_drain_io_counters():
+    path = get_test_file()
+    take_io_counters()
+    for options in ([], ["--io-stats"]):
+        args = ArgParser([path, "--no-cache"] + options)
+        _, _, _, io, _, _ = process_batch([(path, None)], args, {})
+        # nothing is left for the next batch of a long lived worker
+        assert take_io_counters() == ({}, {})
+    assert io[0] == {os.path.abspath(path): 1}
+
+
+def test_recently_modified_files_are_racy(tmp_path):
+    path = tmp_path / "a.py"
+    path.write_text("a = 1\n")
+    stat = os.stat(path)
+    row = stat_row(str(path), stat, "x", stat.st_mtime_ns + 1)
+    assert not is_stat_clean(row, stat)
+    row = stat_row(str(path), stat, "x", stat.st_mtime_ns + 60 * 10**9)
+    assert is_stat_clean(row, stat)
+
+
+def test_files_without_results_are_cached(tmp_path):
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    for name, content, reason in (
+        ("data.unknownext", "x", "unknown_lexer"),
+        ("empty.py", "", "empty"),
+    ):
+        path = str(tmp_path / name)
+        with open(path, "w") as f:
+            f.write(content)
+        first = file_process(path, MockArgs(), {}, cache)
+        digest = file_hash(path)
+        assert cache.get(cache.key(path, digest))["reason"] == reason
+
+        take_io_counters()
+        assert file_process(path, MockArgs(), {}, cache, digest=digest) == first
+        assert take_io_counters() == ({}, {})
+    cache.close()
+
+
+def test_changed_metric_reuses_cached_tokens(tmp_path, monkeypatch):
+    path = get_test_file()
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    first = file_process(path, MockArgs(), {}, cache)
+    digest = file_hash(path)
+    tiers = {
+        tier: count
+        for tier, count in cache.db.execute(
+            "SELECT tier, COUNT(*) FROM results GROUP BY tier"
+        )
+    }
+    assert tiers == {"file": 1, "tokens": 1, "metric": 6}
+
+    # a new version of modernmetric with a changed metric module
+    cache.db.execute("DELETE FROM results WHERE tier = 'file'")
+    cache.db.commit()
+    monkeypatch.setitem(modernmetric.cache._metric_versions, "MetricBaseLOC", "x")
+    take_io_counters()
+    assert file_process(path, MockArgs(), {}, cache, digest=digest)[:3] == first[:3]
+    assert take_io_counters() == ({}, {})
+    assert cache.db.execute(
+        "SELECT COUNT(*) FROM results WHERE tier = 'metric'"
+    ).fetchone() == (7,)
+    cache.close()
+
+
+def test_packed_tokens_are_compressed():
+    path = modernmetric.cache.__file__
+    with open(path) as f:
+        tokens = list(lexer_for_filename(path).get_tokens(f.read()))
+    packed = pack_tokens(tokens)
+    assert unpack_tokens(packed) == tokens
+    assert len(json.dumps(packed)) < os.path.getsize(path)
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    value = {"res": {"loc": 1}, "lexer_name": "Python", "store": {"x": "y" * 10000}}
+    for i in range(200):
+        cache.set("key{}".format(i), value)
+    # key0 is the oldest entry, but was used recently
+    cache.db.execute("UPDATE results SET atime = atime - 1000")
+    cache.db.commit()
+    assert cache.get("key0") is not None
+    cache.flush()
+
+    assert cache.evict(max_bytes=cache.used_bytes() // 2) > 0
+    assert cache.used_bytes() < cache.stats()["file_bytes"]
+    assert cache.get("key0") is not None
+    assert cache.get("key1") is None
+
+    cache.db.execute("UPDATE results SET atime = ?", (int(time.time()),))
+    cache.db.execute("UPDATE results SET atime = atime - 100 WHERE key = 'key0'")
+    cache.db.commit()
+    assert cache.evict(max_age=50) == 1
+    assert cache.get("key0") is None
+    assert not cache.verify()
+    cache.close()
+
+
+def test_verify_finds_broken_entries(tmp_path):
+    cache = ResultCache(tmp_path / "cache.db", MockArgs(), {})
+    cache.set("good", {"res": {}, "lexer_name": "Python", "store": {}})
+    cache.set_many(
+        [
+            ("bad", "{not json", None, "file"),
+            ("partial", '{"res": {}}', None, "file"),
+            ("tokens", '{"types": []}', None, "tokens"),
+        ]
+    )
+    assert len(cache.verify()) == 3
+    assert len(cache.verify(repair=True)) == 3
+    assert cache.verify() == []
+    assert cache.get("good") is not None
+    cache.close()
+
+
+def test_bundle_warm_starts_another_cache(tmp_path):
+    path = get_test_file()
+    cache = ResultCache(tmp_path / "a.db", MockArgs(), {})
+    file_process(path, MockArgs(), {}, cache)
+    bundle = str(tmp_path / "cache.bundle")
+    count = export_bundle(cache, bundle)
+    cache.close()
+
+    other = ResultCache(tmp_path / "b.db", MockArgs(), {})
+    assert import_bundle(other, bundle) == count
+    assert import_bundle(other, bundle) == 0
+    assert other.get(other.key(path, file_hash(path))) is not None
+    other.close()
+
+
+def test_broken_bundle_is_refused(tmp_path):
+    path = get_test_file()
+    cache = ResultCache(tmp_path / "a.db", MockArgs(), {})
+    file_process(path, MockArgs(), {}, cache)
+    bundle = str(tmp_path / "cache.bundle")
+    export_bundle(cache, bundle)
+    cache.close()
+    with gzip.open(bundle, "rb") as f:
+        lines = f.read().split(b"\n")
+
+    broken = str(tmp_path / "broken.bundle")
+    with gzip.open(broken, "wb") as f:
+        f.write(b"\n".join([lines[0], lines[1].replace(b'",', b'x",', 1)]))
+        f.write(b"\n" + lines[-1])
+    other = ResultCache(tmp_path / "b.db", MockArgs(), {})
+    with pytest.raises(ValueError):
+        import_bundle(other, broken)
+    assert other.is_empty()
+
+    with gzip.open(broken, "wb") as f:
+        f.write(lines[0].replace(b'"tool": "', b'"tool": "x'))
+    with pytest.raises(ValueError):
+        import_bundle(other, broken)
+    other.close()
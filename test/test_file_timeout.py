@@ -0,0 +1,31 @@
+import json
+import os
+import time
+
+import modernmetric.__main__
+from modernmetric.__main__ import main as modernmetric_main
+
+TESTFILES = os.path.join(os.path.dirname(__file__), "..", "testfiles")
+
+
+def test_only_the_hanging_file_of_a_batch_is_lost(tmp_path, monkeypatch):
+    monkeypatch.chdir(TESTFILES)
+    file_process = modernmetric.__main__.file_process
+
+    def hanging_file_process(f, *args, **kwargs):
+        if f == "test.js":
+            time.sleep(3600)
+        return file_process(f, *args, **kwargs)
+
+    # the workers are forked with the patched function
+    monkeypatch.setattr(modernmetric.__main__, "file_process", hanging_file_process)
+    files = ["test.c", "test.js", "test.py", "test.go"]
+    output = tmp_path / "output.json"
+    modernmetric_main(
+        custom_args=files
+        + ["--batch-size", "4", "--file_timeout", "2", "--no-cache"]
+        + ["--output_file", str(output)]
+    )
+    with open(output) as f:
+        result = json.load(f)
+    assert sorted(result["files"]) == ["test.c", "test.go", "test.py"]
@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from modernmetric.__main__ import main as modernmetric_main
+from modernmetric.diff_process import metric_delta
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@t"]
+        + list(args),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def test_diff_reports_changed_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git(repo, "init", "-q")
+    (repo / "a.py").write_text("def f(x):\n    return x\n")
+    (repo / "b.py").write_text("import os\n")
+    (repo / "same.py").write_text("x = 1\n")
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "base")
+    (repo / "a.py").write_text("def f(x):\n    if x:\n        return x\n    return 0\n")
+    os.remove(repo / "b.py")
+    (repo / "c.py").write_text("y = 2\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "head")
+
+    output = tmp_path / "diff.json"
+    for _ in range(2):
+        # the second run takes all results from the cache
+        assert (
+            modernmetric_main(
+                custom_args=["diff", "HEAD~1", "--repo", str(repo)]
+                + ["--output_file", str(output)]
+            )
+            == 0
+        )
+        with open(output) as f:
+            result = json.load(f)
+
+        files = result["files"]
+        assert {k: v["status"] for k, v in files.items()} == {
+            "a.py": "M",
+            "b.py": "D",
+            "c.py": "A",
+        }
+        assert files["a.py"]["delta"]["loc"] == 2
+        assert files["b.py"]["head"] is None
+        assert files["c.py"]["delta"]["loc"] == files["c.py"]["head"]["loc"]
+        assert result["overall"]["delta"] == metric_delta(
+            result["overall"]["base"], result["overall"]["head"]
+        )
+
+
+def test_diff_of_unknown_revision_fails(tmp_path):
+    git(tmp_path, "init", "-q")
+    assert (
+        modernmetric_main(
+            custom_args=["diff", "nonexistent", "--repo", str(tmp_path), "--no-cache"]
+        )
+        == 1
+    )
@@ -0,0 +1,71 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+import modernmetric.history
+from modernmetric.__main__ import main as modernmetric_main
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+
+def git(repo, *args):
+    subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@t"]
+        + list(args),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def test_history_matches_runs_of_each_commit(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    repo = tmp_path / "repo"
+    (repo / "pkg").mkdir(parents=True)
+    git(repo, "init", "-q")
+    contents = [
+        {"pkg/a.py": "def f(x):\n    return x\n", "b.c": "int main() { return 0; }\n"},
+        {"pkg/a.py": "def f(x):\n    if x:\n        return x\n    return 0\n"},
+        {"notes.unknownext": "text\n", "pkg/c.py": "import os\n"},
+    ]
+    expected = []
+    for i, change in enumerate(contents):
+        for name, content in change.items():
+            (repo / name).write_text(content)
+        git(repo, "add", "-A")
+        git(repo, "commit", "-q", "-m", str(i))
+        files = sorted(str(x) for x in repo.rglob("*.[cp]*") if ".git" not in x.parts)
+        output = tmp_path / "run{}.json".format(i)
+        modernmetric_main(
+            custom_args=files + ["--no-cache", "--output_file", str(output)]
+        )
+        with open(output) as f:
+            expected.append(json.load(f))
+
+    analysed = []
+    process_blob = modernmetric.history.process_blob
+
+    def counting_process_blob(*args):
+        analysed.append(args[1])
+        return process_blob(*args)
+
+    monkeypatch.setattr(modernmetric.history, "process_blob", counting_process_blob)
+    output = tmp_path / "history.json"
+    for _ in range(2):
+        assert (
+            modernmetric_main(
+                custom_args=["history", "--repo", str(repo)]
+                + ["--output_file", str(output)]
+            )
+            == 0
+        )
+        with open(output) as f:
+            history = json.load(f)["commits"]
+        assert [x["files"] for x in history] == [2, 2, 3]
+        for commit, run in zip(history, expected):
+            assert commit["overall"] == run["overall"]
+            assert commit["stats"] == run["stats"]
+
+    # every version is analysed once, the second run takes all from the cache
+    assert sorted(analysed) == ["b.c", "pkg/a.py", "pkg/a.py", "pkg/c.py"]
@@ -0,0 +1,96 @@
+import glob
+import json
+import os
+import shutil
+
+import pytest
+
+import modernmetric.cache
+import modernmetric.incremental
+from modernmetric.__main__ import main as modernmetric_main
+from modernmetric.cache import content_hash
+
+
+def run(files, output, *options):
+    modernmetric_main(
+        custom_args=files + ["--no-cache", "--output_file", str(output)] + list(options)
+    )
+    with open(output) as f:
+        return json.load(f)
+
+
+def test_incremental_run_matches_full_run(tmp_path):
+    """Only changed files are analysed, the result is the one of a full run"""
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    tree = tmp_path / "tree"
+    tree.mkdir()
+    for x in glob.glob(os.path.join(project_root, "testfiles", "test.*")):
+        shutil.copy(x, tree)
+    files = sorted(str(x) for x in tree.iterdir())
+    previous = tmp_path / "previous.json"
+    run(files, previous, "--with-stores")
+
+    with open(files[0], "a") as f:
+        f.write("\n\n")
+    (tree / "new.py").write_text("import os\n\nx = os.sep\n")
+    files.append(str(tree / "new.py"))
+
+    full = run(files, tmp_path / "full.json", "--with-stores")
+    incremental = run(files, tmp_path / "inc.json", "--incremental", str(previous))
+    assert incremental == full
+
+    # results of other options are not taken over
+    full = run(files, tmp_path / "full.json", "--with-stores", "--maintindex", "sei")
+    incremental = run(
+        files,
+        tmp_path / "inc.json",
+        "--incremental",
+        str(previous),
+        "--maintindex",
+        "sei",
+    )
+    assert incremental == full
+
+
+@pytest.mark.parametrize("cache", ["--no-cache", "cold", "warm"])
+def test_stores_hash_the_analysed_content(tmp_path, monkeypatch, cache):
+    """--with-stores doesn't read the files again after the analysis"""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = sorted(glob.glob(os.path.join(project_root, "testfiles", "test.*")))
+    options = ["--with-stores", "--output_file", str(tmp_path / "out.json")]
+    if cache == "--no-cache":
+        options.append(cache)
+    elif cache == "warm":
+        modernmetric_main(custom_args=files + options)
+
+    def no_rehash(path):
+        raise AssertionError("{} hashed again".format(path))
+
+    monkeypatch.setattr(modernmetric.cache, "file_hash", no_rehash)
+    monkeypatch.setattr(modernmetric.incremental, "file_hash", no_rehash)
+    modernmetric_main(custom_args=files + options)
+    with open(tmp_path / "out.json") as f:
+        section = json.load(f)["incremental"]["files"]
+    for x in files:
+        with open(x, "rb") as f:
+            assert section[x]["hash"] == content_hash(f.read())
+
+
+def test_unusable_previous_output_is_refused(tmp_path, capsys):
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = [os.path.join(project_root, "testfiles", "test.py")]
+    output = tmp_path / "out.json"
+    previous = tmp_path / "previous.json"
+    for content in ["{not json", "[]", '{"files": {}}']:
+        previous.write_text(content)
+        assert (
+            modernmetric_main(
+                custom_args=files
+                + ["--no-cache", "--output_file", str(output)]
+                + ["--incremental", str(previous)]
+            )
+            == 1
+        )
+        assert str(previous) in capsys.readouterr().err
+    assert not output.exists()
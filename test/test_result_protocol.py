@@ -0,0 +1,82 @@
+import os
+
+from modernmetric.__main__ import RES_KEY_STORE, RES_KEY_TOKENS, compact_result
+from modernmetric.cls.modules import (
+    fold_aggregates,
+    get_modules_metrics,
+    new_aggregates,
+    pack_store,
+)
+from modernmetric.fp import file_process
+
+
+class MockArgs:
+    """Mock args class for testing"""
+
+    def __init__(self, dump=False, approx=False):
+        self.ignore_lexer_errors = True
+        self.dump = dump
+        self.no_cache = True
+        self.approx_global_metrics = approx
+        self.approx_precision = 10
+
+
+def _testfiles():
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return [
+        os.path.join(project_root, "testfiles", x)
+        for x in ("test.c", "test.go", "test.php", "test.py", "test.rb")
+    ]
+
+
+def test_compact_result_keeps_global_metrics():
+    args = MockArgs()
+    raw = [file_process(x, args, {}) for x in _testfiles()]
+    compact = [compact_result(x, args) for x in raw]
+
+    for x in compact:
+        assert x[RES_KEY_TOKENS] == []
+
+    for metric in get_modules_metrics(args):
+        assert metric.get_results_global(
+            [x[RES_KEY_STORE] for x in raw]
+        ) == metric.get_results_global([x[RES_KEY_STORE] for x in compact])
+
+
+def test_operand_stores_are_counted():
+    args = MockArgs()
+    path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "modernmetric",
+        "__main__.py",
+    )
+    res, _, _, _, store = file_process(path, args, {})
+    operands = store["MetricBaseOperands"]["operands"]
+    assert isinstance(operands, dict)
+    assert sum(operands.values()) == res["operands_sum"]
+    assert len(operands) == res["operands_uniq"]
+
+    # stores holding every occurrence are still understood
+    legacy = {"MetricBaseOperands": {"operands": ["a", "b", "a"]}}
+    assert pack_store(legacy) == {"MetricBaseOperands": {"operands": {"a": 2, "b": 1}}}
+
+
+def test_partial_aggregates_match_global_results():
+    for args in (MockArgs(), MockArgs(approx=True)):
+        stores = [file_process(x, args, {})[RES_KEY_STORE] for x in _testfiles()]
+        metrics = get_modules_metrics(args)
+
+        # fold two partials like two workers would, then combine them
+        first = new_aggregates(metrics)
+        second = new_aggregates(metrics)
+        for x in stores[:2]:
+            fold_aggregates(metrics, first, x)
+        for x in stores[2:]:
+            fold_aggregates(metrics, second, x)
+        combined = fold_aggregates(metrics, new_aggregates(metrics), second)
+        fold_aggregates(metrics, combined, first)
+
+        for metric in metrics:
+            assert metric.get_results_global(stores) == metric.get_results_aggregate(
+                combined[metric.__class__.__name__]
+            )
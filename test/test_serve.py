@@ -0,0 +1,76 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+
+import modernmetric.__main__
+from modernmetric.__main__ import main as modernmetric_main
+from modernmetric.__main__ import serve_request
+from modernmetric.client import main as client_main
+
+TESTFILES = os.path.join(os.path.dirname(__file__), "..", "testfiles")
+
+
+def test_daemon_answers_like_main(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.chdir(TESTFILES)
+    files = ["test.c", "test.py", "test.js"]
+    sock = str(tmp_path / "serve.sock")
+    expected = tmp_path / "expected.json"
+    modernmetric_main(custom_args=files + ["--output_file", str(expected)])
+
+    daemon = subprocess.Popen(
+        [sys.executable, "-m", "modernmetric", "serve", "--socket", sock]
+        + ["--jobs", "2"],
+        env=dict(os.environ, PYTHONPATH=os.path.join(TESTFILES, "..")),
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(300):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.1)
+        # the second request is answered by the warm workers and cache
+        for i in range(2):
+            output = tmp_path / "served{}.json".format(i)
+            args = ["--socket", sock] + files + ["--output_file", str(output)]
+            assert client_main(args) == 0
+            with open(output) as f, open(expected) as g:
+                assert json.load(f) == json.load(g)
+        assert client_main(["--socket", sock, "--bogus"]) == 2
+        assert client_main(["--socket", sock, "--stop"]) == 0
+        assert daemon.wait(timeout=60) == 0
+    finally:
+        if daemon.poll() is None:
+            daemon.kill()
+    assert not os.path.exists(sock)
+
+
+def test_daemon_refuses_runs_that_dont_terminate():
+    for argv in (
+        ["test.py", "--watch"],
+        ["test.py", "--wat"],
+        ["test.py", "--dump"],
+        ["serve"],
+        [],
+    ):
+        response = serve_request({"argv": argv, "cwd": TESTFILES})
+        assert response["status"] == 1
+        assert "Not supported by the daemon" in response["stderr"]
+
+
+def test_client_gets_what_the_workers_print(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    # the pool of a daemon, see serve_main
+    monkeypatch.setattr(modernmetric.__main__, "_shared_pool", Pool(processes=1))
+    try:
+        response = serve_request(
+            {"argv": ["test.py", "missing.py", "--no-cache"], "cwd": TESTFILES}
+        )
+    finally:
+        modernmetric.__main__._shared_pool.terminate()
+    assert response["status"] == 0
+    assert "Error processing file" in response["stderr"]
+    assert "missing.py" in response["stderr"]
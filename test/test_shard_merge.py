@@ -0,0 +1,70 @@
+import glob
+import json
+import os
+
+from modernmetric.__main__ import main as modernmetric_main
+from modernmetric.shard import select_shard
+
+
+def test_merged_shards_match_single_run(tmp_path):
+    """Merging the partials of all shards must give the single run result"""
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = sorted(glob.glob(os.path.join(project_root, "testfiles", "test*")))
+
+    single = tmp_path / "single.json"
+    modernmetric_main(custom_args=files + ["--no-cache", "--output_file", str(single)])
+
+    partials = []
+    for k in (1, 2, 3):
+        partial = tmp_path / "partial{}.json".format(k)
+        modernmetric_main(
+            custom_args=files
+            + ["--no-cache", "--shard", "{}/3".format(k)]
+            + ["--output_file", str(partial)]
+        )
+        partials.append(str(partial))
+
+    merged = tmp_path / "merged.json"
+    modernmetric_main(custom_args=["merge", "--output_file", str(merged)] + partials)
+
+    with open(single) as f:
+        expected = json.load(f)
+    with open(merged) as f:
+        assert json.load(f) == expected
+
+
+def test_shards_are_disjoint():
+    files = ["src/{}.py".format(x) for x in range(100)]
+    shards = [select_shard(files, k, 4) for k in (1, 2, 3, 4)]
+    assert sorted(sum(shards, [])) == sorted(files)
+    assert select_shard(list(reversed(files)), 2, 4) == list(reversed(shards[1]))
+
+
+def test_partials_of_other_imports_are_not_merged(tmp_path, capsys):
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    files = sorted(glob.glob(os.path.join(project_root, "testfiles", "test.*")))
+    coverage = tmp_path / "coverage.csv"
+    coverage.write_text("{},80\n".format(files[0]))
+    other = tmp_path / "other.csv"
+    other.write_text("{},20\n".format(files[0]))
+
+    partials = []
+    for k, imports in ((1, coverage), (2, other)):
+        partial = tmp_path / "partial{}.json".format(k)
+        modernmetric_main(
+            custom_args=files
+            + ["--no-cache", "--shard", "{}/2".format(k)]
+            + ["--coverage", str(imports), "--output_file", str(partial)]
+        )
+        partials.append(str(partial))
+
+    merged = tmp_path / "merged.json"
+    args = ["merge", "--output_file", str(merged)]
+    assert modernmetric_main(custom_args=args + partials) == 1
+    assert "other --warn_* or --coverage imports" in capsys.readouterr().err
+    # the merge itself has to use the imports of the partials
+    assert modernmetric_main(custom_args=args + partials[:1]) == 1
+    assert not merged.exists()
+    args += ["--coverage", str(coverage)]
+    assert modernmetric_main(custom_args=args + partials[:1]) is None
+    assert merged.exists()
@@ -0,0 +1,64 @@
+import os
+
+from pygments import lexers
+from pygments.token import Token
+
+from modernmetric.cls import tokenclass
+from modernmetric.cls.dispatch import TokenDispatcher
+from modernmetric.cls.modules import get_modules_metrics
+from modernmetric.cls.tokenclass import get_table
+
+
+class MockArgs:
+    """Mock args class for testing"""
+
+    def __init__(self):
+        self.ignore_lexer_errors = True
+        self.dump = False
+
+
+def test_single_walk_matches_per_metric_parse():
+    """One fused walk must give the same results as one walk per metric"""
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in ("test.c", "test.go", "test.php", "test.py", "test.rb"):
+        path = os.path.join(project_root, "testfiles", name)
+        with open(path) as f:
+            content = f.read()
+        lexer = lexers.get_lexer_for_filename(path)
+        tokens = list(lexer.get_tokens(content))
+
+        single = get_modules_metrics(MockArgs())
+        for x in single:
+            x.parse_tokens(lexer.name, tokens)
+
+        fused = get_modules_metrics(MockArgs())
+        TokenDispatcher(fused).walk(lexer.name, iter(tokens))
+
+        for a, b in zip(single, fused):
+            assert a.get_results() == b.get_results(), name
+            assert a.get_internal_store() == b.get_internal_store(), name
+
+
+def test_classification_is_per_language():
+    """Language specific categories must not leak into other languages"""
+    preproc = Token.Comment.Preproc
+    assert get_table("Python")[preproc] & tokenclass.COMMENT
+    assert not get_table("C")[preproc] & tokenclass.COMMENT
+    # classifying Python first must not change the C table
+    assert get_table("Python")[preproc] & tokenclass.COMMENT
+    assert not get_table("C")[preproc] & tokenclass.COMMENT
+    assert get_table("C")[Token.Comment.PreprocFile] & tokenclass.IMPORT
+    assert not get_table("Go")[Token.Comment.PreprocFile] & tokenclass.IMPORT
+
+
+def test_classification_follows_hierarchy():
+    table = get_table("Python")
+    assert table[Token.Keyword.Namespace] & tokenclass.KEYWORD
+    assert table[Token.Literal.String.Doc] & tokenclass.STRING
+    assert table[Token.Comment.Single] & tokenclass.DOCUMENTATION
+    assert table[Token.Comment.Preproc] & tokenclass.PREPROC
+    assert not table[Token.Comment.Preproc] & tokenclass.DOCUMENTATION
+    # named categories match the canonical type only
+    assert table[Token.Name] & tokenclass.OPERAND
+    assert not table[Token.Name.Builtin.Type] & tokenclass.OPERAND
+    assert not table[Token.Literal.String.Char] & tokenclass.OPERAND
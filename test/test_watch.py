@@ -0,0 +1,152 @@
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from modernmetric.__main__ import main as modernmetric_main
+from modernmetric.cls.stats.stats import MetricBaseStatsAverage
+from modernmetric.watch import IncrementalStats
+
+TESTFILES = os.path.join(os.path.dirname(__file__), "..", "testfiles")
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_incremental_stats_match_stats_module(seed):
+    rng = random.Random(seed)
+    files = {}
+    stats = IncrementalStats()
+    for i in range(500):
+        res = {"a": rng.randint(0, 100), "b": rng.random() * 1000, "lang": ["x"]}
+        if i % 3 == 0:
+            del res["b"]
+        files[i] = res
+        stats.add(res)
+    for i in rng.sample(range(500), 200):
+        stats.remove(files.pop(i))
+    overall = {"a": 0, "b": 0, "c": 0, "lang": []}
+    expected = MetricBaseStatsAverage(None).get_results(
+        {"files": files, "overall": overall}
+    )["stats"]
+    assert stats.results(overall) == expected
+
+
+def read_output(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@pytest.mark.parametrize("poll", [False, True])
+def test_watch_follows_changes(tmp_path, monkeypatch, poll):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("src/sub")
+    shutil.copy(os.path.join(TESTFILES, "test.py"), "src/a.py")
+    shutil.copy(os.path.join(TESTFILES, "test.c"), "src/sub/b.c")
+    shutil.copy(os.path.join(TESTFILES, "test.js"), "src/c.js")
+    output = tmp_path / "watch.json"
+    watcher = subprocess.Popen(
+        [sys.executable, "-m", "modernmetric", "--watch", "src", "--debounce", "0.2"]
+        + (["--poll-interval", "0.2"] if poll else [])
+        + ["--output_file", str(output)],
+        env=dict(os.environ, PYTHONPATH=os.path.join(TESTFILES, "..")),
+        stderr=subprocess.DEVNULL,
+    )
+
+    def expect(files):
+        expected = tmp_path / "expected.json"
+        modernmetric_main(custom_args=files + ["--output_file", str(expected)])
+        expected = read_output(expected)
+        for _ in range(300):
+            if read_output(output) == expected:
+                return
+            time.sleep(0.1)
+        assert read_output(output) == expected
+
+    try:
+        expect(["src/a.py", "src/c.js", "src/sub/b.c"])
+        with open("src/a.py", "a") as f:
+            f.write("def g(y):\n    return y\n")
+        os.remove("src/c.js")
+        os.makedirs("src/new")
+        shutil.copy(os.path.join(TESTFILES, "test.go"), "src/new/d.go")
+        expect(["src/a.py", "src/new/d.go", "src/sub/b.c"])
+    finally:
+        watcher.send_signal(signal.SIGINT)
+        assert watcher.wait(timeout=60) == 0
+
+
+@pytest.mark.parametrize("poll", [False, True])
+def test_watch_skips_its_own_output(tmp_path, monkeypatch, poll):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    os.makedirs(tmp_path / "tree")
+    monkeypatch.chdir(tmp_path / "tree")
+    shutil.copy(os.path.join(TESTFILES, "test.py"), "a.py")
+    expected = tmp_path / "expected.json"
+    modernmetric_main(custom_args=["./a.py", "--output_file", str(expected)])
+    expected = read_output(expected)
+    # the output, its temporary file and stderr are all in the watched tree
+    with open("err.txt", "w") as err:
+        watcher = subprocess.Popen(
+            [sys.executable, "-m", "modernmetric", "--watch", "."]
+            + ["--debounce", "0.2", "--output_file", "out.json"]
+            + (["--poll-interval", "0.2"] if poll else []),
+            env=dict(os.environ, PYTHONPATH=os.path.join(TESTFILES, "..")),
+            stderr=err,
+        )
+    try:
+        for _ in range(300):
+            if read_output("out.json") == expected:
+                break
+            time.sleep(0.1)
+        assert read_output("out.json") == expected
+        written = os.stat("out.json").st_ino
+        time.sleep(2)
+        # every write replaces the file
+        assert os.stat("out.json").st_ino == written
+    finally:
+        watcher.send_signal(signal.SIGINT)
+        assert watcher.wait(timeout=60) == 0
+
+
+@pytest.mark.parametrize("poll", [False, True])
+def test_watch_follows_files_passed_by_name(tmp_path, monkeypatch, poll):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    os.makedirs(tmp_path / "tree")
+    monkeypatch.chdir(tmp_path / "tree")
+    shutil.copy(os.path.join(TESTFILES, "test.py"), "a.py")
+    output = tmp_path / "watch.json"
+    watcher = subprocess.Popen(
+        [sys.executable, "-m", "modernmetric", "--watch", "a.py", "--debounce", "0.2"]
+        + (["--poll-interval", "0.2"] if poll else [])
+        + ["--output_file", str(output)],
+        env=dict(os.environ, PYTHONPATH=os.path.join(TESTFILES, "..")),
+        stderr=subprocess.DEVNULL,
+    )
+
+    def expect():
+        expected = tmp_path / "expected.json"
+        modernmetric_main(custom_args=["a.py", "--output_file", str(expected)])
+        expected = read_output(expected)
+        for _ in range(300):
+            if read_output(output) == expected:
+                return
+            time.sleep(0.1)
+        assert read_output(output) == expected
+
+    try:
+        expect()
+        with open("a.py", "a") as f:
+            f.write("def g(y):\n    return y\n")
+        expect()
+    finally:
+        watcher.send_signal(signal.SIGINT)
+        assert watcher.wait(timeout=60) == 0